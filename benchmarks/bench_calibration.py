@@ -0,0 +1,62 @@
+"""Per-frame cost of the science calibration: three passes vs. the fused model.
+
+The three-pass path mirrors what science_processor used to do per frame:
+subtract the bias, subtract the scaled dark, divide by the flat. The fused
+path applies figl_calib.CalibrationModel. Synthetic frames, no files.
+
+    python benchmarks/bench_calibration.py --size 4096 --frames 20
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "recipes"))
+
+from figl_calib import CalibrationModel  # noqa: E402
+
+
+def three_pass(frame, bias, dark, flat):
+    frame -= bias
+    frame -= dark
+    frame /= flat
+    return frame
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=int, default=2048, help="Frame size in pixels per side")
+    parser.add_argument("--frames", type=int, default=20, help="Number of frames timed")
+    parser.add_argument("--exptime", type=float, default=30.0, help="Exposure time of the frames")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    shape = (args.size, args.size)
+    bias = rng.normal(1000.0, 5.0, shape)
+    dark_rate = rng.normal(0.1, 0.01, shape)
+    flat = rng.normal(1.0, 0.02, shape)
+    raw = rng.normal(5000.0, 50.0, shape)
+
+    dark = dark_rate * args.exptime
+    start = time.perf_counter()
+    for _ in range(args.frames):
+        reference = three_pass(raw.copy(), bias, dark, flat)
+    three_pass_time = (time.perf_counter() - start) / args.frames
+
+    model = CalibrationModel(bias, dark_rate, flat)
+    model.offset(args.exptime)
+    start = time.perf_counter()
+    for _ in range(args.frames):
+        fused = model.apply(raw.copy(), 0, args.size, args.exptime)
+    fused_time = (time.perf_counter() - start) / args.frames
+
+    print(f"{args.size}x{args.size} float64, {args.frames} frames")
+    print(f"three-pass: {three_pass_time * 1e3:8.2f} ms/frame")
+    print(f"fused:      {fused_time * 1e3:8.2f} ms/frame  ({three_pass_time / fused_time:.2f}x)")
+    print(f"max relative difference: {np.max(np.abs(fused - reference) / np.abs(reference)):.2e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""Disk use and I/O time of plain vs. tile-compressed products.
+
+A raw 16-bit frame and a float master (the mean of ``--frames`` synthetic
+bias frames) are written plain and with every figl_io compression choice,
+then read back in full and in row bands the way the stacking engine reads
+them. The maximum quantisation error is reported in units of the noise.
+End-to-end recipe timings with compressed products come from
+``bench_recipes.py --compression rice``.
+
+    python benchmarks/bench_compression.py --size 2048
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+from astropy.io import fits
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "recipes"))
+
+from figl_io import compress_product  # noqa: E402
+from figl_stacking import FrameBands, band_rows, bands, read_image  # noqa: E402
+from synthetic import Night  # noqa: E402
+
+# (label, compression, quantize)
+CHOICES = (
+    ("none", "none", 0),
+    ("rice q=16", "rice", 16.0),
+    ("rice q=4", "rice", 4.0),
+    ("gzip q=16", "gzip", 16.0),
+    ("gzip lossless", "gzip", 0),
+)
+
+
+def measure(path, reference, noise, repeat=3):
+    read = []
+    banded = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        image = read_image(path)
+        read.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        with FrameBands([path]) as frames:
+            for y0, y1 in bands(frames.shape[0], band_rows(frames.shape, 1, "mean", 16)):
+                frames.read(0, y0, y1)
+        banded.append(time.perf_counter() - start)
+    return {
+        "size_mb": os.path.getsize(path) / 2**20,
+        "read_s": min(read),
+        "band_read_s": min(banded),
+        "max_error": float(np.max(np.abs(image - reference)) / noise),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=int, default=2048, help="Frame size in pixels per side")
+    parser.add_argument("--frames", type=int, default=10, help="Bias frames averaged into the float master")
+    args = parser.parse_args()
+
+    night = Night(args.size)
+    with tempfile.TemporaryDirectory() as tmp:
+        raw = night.bias_frame(os.path.join(tmp, "raw.fits"))
+        master = np.mean(
+            [night.bias + night.rng.normal(0.0, 5.0, night.shape) for _ in range(args.frames)], axis=0
+        )
+        fits.writeto(os.path.join(tmp, "master.fits"), master)
+        products = {
+            "raw uint16": (raw, read_image(raw), 5.0),
+            "master float64": (os.path.join(tmp, "master.fits"), master, 5.0 / np.sqrt(args.frames)),
+        }
+
+        print(f"{args.size}x{args.size}")
+        print(f"{'product':<16}{'compression':<15}{'MB':>8}{'write s':>9}{'read s':>9}{'bands s':>9}{'err/sigma':>11}")
+        for name, (source, reference, noise) in products.items():
+            for label, compression, quantize in CHOICES:
+                # Integers are always compressed losslessly, quantize does not apply.
+                if name.startswith("raw") and label in ("rice q=4", "gzip q=16"):
+                    continue
+                path = os.path.join(tmp, "product.fits")
+                shutil.copyfile(source, path)
+                start = time.perf_counter()
+                compress_product(path, compression, quantize)
+                write = time.perf_counter() - start
+                result = measure(path, reference, noise)
+                print(f"{name:<16}{label:<15}{result['size_mb']:8.2f}{write:9.3f}{result['read_s']:9.3f}"
+                      f"{result['band_read_s']:9.3f}{result['max_error']:11.4f}")
+
+
+if __name__ == "__main__":
+    main()
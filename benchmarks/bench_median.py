@@ -0,0 +1,74 @@
+"""Median of raw bias stacks of 10 to 500 frames: doubles, integers and histograms.
+
+Synthetic 16-bit bias frames are median-combined by the stacking engine
+three ways:
+
+* ``double``: the frames read as doubles and combined with ``np.median``,
+  what a recipe that calibrates while stacking gets (here with a
+  calibration that does nothing);
+* ``integer``: ``np.median`` on the raw integer bands (``integer_median=False``);
+* ``histogram``: the exact per-pixel histogram median (``integer_median=True``).
+
+Reports the wall time and the peak memory traced by tracemalloc for each and
+checks the results are identical. ``integer`` is what the bias and dark
+recipes use by default; ``histogram`` is selected with
+<ctx>.stacking.histogram.
+
+    python benchmarks/bench_median.py --size 1024 --memory 512 --frames 10 20 50 100 200 500
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "recipes"))
+
+from figl_stacking import stack_frames  # noqa: E402
+from synthetic import Night  # noqa: E402
+
+
+MODES = {
+    "double": {"calibrate": lambda idx, band, y0, y1: band},
+    "integer": {"integer_median": False},
+    "histogram": {"integer_median": True},
+}
+
+
+def measure(files, memory, options):
+    tracemalloc.start()
+    start = time.perf_counter()
+    combined = stack_frames(files, "median", memory, **options)
+    wall = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return combined, wall, peak / 2**20
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=int, default=512, help="Frame size in pixels per side")
+    parser.add_argument("--frames", type=int, nargs="+", default=[10, 20, 50, 100, 200, 500], help="Stack sizes")
+    parser.add_argument("--memory", type=float, default=1024, help="Memory budget of a stack in MB")
+    args = parser.parse_args()
+
+    night = Night(args.size)
+    failed = False
+    print(f"{'frames':>7}" + "".join(f"{mode + ' s':>13}{'MB':>7}" for mode in MODES) + "  identical")
+    with tempfile.TemporaryDirectory() as tmp:
+        files = []
+        for nframes in sorted(args.frames):
+            while len(files) < nframes:
+                files.append(night.bias_frame(os.path.join(tmp, f"bias_{len(files):04d}.fits")))
+            results = [measure(files[:nframes], args.memory, options) for options in MODES.values()]
+            identical = all(np.array_equal(combined, results[0][0]) for combined, _, _ in results)
+            failed |= not identical
+            print(f"{nframes:7d}" + "".join(f"{wall:13.2f}{mb:7.0f}" for _, wall, mb in results) + f"  {identical}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""Single vs. double precision through the bias, dark, flat and science stacks.
+
+Runs the same stacking and calibration calls as mBiasReal, mDark, mFlat and
+science on a synthetic night, once with ``precision`` double and once with
+single (raws kept as uint16 until the bias is subtracted, float32 after),
+and reports the time and the largest difference of every master in units of
+its pixel noise. The single precision products are expected to agree with
+the double ones to within 1e-3 of the noise (typically 1e-5 to 1e-4), i.e.
+the precision mode never changes a product at a level that matters.
+
+    python benchmarks/bench_precision.py --size 2048 --frames 20
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "recipes"))
+
+from figl_calib import CalibrationModel, DarkScaler  # noqa: E402
+from figl_stacking import PRECISIONS, read_image, stack_frames  # noqa: E402
+from synthetic import make_night  # noqa: E402
+
+# Largest allowed difference of single and double precision products, in units of their noise.
+TOLERANCE = 1e-3
+
+
+def reduce(night, precision, method, memory):
+    """Masters and science stack of ``night``, the way the recipes compute them."""
+    dtype = PRECISIONS[precision]
+    native = precision == "single"
+    raw_dtype = None if native else dtype
+    products = {}
+
+    products["bias"] = stack_frames(night["BIAS"], method, memory, dtype=dtype)
+
+    def subtract(image, offset):
+        return np.subtract(image, offset, out=image if image.dtype == dtype else None, dtype=dtype)
+
+    bias = products["bias"]
+    dark_exptime = 30.0
+    products["dark"] = stack_frames(
+        night["DARK"], method, memory, calibrate=lambda idx, band, y0, y1: subtract(band, bias[y0:y1]),
+        dtype=dtype, native=native,
+    ) / dark_exptime
+
+    offsets = DarkScaler(products["dark"], bias)
+    flat_exptime = 5.0
+    medians = [np.median(subtract(read_image(file, raw_dtype), offsets.scaled(flat_exptime))) for file in night["FLAT"]]
+
+    def calibrate_flat(idx, band, y0, y1):
+        band = subtract(band, offsets.scaled(flat_exptime)[y0:y1])
+        band /= medians[idx]
+        return band
+
+    products["flat"] = stack_frames(night["FLAT"], method, memory, calibrate=calibrate_flat, dtype=dtype, native=native)
+
+    model = CalibrationModel(bias, products["dark"], products["flat"], dtype=dtype)
+    products["science"] = stack_frames(
+        night["SCIENCE"], "mean", memory,
+        calibrate=lambda idx, band, y0, y1: model.apply(band, y0, y1, 30.0), dtype=dtype, native=native,
+    )
+    return products
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=int, default=1024, help="Frame size in pixels per side")
+    parser.add_argument("--frames", type=int, default=10, help="Number of bias, dark, flat and science frames")
+    parser.add_argument("--method", default="mean", help="Stacking method of the masters")
+    parser.add_argument("--memory", type=float, default=256, help="Memory budget of a stack in MB")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        night = make_night(tmp, args.size, args.frames, args.frames, args.frames, args.frames, 0)
+        results = {}
+        for precision in ("double", "single"):
+            start = time.perf_counter()
+            results[precision] = reduce(night, precision, args.method, args.memory)
+            print(f"{precision}: {time.perf_counter() - start:.2f} s")
+
+    failed = False
+    print(f"{'product':<10}{'max |diff|':>14}{'noise':>12}{'diff/noise':>12}")
+    for name, reference in results["double"].items():
+        diff = np.max(np.abs(results["single"][name].astype(np.float64) - reference))
+        # Pixel noise of the master, from the scatter of neighbouring pixels.
+        noise = np.std(np.diff(reference, axis=1)) / np.sqrt(2)
+        print(f"{name:<10}{diff:14.3e}{noise:12.3e}{diff / noise:12.2e}")
+        failed |= diff / noise > TOLERANCE
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""Stacking time with and without reading frames ahead.
+
+Stacks the synthetic bias, dark and flat frames of a night with every
+``--prefetch`` depth and reports the wall time and how much of the load
+time the prefetching hid behind the combination. ``--latency`` adds a delay
+to every band read, to mimic frames on a network file system; the results
+are identical for every depth.
+
+    python benchmarks/bench_prefetch.py --size 2048 --frames 20 --latency 0.005
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "recipes"))
+
+from figl_stacking import LoadStats, stack_frames  # noqa: E402
+from synthetic import make_night  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=int, default=1024, help="Frame size in pixels per side")
+    parser.add_argument("--frames", type=int, default=10, help="Number of bias, dark and flat frames")
+    parser.add_argument("--method", default="median", help="Stacking method")
+    parser.add_argument("--memory", type=float, default=256, help="Memory budget of a stack in MB")
+    parser.add_argument("--latency", type=float, default=0.0, help="Extra seconds per band read")
+    parser.add_argument("--prefetch", type=int, nargs="+", default=[0, 1, 2, 4], help="Prefetch depths to compare")
+    args = parser.parse_args()
+
+    def slow_read(idx, band, y0, y1):
+        time.sleep(args.latency)
+        return band
+
+    calibrate = slow_read if args.latency > 0 else None
+    with tempfile.TemporaryDirectory() as tmp:
+        night = make_night(tmp, args.size, args.frames, args.frames, args.frames, 0, 0)
+        print(f"{'frames':<8}{'prefetch':>9}{'wall s':>9}{'load s':>9}{'hidden s':>10}")
+        for tag in ("BIAS", "DARK", "FLAT"):
+            reference = None
+            for depth in args.prefetch:
+                stats = LoadStats()
+                start = time.perf_counter()
+                combined = stack_frames(
+                    night[tag], args.method, args.memory, calibrate=calibrate, prefetch=depth, load_stats=stats,
+                )
+                wall = time.perf_counter() - start
+                if reference is None:
+                    reference = combined
+                elif not np.array_equal(combined, reference):
+                    sys.exit(f"{tag} stack with prefetch {depth} differs from prefetch {args.prefetch[0]}.")
+                print(f"{tag:<8}{depth:9d}{wall:9.2f}{stats.load:9.2f}{stats.hidden:10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+"""Run every recipe on a synthetic night and record its cost.
+
+The night is generated with benchmarks/synthetic.py and reduced in workflow
+order: bias, dark, prep, flat, science, the Landolt field through the
+science recipe, zero point and photometry. Each recipe class is run directly
+in a fresh process inside its own working directory, so the peak resident
+memory measured belongs to that recipe alone. Results are written as JSON:
+
+    python benchmarks/bench_recipes.py --size 2048 --frames 20 -o results.json
+
+``--compression`` writes all image products tile-compressed; the disk use of
+every step's products is recorded as ``product_mb``.
+
+With ``--baseline`` the run is compared to an earlier results file and the
+script exits non-zero when a recipe got slower or bigger than ``--tolerance``.
+"""
+import argparse
+import importlib
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+
+RECIPES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "recipes")
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from synthetic import make_night  # noqa: E402
+
+
+# (step, module, class, output file, output tag), in workflow order.
+STEPS = (
+    ("bias", "mBiasReal", "BiasProcess", "MASTER_BIAS.fits", "MASTER_BIAS"),
+    ("dark", "mDark", "DarkProcess", "MASTER_DARK.fits", "MASTER_DARK"),
+    ("prep", "prep", "RawPrep", None, "CHOSEN_FLAT"),
+    ("flat", "mFlat", "FlatProcess", "MASTER_FLAT.fits", "MASTER_FLAT"),
+    ("science", "science", "ScienceProcess", "SCIENCE_FRAME.fits", "SCIENCE_FRAME"),
+    ("landolt", "science", "ScienceProcess", "SCIENCE_FRAME.fits", "SCIENCE_FRAME"),
+    ("zp", "zero_point", "Photometry", "SCIENCE_FRAME.fits", "STANDARD_FRAME"),
+    ("photometry", "photometry", "Photometry", "PHOTOMETRY.fits", "PHOTOMETRY_TABLE"),
+)
+
+
+def _run_recipe(module_name, class_name, workdir, inputs, settings, queue):
+    """Child process: run one recipe on ``inputs`` [(file, tag)] inside ``workdir``."""
+    sys.path.insert(0, os.path.abspath(RECIPES_DIR))
+    import cpl.ui
+
+    recipe = getattr(importlib.import_module(module_name), class_name)()
+    frameset = cpl.ui.FrameSet([cpl.ui.Frame(file=file, tag=tag) for file, tag in inputs])
+    os.chdir(workdir)
+    start = time.perf_counter()
+    products = recipe.run(frameset, settings)
+    wall = time.perf_counter() - start
+    queue.put({
+        "wall_s": wall,
+        # ru_maxrss is in kilobytes on Linux.
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "products": [(os.path.join(workdir, frame.file), frame.tag) for frame in products],
+    })
+
+
+def run_step(name, module_name, class_name, workdir, inputs, settings=None):
+    os.makedirs(workdir, exist_ok=True)
+    # A spawned process starts clean, a forked one would inherit our RSS.
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    process = context.Process(
+        target=_run_recipe,
+        args=(module_name, class_name, workdir, inputs, settings or {}, queue),
+    )
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        raise RuntimeError(f"Recipe {name} failed with exit code {process.exitcode}.")
+    result = queue.get()
+    nraw = sum(1 for _, tag in inputs if not tag.startswith("MASTER_"))
+    result.update({
+        "recipe": name,
+        "frames": nraw,
+        "fps": nraw / result["wall_s"],
+        "product_mb": sum(os.path.getsize(file) for file, _ in result["products"]) / 2**20,
+    })
+    return result
+
+
+def run_night(directory, size, frames, nscience, settings):
+    night = make_night(
+        os.path.join(directory, "raw"), size, nbias=frames, ndarks=frames, nflats=frames,
+        nscience=nscience, nlandolt=nscience,
+    )
+    results = []
+    products = {}
+
+    def step(name, inputs, step_settings=None):
+        _, module_name, class_name, _, tag = next(s for s in STEPS if s[0] == name)
+        result = run_step(name, module_name, class_name, os.path.join(directory, name), inputs,
+                          {**settings.get(name, {}), **(step_settings or {})})
+        print(f"{name:>10}: {result['frames']:4d} frames {result['wall_s']:8.2f} s "
+              f"{result['fps']:8.2f} frames/s {result['peak_rss_mb']:8.1f} MB peak RSS "
+              f"{result['product_mb']:8.1f} MB products")
+        results.append(result)
+        products[name] = [(file, frame_tag) for file, frame_tag in result.pop("products") if frame_tag == tag]
+        return products[name]
+
+    raw = lambda tag, frame_tag=None: [(file, frame_tag or tag) for file in night[tag]]  # noqa: E731
+
+    step("bias", raw("BIAS"))
+    step("dark", raw("DARK") + products["bias"])
+    step("prep", raw("FLAT"), {"prep.output.mode": "link"})
+    step("flat", products["prep"] + products["bias"] + products["dark"])
+    masters = products["bias"] + products["dark"] + products["flat"]
+    step("science", raw("SCIENCE") + masters)
+    step("landolt", raw("STANDARD", "SCIENCE") + masters)
+    step("zp", products["landolt"], {"zp.catalog": night["CATALOG"], "zp.match.radius": 3.0})
+    step("photometry", products["science"] + products["zp"])
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Regressions of ``results`` against ``baseline`` beyond ``tolerance`` (a fraction)."""
+    previous = {result["recipe"]: result for result in baseline["results"]}
+    regressions = []
+    for result in results:
+        old = previous.get(result["recipe"])
+        if old is None:
+            continue
+        for key in ("wall_s", "peak_rss_mb"):
+            if result[key] > old[key] * (1.0 + tolerance):
+                regressions.append(f"{result['recipe']} {key}: {old[key]:.2f} -> {result[key]:.2f}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=int, default=1024, help="Frame size in pixels per side")
+    parser.add_argument("--frames", type=int, default=10, help="Number of bias, dark and flat frames")
+    parser.add_argument("--science", type=int, default=5, help="Number of science and Landolt frames")
+    parser.add_argument("--method", default="mean", help="Stacking method of bias, dark and flat")
+    parser.add_argument("--compression", default="none", choices=("none", "rice", "gzip"),
+                        help="Tile compression of the image products")
+    parser.add_argument("--workdir", help="Directory for the synthetic night and products, default a temporary one")
+    parser.add_argument("-o", "--output", help="JSON file the results are written to")
+    parser.add_argument("--baseline", help="Earlier results file to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative slowdown or memory growth")
+    args = parser.parse_args()
+
+    settings = {
+        "bias": {"mbias.stacking.method": args.method, "mbias.output.compression": args.compression},
+        "dark": {"mdark.stacking.method": args.method, "mdark.output.compression": args.compression},
+        "prep": {"prep.output.compression": args.compression},
+        "flat": {"mflat.stacking.method": args.method, "mflat.output.compression": args.compression},
+        "science": {"science.output.compression": args.compression},
+        "landolt": {"science.output.compression": args.compression},
+        "zp": {"zp.output.compression": args.compression},
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        results = run_night(args.workdir or tmp, args.size, args.frames, args.science, settings)
+
+    report = {
+        "size": args.size,
+        "frames": args.frames,
+        "science": args.science,
+        "method": args.method,
+        "compression": args.compression,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
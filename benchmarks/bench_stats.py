@@ -0,0 +1,59 @@
+"""Time and error of the figl_stats estimators against the exact statistics.
+
+A synthetic flat (``--level`` counts with Poisson-like noise and saturated
+hot pixels) is measured as a float image and as raw uint16. For every
+estimator the median, MAD and 10th percentile are compared with
+``np.percentile``; the script fails if an error exceeds its stated bound.
+
+    python benchmarks/bench_stats.py --size 4096
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "recipes"))
+
+from figl_stats import METHODS, mad, median, percentile  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=int, default=4096, help="Image size in pixels per side")
+    parser.add_argument("--level", type=float, default=6000.0, help="Flat level in counts")
+    parser.add_argument("--repeat", type=int, default=3, help="Timing repetitions, the fastest is reported")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    image = rng.normal(args.level, np.sqrt(args.level), (args.size, args.size))
+    hot = rng.integers(0, args.size, (2, args.size))
+    image[hot[0], hot[1]] = 65000.0
+    images = {"float64": image, "uint16": np.clip(image, 0, 65535).astype(np.uint16)}
+
+    estimators = {
+        "median": lambda data, method: median(data, method),
+        "mad": lambda data, method: mad(data, method),
+        "p10": lambda data, method: percentile(data, 10.0, method),
+    }
+    failed = False
+    print(f"{'image':<9}{'statistic':<11}{'method':<11}{'ms':>9}{'value':>14}{'|error|':>11}{'bound':>11}")
+    for name, data in images.items():
+        for statistic, estimate in estimators.items():
+            exact = estimate(data, "exact").value
+            for method in METHODS:
+                times = []
+                for _ in range(args.repeat):
+                    start = time.perf_counter()
+                    result = estimate(data, method)
+                    times.append(time.perf_counter() - start)
+                error = abs(result.value - exact)
+                failed |= error > result.error + 1e-9 * abs(exact)
+                print(f"{name:<9}{statistic:<11}{method:<11}{min(times) * 1e3:9.1f}{result.value:14.4f}"
+                      f"{error:11.4f}{result.error:11.4f}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
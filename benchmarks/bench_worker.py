@@ -0,0 +1,126 @@
+"""Per-task overhead of a fresh process per recipe vs. the recipe worker.
+
+Runs the dark recipe ``--tasks`` times on a small synthetic night (so the
+recipe itself takes little time) in three ways:
+
+* ``process``: a fresh interpreter per task that imports cpl and the recipe
+  and runs it, which is what launching pyesorex per task costs;
+* ``client``: esorex_client.py per task, sending the job to a running
+  recipe_worker.py (what EDPS would launch instead of esorex);
+* ``submit``: the job sent to the worker from this process.
+
+The overhead of a task is its wall time minus the time the recipe ran.
+
+    python benchmarks/bench_worker.py --tasks 20
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+RECIPES_DIR = os.path.abspath(os.path.join(BENCH_DIR, "..", "recipes"))
+SCRIPTS_DIR = os.path.abspath(os.path.join(BENCH_DIR, "..", "python_scripts"))
+sys.path.insert(0, SCRIPTS_DIR)
+
+from recipe_worker import submit  # noqa: E402
+from synthetic import make_night  # noqa: E402
+
+# Runs one recipe in a fresh interpreter and prints the seconds it ran.
+PROCESS_RUNNER = """
+import json, os, sys, time
+sys.path.insert(0, {recipes!r})
+import cpl.ui
+from mDark import DarkProcess
+inputs = json.loads(sys.argv[1])
+os.makedirs(sys.argv[2], exist_ok=True)
+os.chdir(sys.argv[2])
+start = time.perf_counter()
+DarkProcess().run(cpl.ui.FrameSet([cpl.ui.Frame(file=f, tag=t) for f, t in inputs]), {{}})
+print(time.perf_counter() - start)
+"""
+
+
+def wait_for(path, process, timeout=60):
+    start = time.time()
+    while not os.path.exists(path):
+        if process.poll() is not None or time.time() - start > timeout:
+            raise RuntimeError("The recipe worker did not start.")
+        time.sleep(0.05)
+
+
+def summary(name, walls, recipes):
+    overhead = [wall - recipe for wall, recipe in zip(walls, recipes)]
+    print(f"{name:<10}{sum(walls) / len(walls):10.3f}{sum(recipes) / len(recipes):10.3f}"
+          f"{sum(overhead) / len(overhead):12.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=int, default=256, help="Frame size in pixels per side")
+    parser.add_argument("--frames", type=int, default=3, help="Number of dark frames per task")
+    parser.add_argument("--tasks", type=int, default=10, help="Number of tasks run each way")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        night = make_night(os.path.join(tmp, "raw"), args.size, nbias=args.frames, ndarks=args.frames,
+                           nflats=0, nscience=0, nlandolt=0)
+        socket_path = os.path.join(tmp, "worker.sock")
+        worker = subprocess.Popen([sys.executable, os.path.join(SCRIPTS_DIR, "recipe_worker.py"),
+                                   "--socket", socket_path], stdout=subprocess.DEVNULL)
+        try:
+            start = time.perf_counter()
+            wait_for(socket_path, worker)
+            print(f"Worker start-up: {time.perf_counter() - start:.2f} s")
+            reply = submit({"recipe": "bias_processor", "inputs": [(file, "BIAS") for file in night["BIAS"]],
+                            "workdir": os.path.join(tmp, "bias")}, socket_path)
+            inputs = [(file, "DARK") for file in night["DARK"]] + reply["products"]
+
+            sof = os.path.join(tmp, "dark.sof")
+            with open(sof, "w") as f:
+                f.writelines(f"{file} {tag}\n" for file, tag in inputs)
+
+            print(f"{'mode':<10}{'wall s':>10}{'recipe s':>10}{'overhead s':>12}")
+            walls, recipes = [], []
+            for task in range(args.tasks):
+                start = time.perf_counter()
+                output = subprocess.run(
+                    [sys.executable, "-c", PROCESS_RUNNER.format(recipes=RECIPES_DIR), json.dumps(inputs),
+                     os.path.join(tmp, "process", str(task))],
+                    check=True, capture_output=True, text=True,
+                ).stdout
+                walls.append(time.perf_counter() - start)
+                recipes.append(float(output.split()[-1]))
+            summary("process", walls, recipes)
+
+            walls, recipes = [], []
+            for task in range(args.tasks):
+                workdir = os.path.join(tmp, "client", str(task))
+                start = time.perf_counter()
+                subprocess.run([sys.executable, os.path.join(SCRIPTS_DIR, "esorex_client.py"), "--socket",
+                                socket_path, f"--output-dir={workdir}", "dark_processor", sof],
+                               check=True, stdout=subprocess.DEVNULL)
+                walls.append(time.perf_counter() - start)
+            # The client does not report the recipe time; it equals the submit one below.
+            client_walls = walls
+
+            walls, recipes = [], []
+            for task in range(args.tasks):
+                start = time.perf_counter()
+                reply = submit({"recipe": "dark_processor", "inputs": inputs,
+                                "workdir": os.path.join(tmp, "submit", str(task))}, socket_path)
+                walls.append(time.perf_counter() - start)
+                recipes.append(reply["seconds"])
+            summary("client", client_walls, recipes)
+            summary("submit", walls, recipes)
+            print(f"Master cache: {reply['masters']['hits']} hits, {reply['masters']['misses']} misses")
+        finally:
+            worker.terminate()
+            worker.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+"""Synthetic raw frames for one observing night of the LFOA camera.
+
+Writes bias, dark, flat, science and Landolt standard frames as 16-bit
+integer FITS files whose headers satisfy the classification rules of
+workflows/figl/figl_wkf.py (IMAGETYP, OBJTYP, FILTER, DATE-OBS, ORIGIN,
+EXPTIME), together with a standard star catalog (ID, X, Y and one magnitude
+column per filter band) for the Landolt field.
+
+    python benchmarks/synthetic.py /tmp/night --size 2048 --bias 20 --darks 20
+"""
+import argparse
+import datetime
+import os
+
+import numpy as np
+from astropy.io import fits
+
+ORIGIN = "LFOA"
+FILTER = "Bessel V"
+# Zero point the Landolt frames are rendered with.
+ZEROPOINT = 22.0
+BIAS_LEVEL = 1000.0
+READ_NOISE = 5.0
+DARK_RATE = 0.2
+SKY_LEVEL = 300.0
+FLAT_LEVEL = 6000.0
+PSF_SIGMA = 2.0
+
+
+def _header(imagetyp, exptime, date_obs, objtyp=None, filter_name=FILTER):
+    header = fits.Header()
+    header["IMAGETYP"] = imagetyp
+    if objtyp is not None:
+        header["OBJTYP"] = objtyp
+    header["FILTER"] = filter_name
+    header["EXPTIME"] = float(exptime)
+    header["DATE-OBS"] = date_obs.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3]
+    header["ORIGIN"] = ORIGIN
+    return header
+
+
+def _write(path, data, header):
+    data = np.clip(np.rint(data), 0, 65535).astype(np.uint16)
+    fits.PrimaryHDU(data, header).writeto(path, overwrite=True)
+    return path
+
+
+def _stars(shape, x, y, flux):
+    """Gaussian stars with total ``flux`` at 0-based positions (x, y)."""
+    image = np.zeros(shape)
+    half = int(np.ceil(5 * PSF_SIGMA))
+    offsets = np.arange(-half, half + 1)
+    for xc, yc, f in zip(x, y, flux):
+        xi, yi = int(round(xc)), int(round(yc))
+        ys = np.clip(yi + offsets, 0, shape[0] - 1)
+        xs = np.clip(xi + offsets, 0, shape[1] - 1)
+        stamp = np.exp(-((xs[None, :] - xc) ** 2 + (ys[:, None] - yc) ** 2) / (2 * PSF_SIGMA ** 2))
+        image[np.ix_(ys, xs)] += f * stamp / (2 * np.pi * PSF_SIGMA ** 2)
+    return image
+
+
+class Night:
+    """Fixed detector signatures shared by all frames of a synthetic night."""
+
+    def __init__(self, size, seed=0, start=None):
+        self.shape = (size, size)
+        self.rng = np.random.default_rng(seed)
+        self.time = start or datetime.datetime(2024, 3, 14, 18, 0, 0)
+        yy, xx = np.mgrid[0:size, 0:size] / size
+        self.bias = BIAS_LEVEL + 3.0 * np.sin(2 * np.pi * 4 * xx)
+        self.dark_rate = DARK_RATE * (1.0 + 0.5 * yy)
+        # Vignetting plus pixel-to-pixel sensitivity.
+        self.flat = (1.0 - 0.15 * ((xx - 0.5) ** 2 + (yy - 0.5) ** 2)) * self.rng.normal(1.0, 0.01, self.shape)
+
+    def _tick(self, exptime):
+        date_obs = self.time
+        self.time += datetime.timedelta(seconds=exptime + 5.0)
+        return date_obs
+
+    def _noise(self, signal):
+        return self.rng.poisson(np.maximum(signal, 0)) + self.rng.normal(0.0, READ_NOISE, self.shape)
+
+    def raw(self, signal, exptime):
+        return self.bias + self._noise(self.dark_rate * exptime + self.flat * signal)
+
+    def bias_frame(self, path):
+        return _write(path, self.bias + self.rng.normal(0.0, READ_NOISE, self.shape),
+                      _header("bias", 0.0, self._tick(0.0)))
+
+    def dark_frame(self, path, exptime):
+        return _write(path, self.raw(0.0, exptime), _header("dark", exptime, self._tick(exptime)))
+
+    def flat_frame(self, path, exptime):
+        return _write(path, self.raw(FLAT_LEVEL, exptime), _header("flat", exptime, self._tick(exptime)))
+
+    def object_frame(self, path, exptime, objtyp, x, y, mags):
+        flux = exptime * 10 ** (-0.4 * (np.asarray(mags) - ZEROPOINT))
+        signal = SKY_LEVEL + _stars(self.shape, x, y, flux)
+        return _write(path, self.raw(signal, exptime), _header("object", exptime, self._tick(exptime), objtyp))
+
+
+def make_night(directory, size=1024, nbias=10, ndarks=10, nflats=10, nscience=5, nlandolt=3,
+               dark_exptimes=(30.0,), flat_exptime=5.0, science_exptime=30.0, nstars=50, seed=0):
+    """Write a synthetic night to ``directory``.
+
+    Darks cycle through ``dark_exptimes``. Returns a dict with the file lists
+    under the raw tags of the workflow (BIAS, DARK, FLAT, SCIENCE, STANDARD)
+    and the path of the Landolt catalog under CATALOG.
+    """
+    os.makedirs(directory, exist_ok=True)
+    night = Night(size, seed)
+    rng = np.random.default_rng(seed + 1)
+    margin = 40
+    files = {"BIAS": [], "DARK": [], "FLAT": [], "SCIENCE": [], "STANDARD": []}
+
+    for idx in range(nbias):
+        files["BIAS"].append(night.bias_frame(os.path.join(directory, f"bias_{idx:03d}.fits")))
+    for idx in range(ndarks):
+        exptime = dark_exptimes[idx % len(dark_exptimes)]
+        files["DARK"].append(night.dark_frame(os.path.join(directory, f"dark_{idx:03d}.fits"), exptime))
+    for idx in range(nflats):
+        files["FLAT"].append(night.flat_frame(os.path.join(directory, f"flat_{idx:03d}.fits"), flat_exptime))
+
+    x = rng.uniform(margin, size - margin, nstars)
+    y = rng.uniform(margin, size - margin, nstars)
+    mags = rng.uniform(10.5, 13.5, nstars)
+    for idx in range(nlandolt):
+        files["STANDARD"].append(night.object_frame(
+            os.path.join(directory, f"landolt_{idx:03d}.fits"), science_exptime, "Landold", x, y, mags))
+
+    catalog = os.path.join(directory, "landolt_catalog.csv")
+    with open(catalog, "w") as f:
+        f.write("ID,X,Y,V,R\n")
+        for idx, (xc, yc, mag) in enumerate(zip(x, y, mags)):
+            f.write(f"{idx + 1},{xc + 1.0:.3f},{yc + 1.0:.3f},{mag:.4f},{mag - 0.3:.4f}\n")
+    files["CATALOG"] = catalog
+
+    x = rng.uniform(margin, size - margin, nstars)
+    y = rng.uniform(margin, size - margin, nstars)
+    mags = rng.uniform(10.5, 13.5, nstars)
+    for idx in range(nscience):
+        files["SCIENCE"].append(night.object_frame(
+            os.path.join(directory, f"science_{idx:03d}.fits"), science_exptime, "Supernova", x, y, mags))
+    return files
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("directory", help="Output directory")
+    parser.add_argument("--size", type=int, default=1024, help="Frame size in pixels per side")
+    parser.add_argument("--bias", type=int, default=10, help="Number of bias frames")
+    parser.add_argument("--darks", type=int, default=10, help="Number of dark frames")
+    parser.add_argument("--flats", type=int, default=10, help="Number of flat frames")
+    parser.add_argument("--science", type=int, default=5, help="Number of science frames")
+    parser.add_argument("--landolt", type=int, default=3, help="Number of Landolt standard frames")
+    parser.add_argument("--dark-exptimes", type=float, nargs="+", default=[30.0], help="Exposure times of the darks")
+    parser.add_argument("--flat-exptime", type=float, default=5.0, help="Exposure time of the flats")
+    parser.add_argument("--science-exptime", type=float, default=30.0, help="Exposure time of science and Landolt frames")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    args = parser.parse_args()
+
+    files = make_night(args.directory, args.size, args.bias, args.darks, args.flats, args.science,
+                       args.landolt, args.dark_exptimes, args.flat_exptime, args.science_exptime,
+                       seed=args.seed)
+    for tag, paths in files.items():
+        count = 1 if tag == "CATALOG" else len(paths)
+        print(f"{tag}: {count}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,126 @@
 import os
+import argparse
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from astropy.io import fits
 
+# FITS headers are made of 80 character cards in blocks of 2880 bytes.
+CARD_SIZE = 80
+BLOCK_SIZE = 2880
+END_CARD = "END".ljust(CARD_SIZE)
+
+def read_primary_header(f):
+    """
+    Read the raw primary header of an open FITS file.
+
+    Returns the list of cards before END and the number of header blocks.
+    """
+    cards = []
+    nblocks = 0
+    while True:
+        block = f.read(BLOCK_SIZE)
+        if len(block) < BLOCK_SIZE:
+            raise ValueError("No END card found in primary header")
+        nblocks += 1
+        block = block.decode("ascii")
+        for i in range(0, BLOCK_SIZE, CARD_SIZE):
+            card = block[i:i + CARD_SIZE]
+            if card == END_CARD:
+                return cards, nblocks
+            cards.append(card)
+
+def card_images(keyword, value):
+    # Keywords longer than 8 characters (like "ESO DET DIT") are HIERARCH cards
+    if (len(keyword) > 8 or " " in keyword) and not keyword.upper().startswith("HIERARCH "):
+        keyword = "HIERARCH " + keyword
+    # Long string values span several CONTINUE cards
+    image = fits.Card(keyword, value).image
+    return [image[i:i + CARD_SIZE] for i in range(0, len(image), CARD_SIZE)]
+
+def card_keyword(card):
+    """Keyword of a raw card, without the HIERARCH prefix (e.g. "ESO DET DIT")."""
+    return fits.Card.fromstring(card).keyword
+
+def apply_edits(cards, edits):
+    """
+    Apply (keyword, value, position) edits to a list of raw cards.
+
+    An existing keyword is replaced where it stands. A new keyword is inserted
+    at ``position`` (as in ``Header.insert``) or added at the end if position
+    is None.
+    """
+    cards = list(cards)
+    for keyword, value, position in edits:
+        new_cards = card_images(keyword, value)
+        keyword = card_keyword(new_cards[0])
+        for idx, card in enumerate(cards):
+            if card_keyword(card) == keyword:
+                end = idx + 1
+                while end < len(cards) and card_keyword(cards[end]) == "CONTINUE":
+                    end += 1
+                cards[idx:end] = new_cards
+                break
+        else:
+            if position is None or position > len(cards):
+                position = len(cards)
+            cards[position:position] = new_cards
+    return cards
+
+def edit_header(filepath, edits, dry_run=False):
+    """
+    Apply several keyword edits to the primary header of one FITS file.
+
+    The header is rewritten in place when the edited cards still fit into the
+    blocks the header already occupies. Only when it outgrows them is the file
+    rewritten through astropy, which has to move the data unit.
+
+    Returns "in place", "rewritten" or "unchanged".
+    """
+    with open(filepath, "rb") as f:
+        cards, nblocks = read_primary_header(f)
+
+    new_cards = apply_edits(cards, edits)
+    if new_cards == cards:
+        return "unchanged"
+
+    header = "".join(new_cards) + END_CARD
+    if len(header) <= nblocks * BLOCK_SIZE:
+        if not dry_run:
+            with open(filepath, "r+b") as f:
+                f.write(header.ljust(nblocks * BLOCK_SIZE).encode("ascii"))
+        return "in place"
+
+    if not dry_run:
+        with fits.open(filepath, mode="update") as hdul:
+            hdr = hdul[0].header
+            for keyword, value, position in edits:
+                if keyword in hdr or position is None:
+                    hdr[keyword] = value
+                else:
+                    hdr.insert(position, (keyword, value))
+    return "rewritten"
+
+def bulk_edit_headers(filepaths, edits, workers=8, dry_run=False):
+    """
+    Apply the same keyword edits to many FITS files concurrently.
+
+    Returns a Counter of how many files were edited in place, rewritten or
+    left unchanged.
+    """
+    results = Counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for filepath, result in zip(filepaths, pool.map(lambda path: edit_header(path, edits, dry_run), filepaths)):
+            results[result] += 1
+            print(f"{'Would edit' if dry_run else 'Edited'} {os.path.basename(filepath)}: {result}")
+    return results
+
+def fits_files(directory):
+    return sorted(
+        os.path.join(directory, filename)
+        for filename in os.listdir(directory)
+        if filename.endswith(".fits")
+    )
+
 def add_keyword_to_fits_header(directory, keyword, value, position=None):
     """
     Add a keyword with a string value to the header of all FITS files in a given directory.
@@ -11,21 +131,26 @@ def add_keyword_to_fits_header(directory, keyword, value, position=None):
     value (str): The string value of the keyword.
     position (int, optional): The position in the header to insert the keyword. If None, the keyword is added at the end.
     """
-    for filename in os.listdir(directory):
-        if filename.endswith(".fits"):
-            filepath = os.path.join(directory, filename)
-            with fits.open(filepath, mode='update') as hdul:
-                hdr = hdul[0].header  # Get the header of the primary HDU # type: ignore
-                if position is not None:
-                    hdr.insert(position, (keyword, value))  # Insert the keyword and value at the specified position
-                else:
-                    hdr[keyword] = value  # Add the keyword and value to the end of the header
-                hdul.flush()  # Save changes to the file
-            print(f"Added keyword '{keyword}' with value '{value}' to {filename} at position {position}")
-
-# Example usage
-directory = '/home/kali/Sof_Data/Landold-Feld'  # Replace with the path to your FITS files
-keyword = 'OBJTYP'
-value = 'Landold'
-position = 113  # Replace with the desired position, or set to None to add at the end
-add_keyword_to_fits_header(directory, keyword, value, position)
+    bulk_edit_headers(fits_files(directory), [(keyword, value, position)])
+
+def parse_edit(spec):
+    """Parse KEYWORD=VALUE or KEYWORD=VALUE@POSITION."""
+    keyword, _, value = spec.partition("=")
+    position = None
+    if "@" in value:
+        value, _, position = value.rpartition("@")
+        position = int(position)
+    return keyword, value, position
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Add or update string keywords in the primary header of many FITS files.")
+    parser.add_argument("directory", help="Directory containing the FITS files")
+    parser.add_argument("--set", dest="edits", action="append", type=parse_edit, required=True,
+                        metavar="KEYWORD=VALUE[@POSITION]", help="Keyword to set, may be given several times")
+    parser.add_argument("--workers", type=int, default=8, help="Number of files edited concurrently")
+    parser.add_argument("--dry-run", action="store_true", help="Only report how each file would be edited")
+    args = parser.parse_args()
+
+    # Example: python add_keyword.py /home/kali/Sof_Data/Landold-Feld --set OBJTYP=Landold@113
+    results = bulk_edit_headers(fits_files(args.directory), args.edits, args.workers, args.dry_run)
+    print(", ".join(f"{count} {result}" for result, count in results.items()))
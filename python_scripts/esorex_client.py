@@ -0,0 +1,69 @@
+"""
+Stand-in for the esorex executable that runs recipes in a recipe worker.
+
+Takes the esorex command line, ``[options] recipe [recipe options] sof``,
+sends the job to a running recipe_worker.py and prints the products. The
+set-of-frames file lists one ``file tag`` pair per line. Products are
+written to ``--output-dir``, the current directory by default.
+
+Example:
+    python esorex_client.py --output-dir=/reduced/bias bias_processor --mbias.stacking.method=median bias.sof
+"""
+import argparse
+import os
+import sys
+
+from recipe_worker import default_socket, submit
+
+
+def read_sof(path):
+    """(file, tag) pairs of a set-of-frames file, relative paths taken from the file's directory."""
+    frames = []
+    with open(path) as f:
+        for line in f:
+            fields = line.split("#", 1)[0].split()
+            if len(fields) < 2:
+                continue
+            file = fields[0] if os.path.isabs(fields[0]) else os.path.join(os.path.dirname(os.path.abspath(path)), fields[0])
+            frames.append((file, fields[1]))
+    return frames
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--socket", default=default_socket(), help="Path of the recipe worker's Unix socket")
+    parser.add_argument("--output-dir", default=".", help="Directory the products are written to")
+    parser.add_argument("recipe", help="Recipe name")
+    parser.add_argument("arguments", nargs=argparse.REMAINDER, help="Recipe options and the set-of-frames file")
+    args, ignored = parser.parse_known_args(argv)
+    for option in ignored:
+        print(f"Ignoring esorex option {option}.", file=sys.stderr)
+
+    parameters = {}
+    sof = None
+    for argument in args.arguments:
+        if argument.startswith("--"):
+            name, _, value = argument[2:].partition("=")
+            parameters[name] = value
+        else:
+            sof = argument
+    if sof is None:
+        parser.error("No set-of-frames file given.")
+
+    reply = submit({
+        "recipe": args.recipe,
+        "inputs": read_sof(sof),
+        "parameters": parameters,
+        "workdir": os.path.abspath(args.output_dir),
+    }, args.socket)
+    if "error" in reply:
+        print(reply["traceback"], file=sys.stderr)
+        print(f"Recipe {args.recipe} failed: {reply['error']}", file=sys.stderr)
+        return 1
+    for file, tag in reply["products"]:
+        print(f"{file} {tag}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
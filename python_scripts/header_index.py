@@ -0,0 +1,267 @@
+"""
+Persistent index of the raw frame headers of a FITS archive.
+
+Only the primary header blocks of each file are read, in parallel, and the
+keywords used by the classification and grouping rules of the figl workflow
+are stored in a SQLite database keyed by path, size and modification time.
+A rescan only reads files that are new or changed and drops files that are
+gone, so rerunning it on a large archive costs little more than a directory
+walk. Every frame also gets the observing night it belongs to: the date on
+which the night started, with nights running from one ``--night-boundary``
+hour (UT, noon by default) to the next. ``stamp`` writes the night into
+the NIGHT keyword of the raw headers, so the figl workflow can group a
+whole night's calibrations into one job.
+
+Examples:
+    python header_index.py archive.db scan /data/raw --workers 16
+    python header_index.py archive.db query --imagetyp flat --filter "Bessel V" --night 2024-03-14
+    python header_index.py archive.db stamp /data/raw
+"""
+import argparse
+import datetime
+import os
+import sqlite3
+import time
+
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from astropy.io import fits
+
+from add_keyword import card_keyword, edit_header, read_primary_header
+
+# Hour of DATE-OBS at which one observing night ends and the next begins.
+NIGHT_BOUNDARY = 12.0
+
+# Header keyword the observing night is stamped into.
+NIGHT_KEYWORD = "NIGHT"
+
+# Keywords of the classification and grouping rules, with their column names.
+KEYWORDS = {
+    "IMAGETYP": "imagetyp",
+    "OBJTYP": "objtyp",
+    "FILTER": "filter",
+    "DATE-OBS": "date_obs",
+    "ORIGIN": "origin",
+    "EXPTIME": "exptime",
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS frames (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    imagetyp TEXT,
+    objtyp TEXT,
+    filter TEXT,
+    date_obs TEXT,
+    origin TEXT,
+    exptime REAL,
+    night TEXT
+);
+CREATE INDEX IF NOT EXISTS frames_type ON frames (imagetyp, filter, night);
+CREATE INDEX IF NOT EXISTS frames_night ON frames (night);
+CREATE TABLE IF NOT EXISTS settings (
+    name TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+def observing_night(date_obs, boundary=NIGHT_BOUNDARY):
+    """Date (YYYY-MM-DD) on which the night of a DATE-OBS started, nights starting at ``boundary`` hours."""
+    if not date_obs:
+        return None
+    try:
+        start = datetime.datetime.fromisoformat(str(date_obs).strip()[:19])
+    except ValueError:
+        return None
+    return (start - datetime.timedelta(hours=boundary)).date().isoformat()
+
+
+def read_keywords(path, boundary=NIGHT_BOUNDARY):
+    """The indexed keywords of the primary header of ``path``, read from its header blocks only."""
+    with open(path, "rb") as f:
+        cards, _ = read_primary_header(f)
+    values = {}
+    for card in cards:
+        keyword = card_keyword(card)
+        if keyword in KEYWORDS:
+            value = fits.Card.fromstring(card).value
+            values[KEYWORDS[keyword]] = value.strip() if isinstance(value, str) else value
+    values["night"] = observing_night(values.get("date_obs"), boundary)
+    return values
+
+
+def fits_files(root):
+    """(path, size, mtime_ns) of every FITS file below ``root``."""
+    stack = [root]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.endswith((".fits", ".fit", ".fts")):
+                    stat = entry.stat()
+                    yield os.path.abspath(entry.path), stat.st_size, stat.st_mtime_ns
+
+
+class HeaderIndex:
+    def __init__(self, database, boundary=NIGHT_BOUNDARY):
+        self.connection = sqlite3.connect(database)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.executescript(SCHEMA)
+        self.boundary = boundary
+        stored = self.connection.execute("SELECT value FROM settings WHERE name = 'night_boundary'").fetchone()
+        if stored is None or float(stored["value"]) != boundary:
+            self._assign_nights()
+
+    def _assign_nights(self):
+        """Recompute the night of every frame for the current boundary, from the stored DATE-OBS."""
+        rows = self.connection.execute("SELECT path, date_obs FROM frames").fetchall()
+        with self.connection:
+            self.connection.executemany(
+                "UPDATE frames SET night = ? WHERE path = ?",
+                [(observing_night(row["date_obs"], self.boundary), row["path"]) for row in rows],
+            )
+            self.connection.execute(
+                "INSERT OR REPLACE INTO settings (name, value) VALUES ('night_boundary', ?)", (str(self.boundary),)
+            )
+
+    def close(self):
+        self.connection.close()
+
+    def scan(self, root, workers=8):
+        """Bring the index of the files below ``root`` up to date.
+
+        Returns the number of files read, unchanged and removed.
+        """
+        root = os.path.abspath(root)
+        known = {
+            row["path"]: (row["size"], row["mtime_ns"])
+            for row in self.connection.execute(
+                "SELECT path, size, mtime_ns FROM frames WHERE path LIKE ? ESCAPE '\\'",
+                (root.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + os.sep + "%",),
+            )
+        }
+        present = set()
+        changed = []
+        for path, size, mtime_ns in fits_files(root):
+            present.add(path)
+            if known.get(path) != (size, mtime_ns):
+                changed.append((path, size, mtime_ns))
+
+        def read(entry):
+            try:
+                return entry, read_keywords(entry[0], self.boundary)
+            except (OSError, ValueError, UnicodeDecodeError) as err:
+                print(f"Skipping {entry[0]}: {err}")
+                return entry, None
+
+        columns = list(KEYWORDS.values()) + ["night"]
+        rows = []
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for (path, size, mtime_ns), values in pool.map(read, changed):
+                if values is not None:
+                    rows.append([path, size, mtime_ns] + [values.get(column) for column in columns])
+
+        removed = [(path,) for path in known if path not in present]
+        with self.connection:
+            self.connection.executemany(
+                f"INSERT OR REPLACE INTO frames (path, size, mtime_ns, {', '.join(columns)}) "
+                f"VALUES ({', '.join('?' * (len(columns) + 3))})",
+                rows,
+            )
+            self.connection.executemany("DELETE FROM frames WHERE path = ?", removed)
+        return len(rows), len(present) - len(changed), len(removed)
+
+    def stamp(self, root, workers=8):
+        """Write the observing night into the NIGHT keyword of the indexed files below ``root``.
+
+        The headers are edited in place where they have room, and the index
+        is updated to the edited files, so the next scan does not read them
+        again. Returns a Counter of the edit results.
+        """
+        self.scan(root, workers)
+        root = os.path.abspath(root)
+        rows = [row for row in self.query() if row["path"].startswith(root + os.sep) and row["night"]]
+
+        def stamp_one(row):
+            try:
+                return row["path"], edit_header(row["path"], [(NIGHT_KEYWORD, row["night"], None)])
+            except (OSError, ValueError, UnicodeDecodeError) as err:
+                print(f"Skipping {row['path']}: {err}")
+                return row["path"], "failed"
+
+        results = Counter()
+        updates = []
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for path, result in pool.map(stamp_one, rows):
+                results[result] += 1
+                if result in ("in place", "rewritten"):
+                    stat = os.stat(path)
+                    updates.append((stat.st_size, stat.st_mtime_ns, path))
+        with self.connection:
+            self.connection.executemany("UPDATE frames SET size = ?, mtime_ns = ? WHERE path = ?", updates)
+        return results
+
+    def query(self, **conditions):
+        """Rows whose columns equal the given values, e.g. ``query(imagetyp="flat", night="2024-03-14")``."""
+        for column in conditions:
+            if column not in KEYWORDS.values() and column != "night":
+                raise ValueError(f"Unknown column {column!r}.")
+        where = " AND ".join(f"{column} = ?" for column in conditions) or "1"
+        return self.connection.execute(
+            f"SELECT * FROM frames WHERE {where} ORDER BY date_obs, path", tuple(conditions.values())
+        ).fetchall()
+
+    def headers(self, root, workers=8):
+        """Scan ``root`` and return {path: {keyword: value}} for its files, like ``fits.getheader``."""
+        self.scan(root, workers)
+        root = os.path.abspath(root)
+        headers = {}
+        for row in self.query():
+            if row["path"].startswith(root + os.sep):
+                header = {keyword: row[column] for keyword, column in KEYWORDS.items() if row[column] is not None}
+                header[NIGHT_KEYWORD] = row["night"]
+                headers[row["path"]] = header
+        return headers
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Index the classification keywords of a raw FITS archive.")
+    parser.add_argument("database", help="SQLite index file")
+    parser.add_argument("--night-boundary", type=float, default=NIGHT_BOUNDARY,
+                        help="Hour (UT) at which one observing night ends and the next begins")
+    commands = parser.add_subparsers(dest="command", required=True)
+    scan = commands.add_parser("scan", help="Index new and changed files below a directory")
+    scan.add_argument("root", help="Archive directory")
+    scan.add_argument("--workers", type=int, default=8, help="Number of headers read concurrently")
+    stamp = commands.add_parser("stamp", help=f"Write the observing night into the {NIGHT_KEYWORD} keyword of the files below a directory")
+    stamp.add_argument("root", help="Archive directory")
+    stamp.add_argument("--workers", type=int, default=8, help="Number of headers edited concurrently")
+    query = commands.add_parser("query", help="List the indexed files matching all given keywords")
+    for column in list(KEYWORDS.values()) + ["night"]:
+        query.add_argument(f"--{column.replace('_', '-')}", dest=column, help=f"Value of {column}")
+    args = parser.parse_args()
+
+    index = HeaderIndex(args.database, args.night_boundary)
+    start = time.perf_counter()
+    if args.command == "scan":
+        read, unchanged, removed = index.scan(args.root, args.workers)
+        print(f"{read} read, {unchanged} unchanged, {removed} removed in {time.perf_counter() - start:.2f} s")
+    elif args.command == "stamp":
+        results = index.stamp(args.root, args.workers)
+        print(", ".join(f"{count} {result}" for result, count in results.items()) or "No files to stamp")
+    else:
+        conditions = {
+            column: (float(value) if column == "exptime" else value)
+            for column, value in vars(args).items()
+            if column in KEYWORDS.values() or column == "night"
+            if value is not None
+        }
+        rows = index.query(**conditions)
+        for row in rows:
+            print(row["path"])
+        print(f"{len(rows)} files in {(time.perf_counter() - start) * 1e3:.1f} ms")
+    index.close()
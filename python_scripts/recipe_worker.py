@@ -0,0 +1,224 @@
+"""
+Long-lived worker that runs figl recipes sent to it over a Unix socket.
+
+Launching pyesorex for every task pays for the interpreter start-up,
+importing cpl and numpy, discovering the recipe plugins and reading the
+same master calibrations again. The worker does all of that once: the
+recipe modules stay imported (when a recipe or figl_* helper source
+changes, it is reloaded together with every module importing it) and
+master calibrations are kept in memory through the
+figl_calib master cache. Recipe jobs are run one at a time, since recipes
+work in the current directory.
+
+A job is one line of JSON, answered with one line of JSON:
+
+    {"recipe": "bias_processor", "inputs": [["/raw/b1.fits", "BIAS"], ...],
+     "parameters": {"mbias.stacking.method": "median"}, "workdir": "/reduced/bias"}
+    {"products": [["/reduced/bias/MASTER_BIAS.fits", "MASTER_BIAS"]], "seconds": 1.2}
+
+``esorex_client.py`` sends jobs with an esorex-like command line.
+
+Example:
+    python recipe_worker.py --socket /tmp/figl.sock --cache 2048
+"""
+import argparse
+import importlib
+import json
+import os
+import socket
+import sys
+import time
+import traceback
+
+RECIPES_DIR = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "recipes"))
+
+# Memory for master calibrations kept between jobs, in MB.
+DEFAULT_MASTER_CACHE = 1024
+
+
+def default_socket():
+    return os.environ.get("FIGL_WORKER_SOCKET", os.path.join("/tmp", f"figl-worker-{os.getuid()}.sock"))
+
+
+def _coerce(parameter, value):
+    """``value`` converted to the type of ``parameter``, for values given as strings on a command line."""
+    current = parameter.value
+    if not isinstance(value, str) or isinstance(current, str):
+        return value
+    if isinstance(current, bool):
+        return value.strip().lower() in ("true", "1", "yes")
+    return type(current)(value)
+
+
+def reload_order(changed, imports):
+    """Modules to reload after ``changed`` were edited, dependencies first.
+
+    These are the changed modules and every module importing one of them,
+    directly or not; ``imports`` maps a module to the modules it imports.
+    """
+    stale = set(changed)
+    grown = True
+    while grown:
+        grown = False
+        for name, used in imports.items():
+            if name not in stale and stale & set(used):
+                stale.add(name)
+                grown = True
+    order, visited = [], set()
+
+    def visit(name):
+        if name in visited:
+            return
+        visited.add(name)
+        for dependency in sorted(imports.get(name, ())):
+            if dependency in stale:
+                visit(dependency)
+        order.append(name)
+
+    for name in sorted(stale):
+        visit(name)
+    return order
+
+
+class RecipeWorker:
+    def __init__(self, recipes_dir=RECIPES_DIR, master_cache=DEFAULT_MASTER_CACHE):
+        # Imported here, so the client importing submit() starts fast.
+        import cpl.ui
+
+        # Importing run_workflow puts the recipes directory on the module path.
+        from run_workflow import HELPER_IMPORT, find_recipes
+        import figl_calib
+
+        self.cpl_ui = cpl.ui
+        self.figl_calib = figl_calib
+        self.find_recipes = find_recipes
+        self.helper_import = HELPER_IMPORT
+        self.recipes_dir = recipes_dir
+        self.master_cache = master_cache
+        self.recipes = find_recipes(recipes_dir)
+        figl_calib.MASTERS.resize(master_cache)
+        for module_name, _, _ in self.recipes.values():
+            importlib.import_module(module_name)
+        self._mtimes = self._loaded()
+
+    def _loaded(self):
+        """Modification times of the imported modules whose source is in the recipes directory."""
+        mtimes = {}
+        for name, module in list(sys.modules.items()):
+            path = getattr(module, "__file__", None)
+            if path is None or os.path.dirname(os.path.abspath(path)) != self.recipes_dir:
+                continue
+            try:
+                mtimes[name] = os.stat(path).st_mtime_ns
+            except OSError:
+                continue
+        return mtimes
+
+    def _reload_changed(self):
+        """Reload the recipe and helper modules whose source changed since they were loaded."""
+        current = self._loaded()
+        changed = {name for name, mtime in current.items() if self._mtimes.get(name, mtime) != mtime}
+        if changed:
+            imports = {}
+            for name in current:
+                with open(sys.modules[name].__file__) as f:
+                    imports[name] = set(self.helper_import.findall(f.read()))
+            order = reload_order(changed, imports)
+            for name in order:
+                importlib.reload(sys.modules[name])
+            if "figl_calib" in order:
+                # The reloaded module starts with a new, empty master cache.
+                self.figl_calib = sys.modules["figl_calib"]
+                self.figl_calib.MASTERS.resize(self.master_cache)
+            current = self._loaded()
+        self._mtimes = current
+
+    def _module(self, module_name):
+        """The imported recipe module."""
+        module = importlib.import_module(module_name)
+        # A recipe added since start-up, and the helpers it imported.
+        self._mtimes = {**self._loaded(), **self._mtimes}
+        return module
+
+    def run(self, job):
+        """Run one job and return its products as [(file, tag)]."""
+        self._reload_changed()
+        if job["recipe"] not in self.recipes:
+            # A new recipe file may have been added since start-up.
+            self.recipes = self.find_recipes(self.recipes_dir)
+            if job["recipe"] not in self.recipes:
+                raise ValueError(f"Unknown recipe {job['recipe']!r}.")
+        module_name, class_name, _ = self.recipes[job["recipe"]]
+        recipe = getattr(self._module(module_name), class_name)()
+        settings = {}
+        for name, value in job.get("parameters", {}).items():
+            try:
+                settings[name] = _coerce(recipe.parameters[name], value)
+            except KeyError:
+                # Left to the recipe, which warns about unknown parameters.
+                settings[name] = value
+        frameset = self.cpl_ui.FrameSet([self.cpl_ui.Frame(file=file, tag=tag) for file, tag in job["inputs"]])
+        workdir = os.path.abspath(job.get("workdir") or os.getcwd())
+        os.makedirs(workdir, exist_ok=True)
+        cwd = os.getcwd()
+        os.chdir(workdir)
+        try:
+            products = recipe.run(frameset, settings)
+        finally:
+            os.chdir(cwd)
+        return [(os.path.join(workdir, frame.file), frame.tag) for frame in products]
+
+    def handle(self, connection):
+        with connection, connection.makefile("rwb") as stream:
+            line = stream.readline()
+            if not line:
+                return
+            start = time.perf_counter()
+            try:
+                reply = {"products": self.run(json.loads(line))}
+            except Exception as err:
+                reply = {"error": f"{type(err).__name__}: {err}", "traceback": traceback.format_exc()}
+            reply["seconds"] = time.perf_counter() - start
+            masters = self.figl_calib.MASTERS
+            reply["masters"] = {"hits": masters.hits, "misses": masters.misses}
+            stream.write(json.dumps(reply).encode() + b"\n")
+
+    def serve(self, path):
+        if os.path.exists(path):
+            os.unlink(path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(path)
+        server.listen()
+        print(f"Serving {len(self.recipes)} recipes on {path}.", flush=True)
+        try:
+            while True:
+                connection, _ = server.accept()
+                self.handle(connection)
+        finally:
+            server.close()
+            os.unlink(path)
+
+
+def submit(job, path=None):
+    """Send ``job`` to the worker listening on ``path`` and return its reply."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(path or default_socket())
+        with connection.makefile("rwb") as stream:
+            stream.write(json.dumps(job).encode() + b"\n")
+            stream.flush()
+            line = stream.readline()
+    if not line:
+        raise ConnectionError("The recipe worker closed the connection without a reply.")
+    return json.loads(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run figl recipes sent over a Unix socket.")
+    parser.add_argument("--socket", default=default_socket(), help="Path of the Unix socket")
+    parser.add_argument("--cache", type=float, default=DEFAULT_MASTER_CACHE,
+                        help="Memory for master calibrations kept between jobs in MB, 0 to disable")
+    args = parser.parse_args()
+    try:
+        RecipeWorker(master_cache=args.cache).serve(args.socket)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,536 @@
+"""
+Run the figl workflow locally, without the EDPS server.
+
+The task graph is read from workflows/figl/figl_wkf.py: the workflow file is
+executed against a small stand-in for the ``edps`` module that records the
+classification rules, data sources and tasks instead of registering them.
+Raw files are classified with the same rules, grouped into jobs, and the jobs
+are run in parallel as soon as the jobs they depend on are done, each recipe
+in its own process and working directory. Independent branches, such as
+``science`` and ``landold`` or the tasks of different nights, run
+concurrently.
+
+Calibrations are grouped by observing night (the NIGHT keyword, see
+workflows/figl/figl_rules.py), so one job reduces a whole night's bias, dark
+or flat frames. Frames without the keyword get it from DATE-OBS when they
+are classified, so the raw headers are never edited for it. The number of jobs per task is reported before running.
+
+Like make, a job is skipped when its inputs (path, size and modification
+time, or the content of master calibrations), its parameters and the source
+of its recipe and of the figl_* modules the recipe imports are unchanged
+since its last successful run. The state is kept in ``figl_state.json`` in the working directory.
+
+Example:
+    python run_workflow.py /data/night /data/reduced --workers 4
+"""
+import argparse
+import concurrent.futures
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import sys
+import types
+
+from collections import defaultdict, namedtuple
+
+from astropy.io import fits
+from astropy.time import Time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+RECIPES_DIR = os.path.abspath(os.path.join(ROOT, "recipes"))
+WORKFLOW_DIR = os.path.abspath(os.path.join(ROOT, "workflows", "figl"))
+STATE_FILE = "figl_state.json"
+
+sys.path.insert(0, RECIPES_DIR)
+
+from figl_cache import ProductCache  # noqa: E402
+from header_index import NIGHT_BOUNDARY, NIGHT_KEYWORD, observing_night  # noqa: E402
+
+InputFrame = namedtuple("InputFrame", "file tag")
+Setting = namedtuple("Setting", "name value")
+
+# Imports of the shared helper modules in the recipe sources.
+HELPER_IMPORT = re.compile(r"^\s*(?:from|import)\s+(figl_\w+)", re.MULTILINE)
+
+
+# --- Recording stand-in for the edps workflow API --------------------------
+
+class ClassificationRule:
+    def __init__(self, tag, keywords=None):
+        self.tag = tag
+        # Either required keyword values or a function of the header.
+        self.keywords = keywords if callable(keywords) else dict(keywords or {})
+
+    def matches(self, header):
+        if callable(self.keywords):
+            return self.keywords(header)
+        return all(str(header.get(key, "")).strip() == str(value) for key, value in self.keywords.items())
+
+
+class DataSource:
+    def __init__(self, name):
+        self.name = name
+        self.rules = []
+        self.grouping_keywords = []
+        self.match_keywords = []
+
+
+class Task:
+    def __init__(self, name):
+        self.name = name
+        self.recipe = None
+        self.main_input = None
+        self.associated_inputs = []
+        self.output_filter = []
+
+    def dependencies(self):
+        return [node for node in [self.main_input] + self.associated_inputs if isinstance(node, Task)]
+
+    def source(self):
+        """The raw data source at the root of the main input chain."""
+        node = self.main_input
+        while isinstance(node, Task):
+            node = node.main_input
+        return node
+
+
+class _Builder:
+    def __init__(self, target):
+        self._target = target
+
+    def build(self):
+        return self._target
+
+
+class DataSourceBuilder(_Builder):
+    def with_classification_rule(self, rule):
+        self._target.rules.append(rule)
+        return self
+
+    def with_grouping_keywords(self, keywords):
+        self._target.grouping_keywords = list(keywords)
+        return self
+
+    def with_match_keywords(self, keywords):
+        self._target.match_keywords = list(keywords)
+        return self
+
+
+class TaskBuilder(_Builder):
+    def with_recipe(self, recipe):
+        self._target.recipe = recipe
+        return self
+
+    def with_main_input(self, node):
+        self._target.main_input = node
+        return self
+
+    def with_associated_input(self, node, *args, **kwargs):
+        self._target.associated_inputs.append(node)
+        return self
+
+    def with_output_filter(self, *rules):
+        self._target.output_filter.extend(rule.tag for rule in rules)
+        return self
+
+
+def load_workflow(path):
+    """Execute a workflow file against the recording edps module and return its tasks."""
+    recorder = types.ModuleType("edps")
+    recorder.classification_rule = ClassificationRule
+    recorder.data_source = lambda name: DataSourceBuilder(DataSource(name))
+    recorder.task = lambda name: TaskBuilder(Task(name))
+
+    # The workflow directory is a package, so the workflow can import its rules module.
+    directory = os.path.dirname(os.path.abspath(path))
+    package = os.path.basename(directory)
+    saved = sys.modules.get("edps")
+    sys.modules["edps"] = recorder
+    sys.path.insert(0, os.path.dirname(directory))
+    try:
+        namespace = {"__name__": f"{package}.workflow", "__package__": package, "__file__": path}
+        with open(path) as f:
+            exec(compile(f.read(), path, "exec"), namespace)
+    finally:
+        sys.path.remove(os.path.dirname(directory))
+        if saved is None:
+            del sys.modules["edps"]
+        else:
+            sys.modules["edps"] = saved
+    return [value for value in namespace.values() if isinstance(value, Task)]
+
+
+def ordered_tasks(tasks):
+    """Tasks sorted so every task comes after the tasks it depends on."""
+    done, ordered = set(), []
+
+    def visit(task):
+        if task.name in done:
+            return
+        for dependency in task.dependencies():
+            visit(dependency)
+        done.add(task.name)
+        ordered.append(task)
+
+    for task in tasks:
+        visit(task)
+    return ordered
+
+
+# --- Classification and jobs ------------------------------------------------
+
+def keyword_value(header, keyword):
+    value = header.get(keyword)
+    # The LFOA frames carry full timestamps, so DATE-OBS groups by date.
+    if keyword == "DATE-OBS" and value:
+        return str(value)[:10]
+    return value
+
+
+class Group:
+    """Raw frames of one data source that are reduced together."""
+
+    def __init__(self, source, frames, header):
+        self.source = source
+        self.frames = frames
+        self.header = header
+
+    def keywords(self, names):
+        return tuple(keyword_value(self.header, name) for name in names)
+
+
+def read_headers(files, workers=8):
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        return dict(zip(files, pool.map(fits.getheader, files)))
+
+
+def add_nights(headers, boundary=NIGHT_BOUNDARY):
+    """Give every header without one the observing night of its DATE-OBS."""
+    for header in headers.values():
+        if NIGHT_KEYWORD not in header:
+            night = observing_night(header.get("DATE-OBS"), boundary)
+            if night:
+                header[NIGHT_KEYWORD] = night
+    return headers
+
+
+def classify(headers, sources):
+    """Group the raw files of every data source.
+
+    Frames are grouped by the grouping keywords of their source. A source
+    without grouping keywords is grouped by its match keywords instead.
+    A frame that a classification rule rejects with a ValueError (e.g. a
+    calibration without NIGHT) is reported and left out of every source.
+    """
+    groups = defaultdict(list)
+    rejected = set()
+    for source in sources:
+        keys = source.grouping_keywords or source.match_keywords
+        by_key = defaultdict(list)
+        for file in sorted(headers):
+            if file in rejected:
+                continue
+            header = headers[file]
+            for rule in source.rules:
+                try:
+                    matches = rule.matches(header)
+                except ValueError as err:
+                    print(f"Warning: skipping {os.path.basename(file)}: {err}")
+                    rejected.add(file)
+                    break
+                if matches:
+                    by_key[tuple(keyword_value(header, key) for key in keys)].append(InputFrame(file, rule.tag))
+                    break
+        for frames in by_key.values():
+            groups[source.name].append(Group(source, frames, headers[frames[0].file]))
+    return groups
+
+
+class Job:
+    def __init__(self, task, group, upstream=None):
+        self.task = task
+        self.group = group
+        self.upstream = upstream
+        self.associated = []
+        slug = "_".join(str(value) for value in group.keywords(
+            group.source.grouping_keywords or group.source.match_keywords)) or "all"
+        self.name = f"{task.name}/{re.sub(r'[^A-Za-z0-9_.-]+', '-', slug)}"
+        self.products = None
+
+    def dependencies(self):
+        return ([self.upstream] if self.upstream else []) + [job for job in self.associated if isinstance(job, Job)]
+
+    def inputs(self):
+        frames = []
+        if self.upstream is None:
+            frames.extend(self.group.frames)
+        else:
+            frames.extend(self.upstream.output_frames())
+        for associated in self.associated:
+            frames.extend(associated.output_frames() if isinstance(associated, Job) else associated.frames)
+        return frames
+
+    def output_frames(self):
+        if self.task.output_filter:
+            return [frame for frame in self.products if frame.tag in self.task.output_filter]
+        return list(self.products)
+
+
+def _timestamp(header):
+    try:
+        return Time(header["DATE-OBS"]).mjd
+    except (KeyError, ValueError):
+        return 0.0
+
+
+def job_group(job):
+    return job.group if isinstance(job, Job) else job
+
+
+def _closest(candidates, group):
+    """The candidate job or group observed closest in time to ``group``."""
+    mjd = _timestamp(group.header)
+    return min(candidates, key=lambda candidate: abs(_timestamp(job_group(candidate).header) - mjd))
+
+
+def plan(tasks, groups):
+    """Jobs of every task in dependency order."""
+    jobs = defaultdict(list)
+    for task in ordered_tasks(tasks):
+        if isinstance(task.main_input, Task):
+            mains = [(upstream.group, upstream) for upstream in jobs[task.main_input.name]]
+        else:
+            mains = [(group, None) for group in groups[task.main_input.name]]
+
+        for group, upstream in mains:
+            job = Job(task, group, upstream)
+            for node in task.associated_inputs:
+                if isinstance(node, Task):
+                    candidates, source = jobs[node.name], node.source()
+                else:
+                    candidates, source = groups[node.name], node
+                matching = [
+                    candidate for candidate in candidates
+                    if job_group(candidate).keywords(source.match_keywords) == group.keywords(source.match_keywords)
+                ]
+                if not matching and candidates:
+                    print(f"Warning: no {node.name} input matches {source.match_keywords} of {job.name}, "
+                          f"using the closest in time.")
+                    matching = candidates
+                if not matching:
+                    print(f"Warning: {job.name} has no {node.name} input, skipping it.")
+                    break
+                job.associated.append(_closest(matching, group))
+            else:
+                jobs[task.name].append(job)
+    return [job for task in ordered_tasks(tasks) for job in jobs[task.name]]
+
+
+# --- Running recipes --------------------------------------------------------
+
+def job_report(jobs):
+    """Lines with the number of jobs of every task and the raw frames they reduce."""
+    by_task = defaultdict(list)
+    for job in jobs:
+        by_task[job.task.name].append(job)
+    lines = []
+    for name, task_jobs in by_task.items():
+        frames = sum(len(job.group.frames) for job in task_jobs)
+        lines.append(f"{name}: {len(task_jobs)} job{'s' if len(task_jobs) != 1 else ''}, "
+                     f"{frames} frames, {frames / len(task_jobs):.1f} per job")
+    lines.append(f"total: {len(jobs)} jobs")
+    return lines
+
+
+def find_recipes(directory=RECIPES_DIR):
+    """Map recipe names to (module, class, version) by scanning the recipe sources."""
+    recipes = {}
+    pattern = re.compile(
+        r"class (\w+)\(cpl\.ui\.PyRecipe\):\s+_name = \"([^\"]+)\"\s+_version = \"([^\"]+)\"")
+    for filename in sorted(os.listdir(directory)):
+        if filename.endswith(".py"):
+            with open(os.path.join(directory, filename)) as f:
+                for class_name, name, version in pattern.findall(f.read()):
+                    recipes[name] = (filename[:-3], class_name, version)
+    return recipes
+
+
+def recipe_sources(module_name, directory=RECIPES_DIR):
+    """Paths of the source of a recipe module and of every figl_* module it imports, directly or not."""
+    found, stack = [], [module_name]
+    while stack:
+        name = stack.pop()
+        path = os.path.join(directory, name + ".py")
+        if path in found or not os.path.exists(path):
+            continue
+        found.append(path)
+        with open(path) as f:
+            stack.extend(HELPER_IMPORT.findall(f.read()))
+    return sorted(found)
+
+
+def _run_recipe(module_name, class_name, inputs, settings, workdir):
+    """Worker process: run one recipe inside ``workdir`` and return its products."""
+    import importlib
+    import cpl.ui
+
+    sys.path.insert(0, RECIPES_DIR)
+    recipe = getattr(importlib.import_module(module_name), class_name)()
+    # The recipe runs inside workdir, so relative input paths would no longer resolve.
+    frameset = cpl.ui.FrameSet([cpl.ui.Frame(file=os.path.abspath(frame.file), tag=frame.tag) for frame in inputs])
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)
+    products = recipe.run(frameset, settings)
+    return [(os.path.join(workdir, frame.file), frame.tag) for frame in products]
+
+
+def job_key(job, recipes, settings, directory=RECIPES_DIR):
+    module_name, class_name, version = recipes[job.task.recipe]
+    sha = hashlib.sha256()
+    for path in recipe_sources(module_name, directory):
+        with open(path, "rb") as f:
+            sha.update(f.read())
+    source = sha.hexdigest()
+    parameters = [Setting(name, value) for name, value in settings.items()]
+    return ProductCache.key(job.task.recipe, f"{version}:{source}", job.inputs(), parameters)
+
+
+def load_parameters(path):
+    """Recipe parameters per task from an EDPS parameter file."""
+    if not path or not os.path.exists(path):
+        return {}
+    try:
+        import yaml
+    except ImportError:
+        print(f"Warning: PyYAML is not installed, ignoring {path}.")
+        return {}
+    with open(path) as f:
+        parameter_set = yaml.safe_load(f).get("parameter_set", {})
+    return parameter_set.get("recipe_parameters") or {}
+
+
+def load_state(workdir):
+    path = os.path.join(workdir, STATE_FILE)
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return {}
+
+
+def save_state(workdir, state):
+    path = os.path.join(workdir, STATE_FILE)
+    with open(path + ".tmp", "w") as f:
+        json.dump(state, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def run(jobs, workdir, parameters, workers=4, force=False):
+    """Run ``jobs`` with up to ``workers`` recipes at a time, skipping unchanged jobs."""
+    recipes = find_recipes()
+    state = load_state(workdir)
+    pending = list(jobs)
+    running = {}
+    counts = {"run": 0, "skipped": 0, "failed": 0}
+    failed = set()
+
+    context = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+        while pending or running:
+            for job in list(pending):
+                dependencies = job.dependencies()
+                if any(dependency.name in failed for dependency in dependencies):
+                    print(f"Not running {job.name}: an input job failed.")
+                    failed.add(job.name)
+                    pending.remove(job)
+                    continue
+                if not all(dependency.products is not None for dependency in dependencies):
+                    continue
+                pending.remove(job)
+                settings = parameters.get(job.task.name, {})
+                key = job_key(job, recipes, settings)
+                previous = state.get(job.name)
+                if (not force and previous and previous["key"] == key
+                        and all(os.path.exists(file) for file, _ in previous["products"])):
+                    job.products = [InputFrame(*product) for product in previous["products"]]
+                    counts["skipped"] += 1
+                    print(f"Up to date: {job.name}")
+                    continue
+                module_name, class_name, _ = recipes[job.task.recipe]
+                print(f"Running {job.name} ({job.task.recipe}, {len(job.inputs())} frames)")
+                future = pool.submit(_run_recipe, module_name, class_name, job.inputs(), settings,
+                                     os.path.abspath(os.path.join(workdir, job.name)))
+                running[future] = (job, key)
+
+            if not running:
+                if pending:
+                    print(f"Not running {', '.join(job.name for job in pending)}: inputs missing.")
+                    counts["failed"] += len(pending)
+                break
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                job, key = running.pop(future)
+                try:
+                    job.products = [InputFrame(*product) for product in future.result()]
+                except Exception as err:
+                    print(f"Failed: {job.name}: {err}")
+                    failed.add(job.name)
+                    counts["failed"] += 1
+                    continue
+                counts["run"] += 1
+                state[job.name] = {"key": key, "products": [list(product) for product in job.products]}
+                save_state(workdir, state)
+                print(f"Done: {job.name} -> {', '.join(os.path.basename(f) for f, _ in job.products)}")
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the figl workflow locally with parallel, incremental tasks.")
+    parser.add_argument("raw_dir", help="Directory containing the raw FITS files")
+    parser.add_argument("workdir", help="Directory for the products and the run state")
+    parser.add_argument("--workflow", default=os.path.join(WORKFLOW_DIR, "figl_wkf.py"), help="Workflow file")
+    parser.add_argument("--parameters", default=os.path.join(WORKFLOW_DIR, "figl_parameters.yaml"),
+                        help="EDPS parameter file with the recipe parameters")
+    parser.add_argument("--workers", type=int, default=4, help="Number of recipes run at the same time")
+    parser.add_argument("--force", action="store_true", help="Rerun every job, even when it is up to date")
+    parser.add_argument("--dry-run", action="store_true", help="Only list the jobs")
+    parser.add_argument("--index", help="SQLite header index (see header_index.py) to classify from instead of reading every header")
+    parser.add_argument("--night-boundary", type=float, default=NIGHT_BOUNDARY,
+                        help="Hour (UT) at which one observing night ends and the next begins")
+    args = parser.parse_args()
+    raw_dir = os.path.abspath(args.raw_dir)
+
+    tasks = load_workflow(args.workflow)
+    sources = {task.source().name: task.source() for task in tasks}
+    for task in tasks:
+        for node in task.associated_inputs:
+            if isinstance(node, DataSource):
+                sources[node.name] = node
+    if args.index:
+        from header_index import HeaderIndex
+
+        index = HeaderIndex(args.index, args.night_boundary)
+        headers = index.headers(raw_dir)
+        index.close()
+    else:
+        files = sorted(
+            os.path.join(raw_dir, filename)
+            for filename in os.listdir(raw_dir)
+            if filename.endswith((".fits", ".fit", ".fts"))
+        )
+        headers = add_nights(read_headers(files), args.night_boundary)
+    groups = classify(headers, sources.values())
+    jobs = plan(tasks, groups)
+    for line in job_report(jobs):
+        print(line)
+
+    if args.dry_run:
+        for job in jobs:
+            depends = ", ".join(dependency.name for dependency in job.dependencies())
+            print(f"{job.name}: {job.task.recipe}" + (f" after {depends}" if depends else ""))
+    else:
+        os.makedirs(args.workdir, exist_ok=True)
+        counts = run(jobs, args.workdir, load_parameters(args.parameters), args.workers, args.force)
+        print(", ".join(f"{count} {result}" for result, count in counts.items()))
+        sys.exit(1 if counts["failed"] else 0)
@@ -1,7 +1,12 @@
-import sys
+import argparse
+from concurrent.futures import ThreadPoolExecutor
 from astropy.io import fits
+import numpy as np
 import os
 
+# FITS files are written in blocks of this many bytes.
+BLOCK_SIZE = 2880
+
 def separate_data_cube(input_file):
     # Open the data cube FITS file
     with fits.open(input_file) as hdul:
@@ -22,11 +27,111 @@ def separate_data_cube(input_file):
         
     print("Separation complete.")
 
+def slice_header(header):
+    """Header of a single plane of the cube, serialised once for all slices."""
+    header = header.copy()
+    header["NAXIS"] = 2
+    header.remove("NAXIS3", ignore_missing=True)
+    # Checksums of the cube do not describe a slice
+    header.remove("CHECKSUM", ignore_missing=True)
+    header.remove("DATASUM", ignore_missing=True)
+    return header.tostring().encode("ascii")
+
+def write_slice(output_file, header_bytes, plane):
+    # The plane is still in its on-disk byte order and integer encoding, so
+    # it can be copied next to the cube header without any conversion.
+    data = plane.tobytes()
+    with open(output_file, "wb") as f:
+        f.write(header_bytes)
+        f.write(data)
+        f.write(b"\0" * (-len(data) % BLOCK_SIZE))
+    return output_file
+
+def parse_slices(spec):
+    """Turn a 1-based slice list like '1-5,8' into a set of 0-based indices."""
+    indices = set()
+    for part in spec.split(","):
+        first, _, last = part.partition("-")
+        indices.update(range(int(first) - 1, int(last or first)))
+    return indices
+
+def separate_data_cube_streaming(input_file, workers=4, combine=None, write=True):
+    """
+    Split a data cube into Flat_N.fits files one plane at a time.
+
+    The cube is memory-mapped, so only the planes being written are read from
+    disk, and the slices are written by a pool of ``workers`` threads. The
+    slice header is serialised once and reused for every file.
+
+    ``combine`` is an optional set of 0-based plane indices that are averaged
+    on the fly into Flat_combined.fits instead of being written on their own.
+    Indices outside the cube raise a ValueError before anything is written.
+    With ``write=False`` no individual slices are written at all.
+    """
+    combine = set(combine or ())
+
+    output_dir = os.path.splitext(input_file)[0]
+    os.makedirs(output_dir, exist_ok=True)
+
+    # Keep the raw integers: BZERO/BSCALE stay in the header of every slice.
+    with fits.open(input_file, memmap=True, do_not_scale_image_data=True) as hdul:
+        cube = hdul[0].data
+        header = hdul[0].header
+        header_bytes = slice_header(header)
+        bscale = header.get("BSCALE", 1.0)
+        bzero = header.get("BZERO", 0.0)
+
+        outside = sorted(i + 1 for i in combine if not 0 <= i < cube.shape[0])
+        if outside:
+            raise ValueError(f"Slices {outside} are outside the cube of {cube.shape[0]} planes.")
+
+        combined = None
+        ncombined = 0
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            pending = []
+            for i in range(cube.shape[0]):
+                if i in combine:
+                    plane = cube[i].astype(np.float64) * bscale + bzero
+                    if combined is None:
+                        combined = plane
+                    else:
+                        combined += plane
+                    ncombined += 1
+                elif write:
+                    output_file = os.path.join(output_dir, f"Flat_{i+1}.fits")
+                    pending.append(pool.submit(write_slice, output_file, header_bytes, cube[i]))
+                # Bound the number of planes waiting to be written
+                while len(pending) > 2 * workers:
+                    print(f"Saved {pending.pop(0).result()}")
+            for future in pending:
+                print(f"Saved {future.result()}")
+
+        if combined is not None:
+            combined /= ncombined
+            combined_header = fits.Header.fromstring(header_bytes.decode("ascii"))
+            for keyword in ("BZERO", "BSCALE", "BLANK"):
+                combined_header.remove(keyword, ignore_missing=True)
+            combined_header.add_history(f"Mean of {ncombined} slices")
+            output_file = os.path.join(output_dir, "Flat_combined.fits")
+            fits.writeto(output_file, combined, combined_header, overwrite=True)
+            print(f"Saved {output_file}")
+
+    print("Separation complete.")
+
 if __name__ == "__main__":
-    # Check if the path to the data cube FITS file is provided
-    if len(sys.argv) != 2:
-        print("Please provide the path to the data cube FITS file as a command-line argument.")
-        print("Example: python separate_data_cube.py /path/to/your/data_cube.fits")
+    parser = argparse.ArgumentParser(description="Split a FITS data cube into one file per slice.")
+    parser.add_argument("input_file", help="Path to the data cube FITS file")
+    parser.add_argument("--stream", action="store_true", help="Read one plane at a time and write the slices in parallel")
+    parser.add_argument("--workers", type=int, default=4, help="Number of slices written concurrently in streaming mode")
+    parser.add_argument("--combine", help="Slices to average into Flat_combined.fits instead of writing them, e.g. '1-10,15'")
+    parser.add_argument("--no-slices", action="store_true", help="Only write the combined file in streaming mode")
+    args = parser.parse_args()
+
+    if args.stream or args.combine:
+        try:
+            combine = parse_slices(args.combine) if args.combine else None
+            separate_data_cube_streaming(args.input_file, args.workers, combine, write=not args.no_slices)
+        except ValueError as err:
+            parser.error(str(err))
     else:
-        input_file = sys.argv[1]
-        separate_data_cube(input_file)
+        separate_data_cube(args.input_file)
@@ -1,8 +1,43 @@
-import sys
 import glob
+import argparse
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 from astropy.io import fits
 import numpy as np
 
+# Keywords describing the integer encoding of the raw data, which no longer
+# applies to the floating point result.
+SCALING_KEYWORDS = ("BZERO", "BSCALE", "BLANK")
+
+def output_header(header):
+    header = header.copy()
+    for keyword in SCALING_KEYWORDS:
+        header.remove(keyword, ignore_missing=True)
+    header.add_history("Bias subtracted")
+    return header
+
+def output_name(dark_file):
+    root, ext = os.path.splitext(dark_file)
+    output_file = root + "_d_subtracted" + ext
+    if os.path.abspath(output_file) == os.path.abspath(dark_file):
+        raise ValueError(f"Output would overwrite the input {dark_file}")
+    return output_file
+
+def physical(raw, header, dtype):
+    """Apply BSCALE/BZERO to the stored values in ``dtype``; BLANK pixels become NaN."""
+    data = raw.astype(dtype)
+    bscale = header.get("BSCALE", 1.0)
+    bzero = header.get("BZERO", 0.0)
+    if bscale != 1.0:
+        data *= dtype(bscale)
+    if bzero != 0.0:
+        data += dtype(bzero)
+    blank = header.get("BLANK")
+    if blank is not None and np.issubdtype(raw.dtype, np.integer):
+        data[raw == blank] = np.nan
+    return data
+
 def subtract_bias(dark_files, bias_file):
     if len(dark_files) == 0:
         print("No dark files provided.")
@@ -12,31 +47,81 @@ def subtract_bias(dark_files, bias_file):
         bias_data = bias_hdul[0].data
 
         for dark_file in dark_files:
-            with fits.open(dark_file) as dark_hdul:
-                dark_data = dark_hdul[0].data
+            with fits.open(dark_file, do_not_scale_image_data=True) as dark_hdul:
+                raw = dark_hdul[0].data
+                dtype = np.result_type(raw.dtype, bias_data.dtype, np.float32).type
+                dark_data = physical(raw, dark_hdul[0].header, dtype)
 
                 # Subtract the bias data from the dark data
                 subtracted_data = dark_data - bias_data
 
-                # Create a new HDU with the subtracted data
-                hdu = fits.PrimaryHDU(subtracted_data)
+                # Create a new HDU with the subtracted data, keeping the original header
+                hdu = fits.PrimaryHDU(subtracted_data, output_header(dark_hdul[0].header))
 
                 # Save the subtracted dark data to a new file
-                output_file = dark_file.replace('.fits', '_d_subtracted.fits')
+                output_file = output_name(dark_file)
                 hdul = fits.HDUList([hdu])
                 hdul.writeto(output_file)
                 print(f"Subtracted dark file saved: {output_file}")
 
+def subtract_one(dark_file, bias_data, dtype, overwrite=False):
+    # Map the raw integers instead of letting astropy scale the whole array,
+    # then apply BSCALE/BZERO and the bias in the target dtype.
+    with fits.open(dark_file, memmap=True, do_not_scale_image_data=True) as dark_hdul:
+        header = dark_hdul[0].header
+        subtracted_data = physical(dark_hdul[0].data, header, dtype)
+        subtracted_data -= bias_data
+
+        output_file = output_name(dark_file)
+        fits.writeto(output_file, subtracted_data, output_header(header), overwrite=overwrite)
+    return output_file
+
+def subtract_bias_batch(dark_files, bias_file, dtype="float32", workers=4, overwrite=False):
+    """
+    Subtract the bias from many dark files at once.
+
+    The darks are memory-mapped, the subtraction is done in ``dtype`` and the
+    files are processed by a pool of ``workers`` threads. Every output keeps
+    the header of its dark file.
+
+    Returns the throughput in frames per second.
+    """
+    if len(dark_files) == 0:
+        print("No dark files provided.")
+        return 0.0
+
+    if np.dtype(dtype).kind != "f":
+        # Integers would truncate the bias and BSCALE/BZERO and cannot hold the NaN of BLANK pixels.
+        raise ValueError(f"Arithmetic type must be floating point, got {dtype}.")
+    dtype = np.dtype(dtype).type
+    bias_data = fits.getdata(bias_file).astype(dtype)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for output_file in pool.map(lambda dark_file: subtract_one(dark_file, bias_data, dtype, overwrite), dark_files):
+            print(f"Subtracted dark file saved: {output_file}")
+    elapsed = time.perf_counter() - start
+
+    fps = len(dark_files) / elapsed if elapsed > 0 else float("inf")
+    size = sum(os.path.getsize(dark_file) for dark_file in dark_files) / 1024 / 1024
+    print(f"Processed {len(dark_files)} frames in {elapsed:.2f} s: {fps:.1f} frames/s, {size / elapsed:.1f} MB/s")
+    return fps
+
 if __name__ == "__main__":
-    # Check if the dark files, bias file are provided
-    if len(sys.argv) < 3:
-        print("Please provide at least one dark file, the bias file.")
-        print("Example: python subtract_dark.py dark_*.fits master_bias.fits")
-    else:
-        dark_pattern = sys.argv[1]
-        bias_file = sys.argv[2]
+    parser = argparse.ArgumentParser(description="Subtract a master bias from dark frames.")
+    parser.add_argument("dark_pattern", help="Glob pattern of the dark files, e.g. 'dark_*.fits'")
+    parser.add_argument("bias_file", help="Master bias file")
+    parser.add_argument("--batch", action="store_true", help="Memory-map and process the files concurrently")
+    parser.add_argument("--dtype", default="float32", choices=("float32", "float64"),
+                        help="Arithmetic and output type in batch mode (default: float32)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Number of files processed concurrently in batch mode")
+    parser.add_argument("--overwrite", action="store_true", help="Replace existing output files in batch mode")
+    args = parser.parse_args()
 
-        # Use glob to expand the dark file pattern into a list of matching files
-        dark_files = glob.glob(dark_pattern)
+    # Use glob to expand the dark file pattern into a list of matching files
+    dark_files = sorted(glob.glob(args.dark_pattern))
 
-        subtract_bias(dark_files, bias_file)
+    if args.batch:
+        subtract_bias_batch(dark_files, args.bias_file, args.dtype, args.workers, args.overwrite)
+    else:
+        subtract_bias(dark_files, args.bias_file)
@@ -0,0 +1,202 @@
+"""
+Reduce science frames while the night is still running.
+
+Watches an incoming directory for new FITS files and classifies each one with
+the classification rules of workflows/figl/figl_wkf.py. Science and Landolt
+frames are calibrated as soon as they are complete on disk, against master
+bias, dark and flat frames that were built beforehand and are held in memory
+as a figl_calib.CalibrationModel. Each calibrated frame is written to the
+output directory and added to a running stack per data source and filter,
+which is updated incrementally and rewritten after every frame, so there is
+never a full re-collapse. Calibration frames are only reported; the masters
+are built with the regular workflow.
+
+Example:
+    python watch_reduce.py /data/incoming /data/quicklook \\
+        --bias MASTER_BIAS.fits --dark MASTER_DARK.fits --flat MASTER_FLAT.fits
+"""
+import argparse
+import os
+import sys
+import time
+import warnings
+
+from collections import deque
+
+import numpy as np
+from astropy.io import fits
+
+from run_workflow import RECIPES_DIR, WORKFLOW_DIR, DataSource, add_nights, load_workflow
+
+sys.path.insert(0, RECIPES_DIR)
+
+from figl_calib import CalibrationModel  # noqa: E402
+from figl_stacking import read_image  # noqa: E402
+
+# Data sources whose frames are calibrated and stacked.
+STREAMED_SOURCES = ("SCIENCE", "STANDARD")
+
+
+def raw_sources(workflow):
+    """The raw data sources of a workflow file, by name."""
+    sources = {}
+    for task in load_workflow(workflow):
+        for node in [task.source()] + task.associated_inputs:
+            if isinstance(node, DataSource):
+                sources[node.name] = node
+    return sources
+
+
+def classify_header(header, sources):
+    """Name of the first data source whose rules match ``header``, or None."""
+    for source in sources.values():
+        if any(rule.matches(header) for rule in source.rules):
+            return source.name
+    return None
+
+
+def is_complete(path):
+    """True once the file holds its full primary header and data unit."""
+    try:
+        with warnings.catch_warnings():
+            # astropy warns about the truncation we are probing for.
+            warnings.simplefilter("ignore")
+            with fits.open(path, memmap=False, lazy_load_hdus=True) as hdul:
+                info = hdul.fileinfo(0)
+                expected = info["datLoc"] + info["datSpan"]
+        return os.path.getsize(path) >= expected
+    except (OSError, ValueError, IndexError, fits.VerifyError):
+        return False
+
+
+class RunningStack:
+    """Mean of the last ``window`` frames (all frames if ``window`` is 0), updated per frame."""
+
+    def __init__(self, window=0):
+        self.window = window
+        self.total = None
+        self.frames = deque()
+        self.count = 0
+        self.exptime = 0.0
+
+    def add(self, image, exptime):
+        if self.total is None:
+            self.total = np.zeros_like(image)
+        self.total += image
+        self.count += 1
+        self.exptime += exptime
+        if self.window:
+            self.frames.append((image, exptime))
+            if len(self.frames) > self.window:
+                oldest, oldest_exptime = self.frames.popleft()
+                self.total -= oldest
+                self.count -= 1
+                self.exptime -= oldest_exptime
+
+    def mean(self):
+        return self.total / self.count
+
+
+def write_fits(path, data, header):
+    """Write atomically, so readers never see a half written product."""
+    tmp = path + ".tmp"
+    fits.PrimaryHDU(data.astype(np.float32), header).writeto(tmp, overwrite=True)
+    os.replace(tmp, path)
+
+
+class Reducer:
+    def __init__(self, model, sources, output_dir, window=0):
+        self.model = model
+        self.sources = sources
+        self.output_dir = output_dir
+        self.window = window
+        self.stacks = {}
+
+    def process(self, path):
+        header = fits.getheader(path)
+        # The classification rules need the observing night of the frame.
+        add_nights({path: header})
+        source = classify_header(header, self.sources)
+        name = os.path.basename(path)
+        if source not in STREAMED_SOURCES:
+            print(f"{name}: {source or 'unclassified'} frame, not reduced in streaming mode")
+            return None
+
+        start = time.perf_counter()
+        exptime = float(header.get("EXPTIME", 0.0))
+        image = read_image(path)
+        self.model.apply(image, 0, image.shape[0], exptime)
+
+        header = header.copy()
+        for keyword in ("BZERO", "BSCALE", "BLANK"):
+            header.remove(keyword, ignore_missing=True)
+        header.add_history("Calibrated with master bias, dark and flat by watch_reduce.py")
+        calibrated = os.path.join(self.output_dir, os.path.splitext(name)[0] + "_cal.fits")
+        write_fits(calibrated, image, header)
+
+        key = (source, str(header.get("FILTER", "")).replace(" ", "_"))
+        stack = self.stacks.setdefault(key, RunningStack(self.window))
+        stack.add(image, exptime)
+        header["NCOMBINE"] = (stack.count, "Frames in the running stack")
+        header["EXPTIME"] = stack.exptime / stack.count
+        write_fits(os.path.join(self.output_dir, f"STACK_{key[0]}_{key[1]}.fits"), stack.mean(), header)
+
+        print(f"{name}: {source} calibrated in {time.perf_counter() - start:.2f} s, "
+              f"stack {key[0]} {key[1]} has {stack.count} frames")
+        return calibrated
+
+
+def arrivals(directory, seen):
+    """Paths of the FITS files in ``directory`` not in ``seen``, oldest first."""
+    new = []
+    for filename in os.listdir(directory):
+        path = os.path.join(directory, filename)
+        if not filename.endswith((".fits", ".fit", ".fts")) or path in seen:
+            continue
+        try:
+            new.append((os.path.getmtime(path), path))
+        except OSError:
+            # Removed or renamed since the directory was listed.
+            continue
+    return [path for _, path in sorted(new)]
+
+
+def watch(directory, reducer, interval=1.0, once=False):
+    """Poll ``directory`` and reduce every new, complete FITS file in arrival order."""
+    seen = set()
+    while True:
+        for path in arrivals(directory, seen):
+            if not is_complete(path):
+                # Still being written, try again on the next poll.
+                continue
+            seen.add(path)
+            try:
+                reducer.process(path)
+            except Exception as err:
+                print(f"{os.path.basename(path)}: failed: {err}")
+        if once:
+            return
+        time.sleep(interval)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Calibrate and stack science frames as they arrive.")
+    parser.add_argument("incoming", help="Directory the camera writes the raw frames to")
+    parser.add_argument("output", help="Directory for the calibrated frames and running stacks")
+    parser.add_argument("--bias", required=True, help="Master bias")
+    parser.add_argument("--dark", required=True, help="Master dark (dark rate per second)")
+    parser.add_argument("--flat", required=True, help="Master flat")
+    parser.add_argument("--workflow", default=os.path.join(WORKFLOW_DIR, "figl_wkf.py"), help="Workflow file with the classification rules")
+    parser.add_argument("--window", type=int, default=0, help="Number of latest frames in the running stack, 0 for all")
+    parser.add_argument("--interval", type=float, default=1.0, help="Seconds between polls of the incoming directory")
+    parser.add_argument("--once", action="store_true", help="Reduce the frames present now and exit")
+    args = parser.parse_args()
+
+    os.makedirs(args.output, exist_ok=True)
+    model = CalibrationModel(read_image(args.bias), read_image(args.dark), read_image(args.flat))
+    reducer = Reducer(model, raw_sources(args.workflow), args.output, args.window)
+    print(f"Watching {args.incoming} ...")
+    try:
+        watch(args.incoming, reducer, args.interval, args.once)
+    except KeyboardInterrupt:
+        pass
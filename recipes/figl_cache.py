@@ -0,0 +1,224 @@
+"""On-disk cache for the master calibration products.
+
+A product is stored under a key that hashes the input frames, the recipe
+parameters that change the result and the recipe name and version. Raw
+frames are fingerprinted by path, tag, size and mtime; master calibrations
+(tags starting with ``MASTER_``) by the SHA-256 of their content, so a
+master fetched from the cache again, with a new mtime, still gives the same
+key to the products built from it. When a recipe is rerun on the same
+inputs the cached product is copied into the working directory instead of
+being rebuilt. The copy keeps the QC keywords of the run that built it, and
+its stage sidecar is restored next to it when one was stored.
+
+Each product ``<key>.fits`` has a ``<key>.json`` record of its last use; the
+least recently used products are evicted once the cache grows beyond its
+size limit.
+
+The cache can be emptied from the command line::
+
+    python figl_cache.py /path/to/cache --clear
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from typing import Iterable, Optional, Tuple
+
+# Size limit of the cache in MB, used when a recipe does not set one.
+DEFAULT_CACHE_SIZE = 4096
+
+# Parameters that only change how a product is computed, not its content.
+IGNORED_PARAMETERS = (".cache.", ".stacking.memory", ".stacking.histogram", ".workers", ".prefetch", ".instrument")
+
+# Tags of input frames fingerprinted by their content instead of their mtime.
+CONTENT_TAG_PREFIX = "MASTER_"
+
+# Suffix of the stage sidecar written next to a product by figl_instrument.
+SIDECAR_SUFFIX = ".stages.json"
+
+# Content hashes of files already read, by (path, size, mtime).
+_CONTENT_HASHES = {}
+
+
+def _parameter_is_ignored(name: str) -> bool:
+    return any(part in name for part in IGNORED_PARAMETERS)
+
+
+def content_hash(file: str) -> str:
+    """SHA-256 of the content of ``file``, remembered while the file is unchanged."""
+    stat = os.stat(file)
+    fingerprint = (os.path.realpath(file), stat.st_size, stat.st_mtime_ns)
+    digest = _CONTENT_HASHES.get(fingerprint)
+    if digest is None:
+        sha = hashlib.sha256()
+        with open(file, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                sha.update(block)
+        digest = _CONTENT_HASHES[fingerprint] = sha.hexdigest()
+    return digest
+
+
+def _sidecar(product_file: str) -> str:
+    return os.path.splitext(product_file)[0] + SIDECAR_SUFFIX
+
+
+def _copy(source: str, destination: str):
+    """Copy ``source`` to ``destination`` through a temporary file, so readers never see half a file."""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(destination)), suffix=".tmp")
+    os.close(fd)
+    try:
+        shutil.copyfile(source, tmp)
+        os.replace(tmp, destination)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+class ProductCache:
+    """A directory of products named after their cache key."""
+
+    def __init__(self, root: str, max_size: float = DEFAULT_CACHE_SIZE):
+        self.root = root
+        self.max_size = max_size
+        os.makedirs(self.root, exist_ok=True)
+
+    @classmethod
+    def from_parameters(cls, parameters, context: str) -> Optional["ProductCache"]:
+        """Build the cache configured by the ``<context>.cache.*`` recipe parameters.
+
+        Returns None when ``<context>.cache.dir`` is empty, i.e. caching is off.
+        """
+        root = parameters[f"{context}.cache.dir"].value
+        if not root:
+            return None
+        return cls(root, parameters[f"{context}.cache.size"].value)
+
+    @staticmethod
+    def key(recipe: str, version: str, frames: Iterable, parameters: Iterable) -> str:
+        """Hash the inputs of a recipe run into a cache key.
+
+        ``frames`` are ``cpl.ui.Frame`` objects (anything with ``file`` and
+        ``tag``), ``parameters`` are recipe parameters (``name`` and ``value``).
+        """
+        inputs = []
+        for frame in frames:
+            if frame.tag.startswith(CONTENT_TAG_PREFIX):
+                inputs.append(("", frame.tag, content_hash(frame.file), 0))
+            else:
+                stat = os.stat(frame.file)
+                inputs.append((os.path.realpath(frame.file), frame.tag, stat.st_size, stat.st_mtime_ns))
+        settings = sorted(
+            (parameter.name, parameter.value)
+            for parameter in parameters
+            if not _parameter_is_ignored(parameter.name)
+        )
+        payload = json.dumps(
+            {"recipe": recipe, "version": version, "frames": sorted(inputs), "parameters": settings},
+            default=str,
+        )
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, f"{key}.fits")
+
+    def _record(self, path: str) -> str:
+        return os.path.splitext(path)[0] + ".json"
+
+    def _touch(self, path: str):
+        """Record the use of the product at ``path`` for the LRU eviction."""
+        with open(self._record(path), "w") as record:
+            json.dump({"used": time.time()}, record)
+
+    def _last_use(self, path: str) -> float:
+        try:
+            with open(self._record(path)) as record:
+                return float(json.load(record)["used"])
+        except (OSError, ValueError, KeyError):
+            # Products without a record (e.g. from an older cache) are evicted first.
+            return 0.0
+
+    def fetch(self, key: str, output_file: str) -> bool:
+        """Copy the cached product for ``key`` to ``output_file``, with its stage sidecar.
+
+        The product is copied rather than linked, so editing it never changes
+        the cache. Returns False on a cache miss.
+        """
+        path = self._path(key)
+        if not os.path.exists(path):
+            return False
+        try:
+            _copy(path, output_file)
+        except FileNotFoundError:
+            # Evicted by another recipe meanwhile.
+            return False
+        if os.path.exists(_sidecar(path)):
+            _copy(_sidecar(path), _sidecar(output_file))
+        self._touch(path)
+        return True
+
+    def store(self, key: str, product_file: str):
+        """Add ``product_file`` and its stage sidecar to the cache under ``key`` and evict old products."""
+        path = self._path(key)
+        _copy(product_file, path)
+        if os.path.exists(_sidecar(product_file)):
+            _copy(_sidecar(product_file), _sidecar(path))
+        elif os.path.exists(_sidecar(path)):
+            os.remove(_sidecar(path))
+        self._touch(path)
+        self.evict()
+
+    def entries(self) -> Iterable[Tuple[str, int, float]]:
+        """Cached products as (path, size, last use) tuples, least recently used first."""
+        entries = []
+        for name in os.listdir(self.root):
+            if name.endswith(".fits"):
+                path = os.path.join(self.root, name)
+                try:
+                    size = os.stat(path).st_size
+                except FileNotFoundError:
+                    continue
+                entries.append((path, size, self._last_use(path)))
+        return sorted(entries, key=lambda entry: entry[2])
+
+    def _remove(self, path: str):
+        for file in (path, self._record(path), _sidecar(path)):
+            if os.path.exists(file):
+                os.remove(file)
+
+    def evict(self):
+        """Remove least recently used products until the cache fits its size limit."""
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        limit = self.max_size * 1024 * 1024
+        for path, size, _ in entries:
+            if total <= limit:
+                break
+            self._remove(path)
+            total -= size
+
+    def invalidate(self, key: Optional[str] = None):
+        """Drop the product stored under ``key``, or every product if no key is given."""
+        if key is not None:
+            self._remove(self._path(key))
+            return
+        for path, _, _ in self.entries():
+            self._remove(path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect or clear a figl product cache.")
+    parser.add_argument("root", help="Cache directory")
+    parser.add_argument("--clear", action="store_true", help="Remove every cached product")
+    args = parser.parse_args()
+
+    cache = ProductCache(args.root)
+    if args.clear:
+        cache.invalidate()
+    entries = cache.entries()
+    for path, size, _ in entries:
+        print(f"{size / 1024 / 1024:10.1f} MB  {os.path.basename(path)}")
+    print(f"{len(entries)} products, {sum(size for _, size, _ in entries) / 1024 / 1024:.1f} MB")
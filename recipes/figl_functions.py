@@ -1,23 +1,57 @@
-import re
+"""Header access shared by the figl recipes.
 
-from cpl import core, ui, dfs, drs
+The primary header of a frame is parsed once and reduced to the keywords the
+pipeline works with. Results are memoized per file (path, size and mtime) so
+the recipes can ask for them as often as they like during a run.
+"""
+import functools
+import os
 
-pattern = r'value\s+:\s+(\d+)'
+from typing import NamedTuple, Optional
 
-def obj(file):
-    obj_typ_list = core.PropertyList.load_regexp(file, 0, "OBJTYP", False)
-    obj_typ = obj_typ_list.dump(show=False)
-    match_obj = re.search(pattern, obj_type).group(1) # type: ignore
-    return match_obj
+import cpl.core
 
-def exp(file):
-    exp_time_list = core.PropertyList.load_regexp(file, 0, "EXPTIME", False)
-    exp_time = core.PropertyList.dump(exp_time_list, show=False)
-    match_exp = float(re.search(pattern, exp_time).group(1)) # type: ignore
-    return match_exp
+# Keywords read from the primary header of every frame.
+KEYWORDS = ("EXPTIME", "OBJTYP", "FILTER", "ZEROPOINT")
 
-def filter_match(file):
-    filter_typ_list = core.PropertyList.load.regexp(file, 0, "FILTER", False)
-    filter_typ = filter_typ_list.dump(show=False)
-    match_filter = re.search(pattern, filter_typ).group(1) # type: ignore
-    return match_filter
\ No newline at end of file
+
+class FrameHeader(NamedTuple):
+    exptime: Optional[float]
+    objtyp: Optional[str]
+    filter: Optional[str]
+    zeropoint: Optional[float]
+
+
+def _as_float(value) -> Optional[float]:
+    return None if value is None else float(value)
+
+
+def _as_str(value) -> Optional[str]:
+    return None if value is None else str(value).strip()
+
+
+@functools.lru_cache(maxsize=4096)
+def _read_header(path: str, mtime: int, size: int) -> FrameHeader:
+    plist = cpl.core.PropertyList.load_regexp(path, 0, f"^({'|'.join(KEYWORDS)})$", False)
+    values = {prop.name: prop.value for prop in plist}
+    return FrameHeader(
+        exptime=_as_float(values.get("EXPTIME")),
+        objtyp=_as_str(values.get("OBJTYP")),
+        filter=_as_str(values.get("FILTER")),
+        zeropoint=_as_float(values.get("ZEROPOINT")),
+    )
+
+
+def read_header(file: str) -> FrameHeader:
+    """Return the pipeline keywords of the primary header of ``file``.
+
+    Missing keywords are None. The header is only parsed again when the file
+    has changed on disk.
+    """
+    stat = os.stat(file)
+    return _read_header(os.path.abspath(file), stat.st_mtime_ns, stat.st_size)
+
+
+def clear_header_cache():
+    """Forget all memoized headers."""
+    _read_header.cache_clear()
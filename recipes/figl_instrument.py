@@ -0,0 +1,126 @@
+"""Stage timing and memory instrumentation for the figl recipes.
+
+A recipe wraps its work in named stages::
+
+    stages = Stages.from_parameters(self.parameters, "mbias")
+    with stages.stage("load"):
+        ...
+
+and writes the totals as ``ESO QC TIME <STAGE>`` (seconds) and
+``ESO QC MEM <STAGE>`` (MB) keywords and into a JSON sidecar next to the
+product. Stage times are exclusive: time spent in a stage nested inside
+another one on the same thread is only counted for the inner stage. A stage
+entered many times (e.g. once per frame band) accumulates its time, and its
+memory figure is the largest growth of the resident set over one entry.
+
+When disabled, ``stage`` returns a shared no-op context manager and ``wrap``
+returns the function unchanged, so the instrumentation costs nothing.
+"""
+import contextlib
+import json
+import os
+import resource
+import threading
+import time
+
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+_DISABLED = contextlib.nullcontext()
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def resident_memory() -> int:
+    """Current resident set size of this process in bytes."""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * _PAGE_SIZE
+    except OSError:
+        # Without procfs only the peak is available (kilobytes on Linux).
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Stages:
+    """Accumulated duration and memory growth of named recipe stages."""
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.times: Dict[str, float] = {}
+        self.memory: Dict[str, int] = {}
+        self.calls: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @classmethod
+    def from_parameters(cls, parameters, context: str) -> "Stages":
+        """Stages enabled by the ``<context>.instrument`` recipe parameter."""
+        return cls(bool(parameters[f"{context}.instrument"].value))
+
+    def stage(self, name: str):
+        """Context manager timing one entry into stage ``name``."""
+        if not self.enabled:
+            return _DISABLED
+        return self._timed(name)
+
+    def wrap(self, name: str, function: Callable) -> Callable:
+        """``function`` with every call timed as stage ``name``."""
+        if not self.enabled:
+            return function
+
+        def timed(*args, **kwargs):
+            with self._timed(name):
+                return function(*args, **kwargs)
+        return timed
+
+    @contextlib.contextmanager
+    def _timed(self, name: str):
+        nesting = getattr(self._local, "nesting", None)
+        if nesting is None:
+            nesting = self._local.nesting = []
+        # [time spent in nested stages]
+        nesting.append([0.0])
+        rss = resident_memory()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            growth = resident_memory() - rss
+            nested = nesting.pop()[0]
+            if nesting:
+                nesting[-1][0] += elapsed
+            with self._lock:
+                self.times[name] = self.times.get(name, 0.0) + elapsed - nested
+                self.memory[name] = max(self.memory.get(name, 0), growth)
+                self.calls[name] = self.calls.get(name, 0) + 1
+
+    def qc_properties(self) -> List[Tuple[str, Any]]:
+        """(keyword, value) pairs of the stages recorded so far."""
+        properties = []
+        for name, seconds in self.times.items():
+            properties.append((f"ESO QC TIME {name.upper()}", round(seconds, 6)))
+            properties.append((f"ESO QC MEM {name.upper()}", round(self.memory[name] / 2**20, 3)))
+        return properties
+
+    def write_sidecar(self, product_file: str, products: Optional[List[str]] = None, **extra) -> None:
+        """Write the stages to ``<product>.stages.json``, if enabled.
+
+        A recipe with several products lists them in ``products``;
+        ``product_file`` then only names the sidecar.
+        """
+        if not self.enabled:
+            return
+        report = {"product": product_file} if products is None else {"products": list(products)}
+        report.update({
+            "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            "stages": {
+                name: {
+                    "seconds": self.times[name],
+                    "memory_mb": self.memory[name] / 2**20,
+                    "calls": self.calls[name],
+                }
+                for name in self.times
+            },
+        })
+        report.update(extra)
+        with open(os.path.splitext(product_file)[0] + ".stages.json", "w") as sidecar:
+            json.dump(report, sidecar, indent=2)
@@ -0,0 +1,100 @@
+"""Reading and writing images that may be tile-compressed.
+
+Tile-compressed FITS files keep an empty primary HDU and the image in a
+compressed extension. The readers look for the first HDU that holds image
+data, so compressed and plain inputs are read the same way, and astropy
+decompresses only the tiles a section touches.
+
+``compress_product`` rewrites a product saved by ``cpl.dfs.save_image`` as a
+tile-compressed file. Integer images are compressed losslessly. Float images
+are quantised to ``quantize`` levels per noise sigma of each tile (the FITS
+tiled image convention, with subtractive dithering), so the quantisation
+error is about noise / (2 * quantize). With ``quantize`` 0 float images
+are compressed losslessly with GZIP and byte shuffling instead.
+
+``write_table_columns`` fills the table of a product saved by
+``cpl.dfs.save_table`` with whole numpy columns, instead of setting every
+cell of a ``cpl.core.Table`` from Python.
+"""
+import os
+
+import numpy as np
+from astropy.io import fits
+
+# Compression choices of the <context>.output.compression parameters.
+COMPRESSION_TYPES = {
+    "rice": "RICE_1",
+    "gzip": "GZIP_2",
+}
+
+# Default quantisation of float products, in levels per noise sigma.
+DEFAULT_QUANTIZE = 16.0
+
+
+def image_hdu(hdul: fits.HDUList):
+    """The first HDU of ``hdul`` holding image data, compressed or not."""
+    for hdu in hdul:
+        if isinstance(hdu, (fits.PrimaryHDU, fits.ImageHDU, fits.CompImageHDU)) and hdu.header.get("NAXIS", 0) > 0:
+            return hdu
+    raise ValueError(f"No image data in {hdul.filename()!r}.")
+
+
+def image_extension(file: str) -> int:
+    """Index of the first HDU of ``file`` holding image data, e.g. for ``cpl.core.Image.load``."""
+    with fits.open(file, memmap=False) as hdul:
+        return hdul.index_of(image_hdu(hdul))
+
+
+def compress_product(file: str, compression: str = "rice", quantize: float = DEFAULT_QUANTIZE):
+    """Rewrite the image product ``file`` tile-compressed, in place.
+
+    The primary header keeps all product keywords, so tools reading the
+    primary header (like figl_functions.read_header) see the same values.
+    """
+    if compression == "none":
+        return
+    compression_type = COMPRESSION_TYPES[compression]
+    with fits.open(file, memmap=False) as hdul:
+        hdu = image_hdu(hdul)
+        if isinstance(hdu, fits.CompImageHDU):
+            return
+        data = hdu.data
+        header = hdul[0].header.copy()
+    if data.dtype.kind == "f" and quantize == 0:
+        # Rice needs quantised floats, lossless float compression is GZIP only.
+        compression_type = "GZIP_2"
+    for keyword in ("BZERO", "BSCALE", "BLANK"):
+        header.remove(keyword, ignore_missing=True)
+
+    options = {"quantize_level": quantize} if data.dtype.kind == "f" else {}
+    primary = fits.PrimaryHDU(header=header)
+    compressed = fits.CompImageHDU(data, compression_type=compression_type, **options)
+    tmp = file + ".tmp"
+    fits.HDUList([primary, compressed]).writeto(tmp, overwrite=True, output_verify="silentfix")
+    os.replace(tmp, file)
+
+
+def write_table_columns(file: str, columns: dict):
+    """Replace the rows of the first table extension of ``file`` with ``columns`` ({name: array}).
+
+    Integer columns are written as 32-bit integers (CPL_TYPE_INT), all others
+    as doubles. The keywords of the extension header are kept.
+    """
+    fits_columns = [
+        fits.Column(name=name, format="J", array=np.asarray(values, dtype=np.int32))
+        if np.asarray(values).dtype.kind in "iu"
+        else fits.Column(name=name, format="D", array=np.asarray(values, dtype=np.float64))
+        for name, values in columns.items()
+    ]
+    with fits.open(file, memmap=False) as hdul:
+        index = next(i for i, hdu in enumerate(hdul) if isinstance(hdu, fits.BinTableHDU))
+        header = hdul[index].header.copy()
+        # The column keywords of the saved table are replaced by the new ones.
+        for keyword in list(header):
+            if keyword.startswith(("TTYPE", "TFORM", "TUNIT", "TNULL", "TDIM", "TSCAL", "TZERO", "TDISP")):
+                header.remove(keyword, remove_all=True)
+        hdus = [hdu.copy() for hdu in hdul]
+        hdus[index] = fits.BinTableHDU.from_columns(fits_columns, header=header)
+    tmp = file + ".tmp"
+    fits.HDUList(hdus).writeto(tmp, overwrite=True)
+    os.replace(tmp, file)
@@ -0,0 +1,232 @@
+"""Vectorized aperture photometry for a whole source list.
+
+All sources are measured together: a cutout around every source is gathered
+with one fancy-indexing operation, and the aperture sums and the local sky
+(median of an annulus) are reduced over the stacked cutouts. Positions are
+0-based pixel coordinates with (0, 0) at the centre of the first pixel.
+"""
+import math
+
+from typing import Dict, Optional
+
+import numpy as np
+from astropy.wcs import WCS
+
+# Number of sources measured per batch, to bound the size of the cutout cube.
+BATCH_SIZE = 1024
+
+
+def _measure_batch(padded: np.ndarray, pad: int, x: np.ndarray, y: np.ndarray,
+                   radius: float, inner: float, outer: float) -> Dict[str, np.ndarray]:
+    offsets = np.arange(-pad, pad + 1)
+    ny, nx = padded.shape[0] - 2 * pad, padded.shape[1] - 2 * pad
+    xi = np.clip(np.rint(x), 0, nx - 1).astype(np.int64)
+    yi = np.clip(np.rint(y), 0, ny - 1).astype(np.int64)
+    rows = (yi + pad)[:, None, None] + offsets[None, :, None]
+    cols = (xi + pad)[:, None, None] + offsets[None, None, :]
+    cutouts = padded[rows, cols]
+
+    # Distance of every cutout pixel to the sub-pixel source position.
+    dy = offsets[None, :, None] - (y - yi)[:, None, None]
+    dx = offsets[None, None, :] - (x - xi)[:, None, None]
+    r2 = dx * dx + dy * dy
+
+    in_aperture = (r2 <= radius * radius) & np.isfinite(cutouts)
+    in_annulus = (r2 >= inner * inner) & (r2 <= outer * outer)
+
+    sky = np.nanmedian(np.where(in_annulus, cutouts, np.nan).reshape(len(x), -1), axis=1)
+    npix = in_aperture.sum(axis=(1, 2))
+    total = np.where(in_aperture, cutouts, 0.0).sum(axis=(1, 2))
+    return {"FLUX": total - sky * npix, "SKY": sky, "NPIX": npix}
+
+
+def aperture_photometry(image: np.ndarray, x, y, radius: float,
+                        inner: float, outer: float) -> Dict[str, np.ndarray]:
+    """Measure fixed circular apertures with local sky annuli at (x, y).
+
+    Returns arrays ``FLUX`` (sky subtracted), ``SKY`` (per-pixel sky level
+    from the median of the annulus ``inner`` to ``outer``) and ``NPIX``
+    (pixels in the aperture). Apertures running off the image only count
+    the pixels inside it.
+    """
+    x = np.atleast_1d(np.asarray(x, dtype=np.float64))
+    y = np.atleast_1d(np.asarray(y, dtype=np.float64))
+    pad = int(math.ceil(max(radius, outer))) + 1
+    padded = np.pad(np.asarray(image, dtype=np.float64), pad, constant_values=np.nan)
+
+    results = {"FLUX": [], "SKY": [], "NPIX": []}
+    for start in range(0, len(x), BATCH_SIZE):
+        batch = _measure_batch(
+            padded, pad, x[start:start + BATCH_SIZE], y[start:start + BATCH_SIZE],
+            radius, inner, outer,
+        )
+        for key, values in batch.items():
+            results[key].append(values)
+    return {
+        key: np.concatenate(values) if values else np.empty(0)
+        for key, values in results.items()
+    }
+
+
+def instrumental_magnitude(flux: np.ndarray, exptime: float) -> np.ndarray:
+    """-2.5 log10(flux / exptime), NaN where the flux is not positive."""
+    flux = np.asarray(flux, dtype=np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(flux > 0, -2.5 * np.log10(flux / exptime), np.nan)
+
+
+class GridIndex:
+    """Uniform grid over 2-D reference points for radius queries.
+
+    The points are bucketed into square cells of size ``cell`` and sorted by
+    cell, so a query only compares against the 3x3 cells around it. Building
+    is O(N log N) and a query of M points costs O(M log N) plus the number of
+    candidate pairs, instead of O(N M) for brute force.
+    """
+
+    def __init__(self, x, y, cell: float):
+        self.x = np.asarray(x, dtype=np.float64)
+        self.y = np.asarray(y, dtype=np.float64)
+        self.cell = float(cell)
+        self._origin = (
+            (self.x.min(), self.y.min()) if len(self.x) else (0.0, 0.0)
+        )
+        cx, cy = self._cells(self.x, self.y)
+        self._ncols = int(cy.max()) + 3 if len(cy) else 3
+        keys = self._keys(cx, cy)
+        self._order = np.argsort(keys, kind="stable")
+        self._keys_sorted = keys[self._order]
+
+    def _cells(self, x, y):
+        cx = np.floor((x - self._origin[0]) / self.cell).astype(np.int64) + 1
+        cy = np.floor((y - self._origin[1]) / self.cell).astype(np.int64) + 1
+        return cx, cy
+
+    def _keys(self, cx, cy):
+        return cx * self._ncols + cy
+
+    def query_pairs(self, x, y, radius: float):
+        """All (query index, reference index, distance) pairs closer than ``radius``.
+
+        ``radius`` must not exceed the cell size.
+        """
+        if radius > self.cell:
+            raise ValueError("Query radius larger than the grid cell.")
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        cx, cy = self._cells(x, y)
+        queries, refs = [], []
+        for ox in (-1, 0, 1):
+            for oy in (-1, 0, 1):
+                ncx, ncy = cx + ox, cy + oy
+                valid = (ncy >= 0) & (ncy < self._ncols)
+                keys = np.where(valid, self._keys(ncx, ncy), -1)
+                lo = np.searchsorted(self._keys_sorted, keys, side="left")
+                hi = np.searchsorted(self._keys_sorted, keys, side="right")
+                counts = np.where(valid, hi - lo, 0)
+                query = np.repeat(np.arange(len(x)), counts)
+                # Position of every candidate in the sorted reference list.
+                first = np.repeat(lo - np.cumsum(counts) + counts, counts)
+                queries.append(query)
+                refs.append(self._order[first + np.arange(counts.sum())])
+        query = np.concatenate(queries)
+        ref = np.concatenate(refs)
+        dist = np.hypot(x[query] - self.x[ref], y[query] - self.y[ref])
+        close = dist <= radius
+        return query[close], ref[close], dist[close]
+
+    def nearest(self, x, y, radius: float):
+        """Index of the nearest reference point within ``radius`` of each query, -1 if none."""
+        query, ref, dist = self.query_pairs(x, y, radius)
+        match = np.full(len(np.atleast_1d(x)), -1, dtype=np.int64)
+        distance = np.full(len(match), np.nan)
+        # Sort by distance, then keep the first pair of every query.
+        order = np.lexsort((dist, query))
+        query, ref, dist = query[order], ref[order], dist[order]
+        first = np.ones(len(query), dtype=bool)
+        first[1:] = query[1:] != query[:-1]
+        match[query[first]] = ref[first]
+        distance[query[first]] = dist[first]
+        return match, distance
+
+
+def robust_zero_point(catalog_mag, instrumental_mag, kappa: float = 3.0, niter: int = 5):
+    """Sigma-clipped zero point from matched catalog and instrumental magnitudes.
+
+    The centre is the median of ``catalog - instrumental`` and the scatter is
+    the MAD scaled to a standard deviation. Returns (zero point, rms of the
+    kept stars, number of kept stars).
+    """
+    diff = np.asarray(catalog_mag, dtype=np.float64) - np.asarray(instrumental_mag, dtype=np.float64)
+    keep = np.isfinite(diff)
+    for _ in range(niter):
+        if not keep.any():
+            break
+        center = np.median(diff[keep])
+        scatter = 1.4826 * np.median(np.abs(diff[keep] - center))
+        new_keep = np.isfinite(diff) & (np.abs(diff - center) <= kappa * max(scatter, 1e-6))
+        if np.array_equal(new_keep, keep):
+            break
+        keep = new_keep
+    if not keep.any():
+        return np.nan, np.nan, 0
+    return float(np.median(diff[keep])), float(np.std(diff[keep])), int(keep.sum())
+
+
+def load_catalog(path: str) -> np.ndarray:
+    """Load a standard star catalog from a text file with a header row.
+
+    Columns are separated by commas or whitespace. The catalog needs RA/DEC
+    (degrees) or X/Y (1-based pixels) columns and one magnitude column per
+    filter, e.g. ``ID RA DEC V R``.
+    """
+    with open(path) as f:
+        header = f.readline()
+    delimiter = "," if "," in header else None
+    return np.genfromtxt(path, names=True, dtype=None, encoding="utf-8", delimiter=delimiter)
+
+
+def _tangent_plane(ra, dec, ra0: float, dec0: float):
+    """Offsets in arcsec from (ra0, dec0), good enough for a single field."""
+    dra = (np.asarray(ra) - ra0 + 180.0) % 360.0 - 180.0
+    return dra * np.cos(np.radians(dec0)) * 3600.0, (np.asarray(dec) - dec0) * 3600.0
+
+
+class CatalogMatcher:
+    """Cross-match detections to a standard star catalog through a ``GridIndex``.
+
+    Catalogs with RA/DEC columns are matched on the sky, which needs a
+    celestial WCS in the frame header, and ``radius`` is in arcsec. Catalogs
+    with X/Y columns are matched in pixels.
+    """
+
+    def __init__(self, catalog: np.ndarray, radius: float):
+        self.catalog = catalog
+        self.radius = radius
+        names = catalog.dtype.names
+        self.celestial = "RA" in names and "DEC" in names
+        if self.celestial:
+            self._center = (float(np.mean(catalog["RA"])), float(np.mean(catalog["DEC"])))
+            u, v = _tangent_plane(catalog["RA"], catalog["DEC"], *self._center)
+        elif "X" in names and "Y" in names:
+            u, v = catalog["X"] - 1.0, catalog["Y"] - 1.0
+        else:
+            raise ValueError("Catalog needs RA/DEC or X/Y columns.")
+        self.index = GridIndex(u, v, radius)
+
+    def match(self, x, y, header=None):
+        """Catalog row of each detection at 0-based pixel (x, y), -1 if none."""
+        if self.celestial:
+            wcs = WCS(header) if header is not None else None
+            if wcs is None or not wcs.has_celestial:
+                raise ValueError("Frame has no celestial WCS to match an RA/DEC catalog.")
+            ra, dec = wcs.celestial.all_pix2world(x, y, 0)
+            x, y = _tangent_plane(ra, dec, *self._center)
+        return self.index.nearest(x, y, self.radius)[0]
+
+
+def filter_band(filter_name: Optional[str]) -> Optional[str]:
+    """Catalog column of a FILTER keyword, e.g. 'Bessel V' -> 'V'."""
+    if not filter_name:
+        return None
+    return filter_name.split()[-1]
@@ -0,0 +1,584 @@
+"""Banded stacking engine shared by the figl recipes.
+
+Instead of loading every frame into one ``cpl.core.ImageList``, the frames
+are read in bands of full image rows. Each band is combined on its own and
+written into the output image, so the peak memory is bounded by the memory
+budget and not by the number of frames.
+"""
+import contextlib
+import math
+import threading
+import time
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+from astropy.io import fits
+
+from figl_instrument import Stages
+from figl_io import image_hdu
+
+# Memory budget for one stack in MB, used when a recipe does not set one.
+DEFAULT_MEMORY_LIMIT = 1024
+
+# Defaults of the sigma-clipping: rejection threshold in standard deviations
+# and number of clipping passes after the first statistics pass.
+DEFAULT_KAPPA = 3.0
+DEFAULT_NITER = 2
+
+# Frames (or frame bands) loaded ahead of the one being processed, used when a
+# recipe does not set <context>.prefetch.
+DEFAULT_PREFETCH = 2
+
+# calibrate(index, band, y0, y1) -> band, applied to every frame band before combining.
+Calibration = Callable[[int, np.ndarray, int, int], np.ndarray]
+
+# Pixel types of the <context>.precision recipe parameters. Single precision
+# products agree with double precision ones to within 1e-3 of their noise,
+# see benchmarks/bench_precision.py.
+PRECISIONS = {"double": np.float64, "single": np.float32}
+
+
+def image_shape(file: str) -> Tuple[int, int]:
+    """Return the (ny, nx) shape of the image of a FITS file."""
+    with fits.open(file, memmap=False) as hdul:
+        return tuple(image_hdu(hdul).shape)  # type: ignore
+
+
+def read_image(file: str, dtype=np.float64) -> np.ndarray:
+    """Load the full image of a FITS file, compressed or not, as a numpy array.
+
+    With ``dtype`` None the image keeps the type it is stored in, e.g. uint16
+    for raw frames.
+    """
+    with fits.open(file, memmap=False) as hdul:
+        return np.array(image_hdu(hdul).section[:, :], dtype=dtype)  # type: ignore
+
+
+class FrameBands:
+    """Keeps a set of frames open and reads row bands out of them."""
+
+    def __init__(self, files: Sequence[str], dtype=np.float64):
+        if len(files) == 0:
+            raise ValueError("No frames to stack.")
+        self.files = list(files)
+        self.dtype = dtype
+        self._stack = contextlib.ExitStack()
+        self._hdus = [
+            image_hdu(self._stack.enter_context(fits.open(file, memmap=False)))
+            for file in self.files
+        ]
+        self.shape = tuple(self._hdus[0].shape)
+        for file, hdu in zip(self.files, self._hdus):
+            if tuple(hdu.shape) != self.shape:
+                self.close()
+                raise ValueError(
+                    f"Frame {file!r} has shape {tuple(hdu.shape)}, expected {self.shape}."
+                )
+
+    def __len__(self) -> int:
+        return len(self._hdus)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._stack.close()
+
+    def read(self, index: int, y0: int, y1: int) -> np.ndarray:
+        return np.array(self._hdus[index].section[y0:y1, :], dtype=self.dtype)
+
+    def stored_dtype(self) -> Optional[np.dtype]:
+        """Type all frames are stored in, None if they differ."""
+        types = {np.asarray(hdu.section[0:1, 0:1]).dtype for hdu in self._hdus}
+        return types.pop() if len(types) == 1 else None
+
+
+class LoadStats:
+    """Time spent loading frames and time the consumer waited for them.
+
+    The load time is summed over all loader threads; what the consumer did
+    not have to wait for was hidden behind its own computation.
+    """
+
+    def __init__(self):
+        self.load = 0.0
+        self.wait = 0.0
+        self.reads = 0
+        self._lock = threading.Lock()
+
+    def add(self, load: float = 0.0, wait: float = 0.0, reads: int = 0):
+        with self._lock:
+            self.load += load
+            self.wait += wait
+            self.reads += reads
+
+    @property
+    def hidden(self) -> float:
+        return max(0.0, self.load - self.wait)
+
+    def summary(self) -> str:
+        return (f"{self.reads} frame reads took {self.load:.2f} s, "
+                f"{self.hidden:.2f} s of it hidden behind processing.")
+
+
+class FrameSource:
+    """Iterate over ``load(index)`` for ``count`` indices, loading ahead in the background.
+
+    Up to ``depth`` items are loaded concurrently on ``pool`` (or on
+    ``depth`` private loader threads) while the caller processes the current
+    one, so at most ``depth + 1`` items are held at a time and slow reads
+    overlap with each other as well as with the processing. The items are always yielded in
+    index order, so the result of the processing never depends on timing.
+    With ``depth`` 0 the items are loaded synchronously.
+    """
+
+    def __init__(self, load: Callable[[int], Any], count: int, depth: int = DEFAULT_PREFETCH,
+                 pool: Optional[ThreadPoolExecutor] = None, stats: Optional[LoadStats] = None):
+        self.load = load
+        self.count = count
+        self.depth = max(0, depth)
+        self.pool = pool
+        self.stats = stats if stats is not None else LoadStats()
+
+    def __len__(self) -> int:
+        return self.count
+
+    def _timed_load(self, idx: int):
+        start = time.perf_counter()
+        item = self.load(idx)
+        self.stats.add(load=time.perf_counter() - start, reads=1)
+        return item
+
+    def __iter__(self) -> Iterator[Any]:
+        if self.depth == 0 or self.count < 2:
+            for idx in range(self.count):
+                start = time.perf_counter()
+                item = self.load(idx)
+                elapsed = time.perf_counter() - start
+                self.stats.add(load=elapsed, wait=elapsed, reads=1)
+                yield item
+            return
+        with contextlib.ExitStack() as stack:
+            pool = self.pool
+            if pool is None:
+                pool = stack.enter_context(ThreadPoolExecutor(max_workers=self.depth))
+            pending = deque()
+            next_idx = 0
+            while next_idx < min(self.count, self.depth):
+                pending.append(pool.submit(self._timed_load, next_idx))
+                next_idx += 1
+            while pending:
+                start = time.perf_counter()
+                item = pending.popleft().result()
+                self.stats.add(wait=time.perf_counter() - start)
+                if next_idx < self.count:
+                    pending.append(pool.submit(self._timed_load, next_idx))
+                    next_idx += 1
+                yield item
+                del item
+
+
+def _mean(read_pass, nframes: int, **options):
+    # Same summation order as cpl_imagelist_collapse_create: add the frames
+    # one after another and divide once at the end.
+    frame_bands = read_pass()
+    total = next(frame_bands)
+    for band in frame_bands:
+        total += band
+    total /= nframes
+    return total, None
+
+
+def _median(read_pass, nframes: int, **options):
+    cube = None
+    for idx, band in enumerate(read_pass()):
+        if cube is None:
+            cube = np.empty((nframes,) + band.shape, dtype=band.dtype)
+        cube[idx] = band
+    # The cube is scratch: partition it in place instead of copying it.
+    return np.median(cube, axis=0, overwrite_input=True), None
+
+
+# Offsets that map the stored integer types, by (kind, itemsize), onto
+# unsigned 16-bit keys of the same order.
+INTEGER_KEYS = {
+    ("u", 1): 0,
+    ("i", 1): 1 << 7,
+    ("u", 2): 0,
+    ("i", 2): 1 << 15,
+}
+
+
+def _integer_key(dtype: Optional[np.dtype]):
+    return None if dtype is None else (dtype.kind, dtype.itemsize)
+
+
+def _select_bins(counts: np.ndarray, ranks: np.ndarray):
+    """Per pixel, the bin of ``counts`` (bins, pixels) holding 0-based rank ``ranks`` and the count below it.
+
+    The bins are scanned in order until every pixel has found its rank, so
+    a stack whose values only use a few bins costs only those bins.
+    """
+    bins = np.zeros(ranks.shape, dtype=np.intp)
+    below = np.zeros(ranks.shape, dtype=np.int32)
+    running = np.zeros(ranks.shape, dtype=np.int32)
+    pending = np.ones(ranks.shape, dtype=bool)
+    for b in range(counts.shape[0]):
+        previous = running.copy()
+        running += counts[b]
+        found = pending & (running > ranks)
+        if found.any():
+            bins[found] = b
+            below[found] = previous[found]
+            pending &= ~found
+            if not pending.any():
+                break
+    return bins, below
+
+
+def _integer_median(read_pass, nframes: int, **options):
+    """Exact per-pixel median of 8 or 16-bit integer frames, from per-pixel histograms.
+
+    The first pass counts the high byte of every value per pixel, which
+    locates the high byte of the middle value(s); the second pass counts
+    the low bytes of the values with that high byte. Nothing is sorted and
+    no frames are held, so the memory per pixel is fixed (two 256-bin
+    histograms) whatever the number of frames. For an even number of frames
+    the two middle values are averaged, as by ``np.median``.
+    """
+    count_type = np.uint16 if nframes < (1 << 16) else np.uint32
+    middle = sorted({(nframes - 1) // 2, nframes // 2})
+    high = None
+    offset = 0
+    for band in read_pass():
+        if high is None:
+            shape, npix = band.shape, band.size
+            offset = INTEGER_KEYS[_integer_key(band.dtype)]
+            pixels = np.arange(npix, dtype=np.intp)
+            high = np.zeros((256, npix), dtype=count_type)
+        index = band.ravel().astype(np.intp)
+        index += offset
+        index >>= 8
+        index *= npix
+        index += pixels
+        # Every pixel occurs once per frame, so the increment has no duplicate indices.
+        high.reshape(-1)[index] += 1
+
+    selected = [_select_bins(high, np.full(npix, rank, dtype=np.int32)) for rank in middle]
+    del high
+    # The two middle values of an even stack usually share their high byte,
+    # and then one histogram of low bytes serves both.
+    starts = [selected[0][0]]
+    if len(middle) == 2 and not np.array_equal(selected[0][0], selected[1][0]):
+        starts.append(selected[1][0])
+    starts = [(start << 8) - offset for start in starts]
+    # Row 256 collects the values outside the high byte.
+    low = [np.zeros((257, npix), dtype=count_type) for _ in starts]
+    for band in read_pass():
+        values = band.ravel().astype(np.intp)
+        for start, counts in zip(starts, low):
+            index = values - start
+            index[(index < 0) | (index > 255)] = 256
+            index *= npix
+            index += pixels
+            counts.reshape(-1)[index] += 1
+
+    median = np.zeros(npix, dtype=np.float64)
+    for idx, (rank, (high_bins, below)) in enumerate(zip(middle, selected)):
+        counts = low[min(idx, len(low) - 1)]
+        low_bins, _ = _select_bins(counts[:256], rank - below)
+        median += (high_bins << 8) + low_bins - offset
+    median /= len(middle)
+    return median.reshape(shape), None
+
+
+def _t_tail(t: float, dof: int) -> float:
+    """Two-sided tail probability P(|T| > t) of Student's t with ``dof`` degrees of freedom.
+
+    Closed form for integer degrees of freedom (Abramowitz & Stegun 26.7.3-4).
+    """
+    theta = math.atan(t / math.sqrt(dof))
+    cos2 = math.cos(theta) ** 2
+    if dof % 2:
+        term, total = 1.0, 0.0
+        for k in range(1, (dof - 1) // 2 + 1):
+            total += term
+            term *= cos2 * 2 * k / (2 * k + 1)
+        inside = 2 / math.pi * (theta + math.sin(theta) * math.cos(theta) * total)
+    else:
+        term, total = 1.0, 0.0
+        for k in range(1, dof // 2 + 1):
+            total += term
+            term *= cos2 * (2 * k - 1) / (2 * k)
+        inside = math.sin(theta) * total
+    return 1.0 - inside
+
+
+def _t_limit(kappa: float, dof: int) -> float:
+    """Threshold of a Student's t with ``dof`` degrees of freedom with the two-sided tail of ``kappa`` Gaussian sigma."""
+    tail = math.erfc(kappa / math.sqrt(2))
+    low, high = kappa, kappa
+    while _t_tail(high, dof) > tail:
+        high *= 2
+    for _ in range(60):
+        mid = (low + high) / 2
+        if _t_tail(mid, dof) > tail:
+            low = mid
+        else:
+            high = mid
+    return high
+
+
+def _sigclip(read_pass, nframes: int, kappa: float = DEFAULT_KAPPA,
+             niter: int = DEFAULT_NITER, **options):
+    """Kappa-sigma clipped mean from running sums, one pass over the frames per iteration.
+
+    The first pass measures the plain mean and the sum of squared
+    deviations. The first clipping pass judges each value against the mean
+    and sample standard deviation of the other frames, derived from those
+    sums: a standard deviation that includes the outlier itself puts it at
+    most (n - 1) / sqrt(n) sigma off, so at kappa 3 it is never rejected
+    in a stack of up to ten frames. A sigma from the other n - 1 values is
+    uncertain for small stacks, so the threshold is the Student's t value
+    (n - 2 degrees of freedom) with the same tail as ``kappa`` Gaussian
+    sigma; otherwise a stack of five would lose about 6% of its good values.
+    Each further pass only accumulates the values within ``kappa`` sample
+    standard deviations of the current centre, plus a few ulps so identical
+    values survive a zero sigma. A pixel for which a pass keeps no value
+    keeps the previous result. The sums are taken relative to the previous
+    centre to keep them numerically stable.
+    """
+    frame_bands = read_pass()
+    center = next(frame_bands).copy()
+    m2 = np.zeros_like(center)
+    for count, band in enumerate(frame_bands, start=2):
+        # Welford update of the mean and the sum of squared deviations.
+        delta = band - center
+        center += delta / count
+        m2 += delta * (band - center)
+
+    count = np.full(center.shape, nframes, dtype=np.int32)
+    if nframes < 3:
+        # Too few values to judge one against the others.
+        return center, nframes - count
+    # A value is off the mean of the others by band * n / (n - 1), with a
+    # variance of sigma**2 * n / (n - 1).
+    loo_limit = _t_limit(kappa, nframes - 2) * math.sqrt((nframes - 1) / nframes)
+    sigma = None
+    for _ in range(niter):
+        total = np.zeros_like(center)
+        total_sq = np.zeros_like(center)
+        previous, count = count, np.zeros(center.shape, dtype=np.int32)
+        if sigma is not None:
+            limit = kappa * sigma + 4 * np.spacing(np.abs(center))
+        for band in read_pass():
+            band -= center
+            if sigma is None:
+                # Sample variance of the other frames: m2 less this value's
+                # share, over nframes - 2.
+                limit = np.maximum(m2 - band * band * (nframes / (nframes - 1)), 0.0)
+                limit /= nframes - 2
+                np.sqrt(limit, out=limit)
+                limit *= loo_limit
+                limit += 4 * np.spacing(np.abs(center))
+            keep = np.abs(band) <= limit
+            band[~keep] = 0.0
+            total += band
+            np.multiply(band, band, out=band)
+            total_sq += band
+            count += keep
+        del limit
+        m2 = None
+        used = count > 0
+        mean = np.divide(total, count, out=np.zeros_like(total), where=used)
+        # Sample variance of the kept values around their new mean.
+        total_sq -= count * mean * mean
+        sigma = np.divide(total_sq, count - 1, out=np.zeros_like(total), where=count > 1)
+        np.sqrt(np.maximum(sigma, 0.0, out=sigma), out=sigma)
+        center += mean
+        count = np.where(used, count, previous)
+    return center, nframes - count
+
+
+# Stacking methods: name -> (combine function, band buffers held in memory).
+# None means one buffer per frame; streaming methods hold a fixed number of
+# buffers whatever the frame count.
+METHODS: Dict[str, Tuple[Callable, Optional[int]]] = {
+    "mean": (_mean, 2),
+    "median": (_median, None),
+    "sigclip": (_sigclip, 12),
+}
+
+
+def band_rows(shape: Tuple[int, int], nframes: int, method: str,
+              memory_limit: float = DEFAULT_MEMORY_LIMIT, itemsize: int = 8,
+              workers: int = 1, prefetch: int = 0, out_itemsize: Optional[int] = None) -> int:
+    """Number of image rows per band that keeps a stack within ``memory_limit`` MB.
+
+    ``itemsize`` is that of the frame bands, ``out_itemsize`` that of the
+    combined band if it differs (the median of integer bands is a double).
+    """
+    held = METHODS[method][1]
+    out_bytes = 0
+    if held is None:
+        # The frames, the combined band and a band-sized temporary of
+        # np.median.
+        held = nframes
+        out_bytes = 2 * (out_itemsize or itemsize)
+    # Bands loaded ahead of the one being combined, and the band each
+    # concurrent read holds in its stored type before the conversion.
+    lookahead = min(nframes, _lookahead(workers, prefetch))
+    held += lookahead + max(1, lookahead)
+    row_bytes = shape[1] * (itemsize * held + out_bytes)
+    rows = int(memory_limit * 1024 * 1024 // row_bytes)
+    return max(1, min(shape[0], rows))
+
+
+def _integer_median_rows(shape: Tuple[int, int], memory_limit: float, lookahead: int, itemsize: int = 8) -> int:
+    """Number of image rows per band of the integer median within ``memory_limit`` MB."""
+    # Two histograms of 16-bit counts, the bands in flight as 16-bit values,
+    # the index arrays and selected bins, and the combined band.
+    pixel_bytes = 2 * 257 * 2 + (1 + lookahead) * 2 + 6 * 8 + itemsize
+    rows = int(memory_limit * 1024 * 1024 // (shape[1] * pixel_bytes))
+    return max(1, min(shape[0], rows))
+
+
+def _lookahead(workers: int, prefetch: int) -> int:
+    """Frame bands in flight: the prefetch window, widened to keep every worker busy."""
+    return max(prefetch, workers) if workers > 1 else max(0, prefetch)
+
+
+def prefetch_depth(nbytes: int, memory_limit: float = DEFAULT_MEMORY_LIMIT,
+                   prefetch: int = DEFAULT_PREFETCH) -> int:
+    """Prefetch depth for whole frames of ``nbytes`` that fits beside the current one in ``memory_limit`` MB."""
+    fits_in = int(memory_limit * 1024 * 1024 // max(1, nbytes)) - 1
+    return max(0, min(prefetch, fits_in))
+
+
+def bands(ny: int, rows: int) -> List[Tuple[int, int]]:
+    """Split ``ny`` image rows into consecutive (y0, y1) bands of ``rows`` rows."""
+    return [(y0, min(ny, y0 + rows)) for y0 in range(0, ny, rows)]
+
+
+def stack_frames(files: Sequence[str], method: str = "mean",
+                 memory_limit: float = DEFAULT_MEMORY_LIMIT,
+                 calibrate: Optional[Calibration] = None,
+                 workers: int = 1, kappa: float = DEFAULT_KAPPA,
+                 niter: int = DEFAULT_NITER,
+                 qc: Optional[Dict[str, Any]] = None,
+                 stages: Optional[Stages] = None,
+                 dtype=np.float64, native: bool = False,
+                 prefetch: int = DEFAULT_PREFETCH,
+                 load_stats: Optional[LoadStats] = None,
+                 integer_median: bool = False) -> np.ndarray:
+    """Combine ``files`` band by band with the given stacking method.
+
+    ``calibrate`` is applied to each frame band right after it is read, e.g.
+    to subtract the master bias. With ``workers`` > 1 the frames of a band are
+    read and calibrated on a thread pool; ``calibrate`` must then only read
+    shared state such as the master images. The frames are still combined in
+    input order, so the result is the same as with a single worker.
+
+    ``prefetch`` frame bands are read (and calibrated) on background threads
+    ahead of the band being combined, within the memory budget, so reading
+    overlaps with combining; 0 reads synchronously. As with ``workers``,
+    ``calibrate`` must then only read shared state. The load and wait times
+    are added to ``load_stats``.
+
+    Without ``calibrate``, the ``median`` of frames stored as 8 or 16-bit
+    integers is taken on the raw integers, with the same result as on
+    doubles: with ``np.median`` on integer bands, a quarter the size of
+    double bands and faster to partition, or with ``integer_median`` from
+    per-pixel histograms of the raw values (see ``_integer_median``). The
+    histograms need a fixed 1 KB per pixel whatever the number of frames,
+    against 2 bytes per frame and pixel, but take about 1.6 times as long
+    (benchmarks/bench_median.py), so they only pay off for stacks too large
+    for the memory budget. Float frames always use ``np.median`` on
+    ``dtype`` bands.
+
+    ``kappa`` and ``niter`` configure the ``sigclip`` method. For methods that
+    reject values, the per-pixel rejection counts are summarised into ``qc``
+    as ``NREJ TOTAL``, ``NREJ MAX``, ``NREJ MEAN`` and ``NREJ NPIX`` (pixels
+    with at least one rejected value).
+
+    The frames are combined in ``dtype``. With ``native`` the frames are read
+    in the type they are stored in (uint16 for raw frames) and ``calibrate``
+    has to return bands of ``dtype``, so raw pixels stay integers until the
+    bias is subtracted.
+
+    With ``stages`` the reads are timed as stage ``load``, ``calibrate`` as
+    ``calibrate`` and the combination as ``collapse``.
+    Returns the combined image as a ``dtype`` array.
+    """
+    if method not in METHODS:
+        raise ValueError(f"Unknown stacking method {method!r}.")
+    combine = METHODS[method][0]
+    if stages is None:
+        stages = Stages()
+
+    integer = method == "median" and calibrate is None
+    itemsize = out_itemsize = np.dtype(dtype).itemsize
+    with FrameBands(files, None if native or integer else dtype) as frames:
+        if integer:
+            stored = frames.stored_dtype()
+            integer = _integer_key(stored) in INTEGER_KEYS
+            if not integer:
+                frames.dtype = None if native else dtype
+            elif integer_median:
+                combine = _integer_median
+            else:
+                # np.median on the raw integer bands, which returns doubles.
+                itemsize = stored.itemsize
+                out_itemsize = np.dtype(np.float64).itemsize
+                integer = False
+        read = stages.wrap("load", frames.read)
+        if calibrate is None:
+            load = read
+        else:
+            calibrate = stages.wrap("calibrate", calibrate)
+
+            def load(idx, y0, y1):
+                return calibrate(idx, read(idx, y0, y1), y0, y1)
+
+        depth = _lookahead(workers, prefetch)
+        if integer:
+            rows = _integer_median_rows(frames.shape, memory_limit, depth, itemsize)
+        else:
+            rows = band_rows(frames.shape, len(frames), method, memory_limit, itemsize, workers, prefetch,
+                             out_itemsize)
+        if load_stats is None:
+            load_stats = LoadStats()
+        combined = np.empty(frames.shape, dtype=dtype)
+        rejected = None
+        with contextlib.ExitStack() as stack:
+            pool = None
+            if depth > 0:
+                pool = stack.enter_context(ThreadPoolExecutor(max_workers=depth))
+            for y0, y1 in bands(frames.shape[0], rows):
+                def read_pass():
+                    return iter(FrameSource(
+                        lambda idx: load(idx, y0, y1), len(frames), depth, pool, load_stats
+                    ))
+
+                with stages.stage("collapse"):
+                    combined[y0:y1], band_rejected = combine(
+                        read_pass, len(frames), kappa=kappa, niter=niter
+                    )
+                if band_rejected is not None:
+                    if rejected is None:
+                        rejected = np.zeros(frames.shape, dtype=np.int32)
+                    rejected[y0:y1] = band_rejected
+
+    if qc is not None and rejected is not None:
+        qc["NREJ TOTAL"] = int(rejected.sum())
+        qc["NREJ MAX"] = int(rejected.max())
+        qc["NREJ MEAN"] = float(rejected.mean())
+        qc["NREJ NPIX"] = int(np.count_nonzero(rejected))
+
+    return combined
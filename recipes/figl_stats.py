@@ -0,0 +1,161 @@
+"""Image statistics with a bounded error: median, MAD and percentiles.
+
+Every estimator returns an ``Estimate`` of the value and a bound on its
+error, in the units of the data:
+
+``exact``
+    ``np.percentile`` over every pixel, error 0.
+``sampled``
+    The percentile of ``nsamples`` pixels drawn with a fixed seed. The
+    error is the half-width of the distribution-free 95% confidence
+    interval of a sample percentile (the sample order statistics
+    ``z * sqrt(n p (1 - p))`` ranks either side). For Gaussian noise of
+    sigma s the median is then good to about 2.5 s / sqrt(nsamples), i.e.
+    0.008 s with the default 100000 samples, in a fixed time whatever the
+    image size.
+``histogram``
+    Integer images are counted with ``np.bincount`` and the result is
+    exact. Float images are binned in two levels of ``nbins`` bins, the
+    second level inside the first-level bin holding an order statistic,
+    and its value is interpolated in the final bin. The two order
+    statistics the percentile is interpolated between are refined
+    separately, so the error is at most the final bin width,
+    (max - min) / nbins**2, even when they fall in different bins.
+
+The MAD is the median absolute deviation from the median, not scaled to a
+standard deviation. Its error bound includes the error of the median.
+"""
+import math
+
+from collections import namedtuple
+
+import numpy as np
+
+# Estimators selectable with the <context>.statistics parameters.
+METHODS = ("exact", "sampled", "histogram")
+
+# Pixels drawn by the sampled estimators.
+DEFAULT_SAMPLES = 100_000
+
+# Bins per level of the histogram estimators of float images.
+DEFAULT_BINS = 4096
+
+# Normal quantile of the 95% confidence interval of the sampled estimators.
+CONFIDENCE_Z = 1.96
+
+# Largest value range of integer images counted in one histogram.
+MAX_INTEGER_SPAN = 1 << 24
+
+Estimate = namedtuple("Estimate", "value error")
+
+
+def _sampled(flat: np.ndarray, q: float) -> Estimate:
+    """Percentile ``q`` of the already drawn sample ``flat`` and its confidence bound."""
+    n = flat.size
+    p = q / 100.0
+    rank = p * (n - 1)
+    half = CONFIDENCE_Z * math.sqrt(n * p * (1.0 - p))
+    below = int(math.floor(rank))
+    above = min(n - 1, below + 1)
+    low = max(0, int(math.floor(rank - half)))
+    high = min(n - 1, int(math.ceil(rank + half)))
+    part = np.partition(flat, sorted({below, above, low, high}))
+    value = float(part[below]) + (rank - below) * (float(part[above]) - float(part[below]))
+    return Estimate(value, max(value - float(part[low]), float(part[high]) - value))
+
+
+def _order_statistics(counts: np.ndarray, ranks):
+    """Bin and rank within the bin of each 0-based rank, from histogram ``counts``."""
+    cumulative = np.cumsum(counts)
+    bins = np.searchsorted(cumulative, np.asarray(ranks) + 1)
+    return bins, np.asarray(ranks) - (cumulative[bins] - counts[bins])
+
+
+def _histogram_rank(flat: np.ndarray, rank: int, nbins: int, low: float, high: float) -> Estimate:
+    """Value of the 0-based order statistic ``rank`` of the float values ``flat`` in [low, high]."""
+    # Two levels of bins: the whole range, then the bin holding the rank.
+    values = flat
+    start, width = low, (high - low) / nbins
+    for _ in range(2):
+        index = np.clip(((values - start) / width).astype(np.intp), 0, nbins - 1)
+        counts = np.bincount(index, minlength=nbins)
+        bins, within = _order_statistics(counts, [rank])
+        selected = bins[0]
+        rank = int(within[0])
+        values = values[index == selected]
+        start, width = start + selected * width, width / nbins
+    # Interpolate the order statistic in the final bin, assuming its values are spread evenly.
+    final_width = width * nbins
+    value = start + final_width * (rank + 0.5) / max(1, counts[selected])
+    return Estimate(float(value), final_width)
+
+
+def _histogram(flat: np.ndarray, q: float, nbins: int) -> Estimate:
+    n = flat.size
+    rank = q / 100.0 * (n - 1)
+    ranks = [int(math.floor(rank)), min(n - 1, int(math.floor(rank)) + 1)]
+    low, high = flat.min(), flat.max()
+    if low == high:
+        return Estimate(float(low), 0.0)
+
+    if flat.dtype.kind in "ui" and int(high) - int(low) < MAX_INTEGER_SPAN:
+        counts = np.bincount((flat - low).astype(np.intp, copy=False), minlength=int(high) - int(low) + 1)
+        bins, _ = _order_statistics(counts, ranks)
+        below, above = float(low) + bins[0], float(low) + bins[1]
+        return Estimate(below + (rank - ranks[0]) * (above - below), 0.0)
+
+    # The two order statistics around the rank are refined on their own, as
+    # they can lie in different bins (e.g. the median of a bimodal image).
+    below = _histogram_rank(flat, ranks[0], nbins, float(low), float(high))
+    if ranks[1] == ranks[0] or rank == ranks[0]:
+        return below
+    above = _histogram_rank(flat, ranks[1], nbins, float(low), float(high))
+    value = below.value + (rank - ranks[0]) * (above.value - below.value)
+    return Estimate(value, max(below.error, above.error))
+
+
+def percentile(data: np.ndarray, q: float, method: str = "exact", nsamples: int = DEFAULT_SAMPLES,
+               nbins: int = DEFAULT_BINS, seed: int = 0) -> Estimate:
+    """Percentile ``q`` (0 to 100) of ``data`` with the given estimator."""
+    if method not in METHODS:
+        raise ValueError(f"Unknown statistics method {method!r}.")
+    flat = np.asarray(data).ravel()
+    if flat.size == 0:
+        raise ValueError("No data for statistics.")
+    if method == "exact" or (method == "sampled" and flat.size <= nsamples):
+        return Estimate(float(np.percentile(flat, q)), 0.0)
+    if method == "sampled":
+        sample = flat[np.random.default_rng(seed).integers(0, flat.size, nsamples)]
+        return _sampled(sample, q)
+    return _histogram(flat, q, nbins)
+
+
+def median(data: np.ndarray, method: str = "exact", **options) -> Estimate:
+    """Median of ``data`` with the given estimator."""
+    return percentile(data, 50.0, method, **options)
+
+
+def mad(data: np.ndarray, method: str = "exact", center: Estimate = None, **options) -> Estimate:
+    """Median absolute deviation of ``data`` from its median (or ``center``)."""
+    if center is None:
+        center = median(data, method, **options)
+    flat = np.asarray(data).ravel()
+    nsamples = options.get("nsamples", DEFAULT_SAMPLES)
+    if method == "sampled" and flat.size > nsamples:
+        # Only the deviations of a sample, drawn as for the median.
+        sample = flat[np.random.default_rng(options.get("seed", 0)).integers(0, flat.size, nsamples)]
+        deviation = _sampled(np.abs(sample - center.value), 50.0)
+    else:
+        deviation = percentile(np.abs(flat - center.value), 50.0, method, **options)
+    return Estimate(deviation.value, deviation.error + center.error)
+
+
+def image_statistics(image: np.ndarray, method: str = "exact", **options) -> dict:
+    """QC statistics of a product: MEDIAN and MAD, with MEDIAN ERR and MAD ERR when approximated."""
+    center = median(image, method, **options)
+    deviation = mad(image, method, center, **options)
+    qc = {"MEDIAN": center.value, "MAD": deviation.value}
+    if method != "exact":
+        qc["MEDIAN ERR"] = center.error
+        qc["MAD ERR"] = deviation.error
+    return qc
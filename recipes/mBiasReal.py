@@ -5,6 +5,14 @@ import cpl.drs
 
 from typing import Any, Dict
 
+from figl_cache import DEFAULT_CACHE_SIZE, ProductCache
+from figl_instrument import Stages
+from figl_io import DEFAULT_QUANTIZE, compress_product
+from figl_stacking import (
+    DEFAULT_KAPPA, DEFAULT_MEMORY_LIMIT, DEFAULT_NITER, DEFAULT_PREFETCH, PRECISIONS, LoadStats, stack_frames,
+)
+from figl_stats import METHODS, image_statistics
+
 class BiasProcess(cpl.ui.PyRecipe):
     _name = "bias_processor"
     _version = "0.1"
@@ -22,7 +30,94 @@ class BiasProcess(cpl.ui.PyRecipe):
                     context = "mbias",
                     description = "Method used for averaging",
                     default = "mean",
-                    alternatives = ("mean", "median"),
+                    alternatives = ("mean", "median", "sigclip"),
+                ),
+                cpl.ui.ParameterValue(
+                    name = "mbias.stacking.memory",
+                    context = "mbias",
+                    description = "Memory budget for stacking in MB",
+                    default = DEFAULT_MEMORY_LIMIT,
+                ),
+                cpl.ui.ParameterValue(
+                    name = "mbias.stacking.histogram",
+                    context = "mbias",
+                    description = "Median of integer raw frames from per-pixel histograms: a fixed 1 KB of memory per pixel instead of 2 bytes per frame and pixel, for stacks too large for mbias.stacking.memory, at about 1.6 times the time",
+                    default = False,
+                ),
+                cpl.ui.ParameterValue(
+                    name = "mbias.prefetch",
+                    context = "mbias",
+                    description = "Number of frames read ahead on background threads while processing, 0 reads them synchronously",
+                    default = DEFAULT_PREFETCH,
+                ),
+                cpl.ui.ParameterValue(
+                    name = "mbias.sigclip.kappa",
+                    context = "mbias",
+                    description = "Rejection threshold of the sigclip method in standard deviations",
+                    default = DEFAULT_KAPPA,
+                ),
+                cpl.ui.ParameterValue(
+                    name = "mbias.sigclip.niter",
+                    context = "mbias",
+                    description = "Number of clipping passes of the sigclip method",
+                    default = DEFAULT_NITER,
+                ),
+                cpl.ui.ParameterValue(
+                    name = "mbias.cache.dir",
+                    context = "mbias",
+                    description = "Directory of the product cache, empty to disable caching",
+                    default = "",
+                ),
+                cpl.ui.ParameterValue(
+                    name = "mbias.cache.size",
+                    context = "mbias",
+                    description = "Size limit of the product cache in MB",
+                    default = DEFAULT_CACHE_SIZE,
+                ),
+                cpl.ui.ParameterValue(
+                    name = "mbias.cache.invalidate",
+                    context = "mbias",
+                    description = "Discard a cached product for these inputs and rebuild it",
+                    default = False,
+                ),
+                cpl.ui.ParameterEnum(
+                    name = "mbias.precision",
+                    context = "mbias",
+                    description = "Pixel precision: double, or single to keep raw frames as integers until the bias is subtracted and compute and save in float32",
+                    default = "double",
+                    alternatives = ("double", "single"),
+                ),
+                cpl.ui.ParameterEnum(
+                    name = "mbias.statistics",
+                    context = "mbias",
+                    description = "Estimator of the QC median and MAD of the master (written with mbias.qc.statistics): exact, or the sampled or histogram approximation, whose error bound is written as a QC ERR keyword",
+                    default = "exact",
+                    alternatives = METHODS,
+                ),
+                cpl.ui.ParameterValue(
+                    name = "mbias.qc.statistics",
+                    context = "mbias",
+                    description = "Write the median and MAD of the master as QC MEDIAN and MAD keywords",
+                    default = False,
+                ),
+                cpl.ui.ParameterEnum(
+                    name = "mbias.output.compression",
+                    context = "mbias",
+                    description = "Tile compression of the product: none, rice or gzip. Integer images are compressed losslessly, float images are quantised unless mbias.output.quantize is 0",
+                    default = "none",
+                    alternatives = ("none", "rice", "gzip"),
+                ),
+                cpl.ui.ParameterValue(
+                    name = "mbias.output.quantize",
+                    context = "mbias",
+                    description = "Quantisation of compressed float products in levels per noise sigma, 0 for lossless",
+                    default = DEFAULT_QUANTIZE,
+                ),
+                cpl.ui.ParameterValue(
+                    name = "mbias.instrument",
+                    context = "mbias",
+                    description = "Record the time and memory of each processing stage as QC keywords and a JSON sidecar",
+                    default = False,
                 ),
             )
         )
@@ -61,8 +156,26 @@ class BiasProcess(cpl.ui.PyRecipe):
                   f"No raw frames in frameset."
              )
 
+        cache = ProductCache.from_parameters(self.parameters, "mbias")
+        if cache:
+            cache_key = cache.key(self.name, self.version, frameset, self.parameters)
+            if self.parameters["mbias.cache.invalidate"].value:
+                cpl.core.Msg.info(self.name, f"Discarding cached product {cache_key}.")
+                cache.invalidate(cache_key)
+            elif cache.fetch(cache_key, output_file):
+                cpl.core.Msg.info(self.name, f"Using cached product {cache_key} as {output_file!r}.")
+                product_frames.append(
+                    cpl.ui.Frame(
+                        file=output_file,
+                        tag="MASTER_BIAS",
+                        group=cpl.ui.Frame.FrameGroup.CALIB,
+                    )
+                )
+                return product_frames
+
+        stages = Stages.from_parameters(self.parameters, "mbias")
         header = None
-        processed_bias_images = cpl.core.ImageList()
+        raw_bias_files = []
 
         for idx, frame in enumerate(raw_bias_frames):
             cpl.core.Msg.info(self.name, f"Processing {frame.file!r}...")
@@ -70,47 +183,67 @@ class BiasProcess(cpl.ui.PyRecipe):
             if idx == 0:
                 header = cpl.core.PropertyList.load(frame.file, 0)
 
-            cpl.core.Msg.debug(self.name, f"Loading bias image {idx}...")
-            raw_bias_image = cpl.core.Image.load(frame.file)
-
-            processed_bias_images.insert(idx, raw_bias_image)
+            raw_bias_files.append(frame.file)
 
         method = self.parameters["mbias.stacking.method"].value
+        memory_limit = self.parameters["mbias.stacking.memory"].value
+        kappa = self.parameters["mbias.sigclip.kappa"].value
+        niter = self.parameters["mbias.sigclip.niter"].value
+        dtype = PRECISIONS[self.parameters["mbias.precision"].value]
+        prefetch = self.parameters["mbias.prefetch"].value
+        histogram = self.parameters["mbias.stacking.histogram"].value
+        load_stats = LoadStats()
+        qc = {}
         cpl.core.Msg.info(self.name, f"Combining bias images using method {method!r}")
 
-        combined_image = None
-
-        if method == "mean":
-             combined_image = processed_bias_images.collapse_create()
-        
-        elif method == "median":
-             combined_image = processed_bias_images.collapse_median_create()
-        
-        else:
+        try:
+            combined = stack_frames(
+                raw_bias_files, method, memory_limit, kappa=kappa, niter=niter, qc=qc, stages=stages,
+                dtype=dtype, prefetch=prefetch, load_stats=load_stats, integer_median=histogram,
+            )
+        except ValueError as err:
             cpl.core.Msg.error(
                   self.name,
-                  f"Got unknown stacking method {method!r}. Stopping..."
+                  f"{err} Stopping..."
             )
             return product_frames
-        
+        cpl.core.Msg.info(self.name, load_stats.summary())
+        combined_image = cpl.core.Image(combined)
+        if self.parameters["mbias.qc.statistics"].value:
+            qc.update(image_statistics(combined, self.parameters["mbias.statistics"].value))
+
         product_properties = cpl.core.PropertyList()
+        for key, value in qc.items():
+            product_properties.append(cpl.core.Property(f"ESO QC {key}", value))
+        for key, value in stages.qc_properties():
+            product_properties.append(cpl.core.Property(key, value))
         product_properties.append(
              cpl.core.Property("ESO PRO CATG", cpl.core.Type.STRING, r"OBJECT_REDUCED")
         )
 
         cpl.core.Msg.info(self.name, f"Saving product file as {output_file!r}.")
 
-        cpl.dfs.save_image(
-            frameset,
-            self.parameters,
-            frameset,
-            combined_image,
-            self.name,
-            product_properties,
-            f"demo/{self.version!r}",
-            output_file,
-            header=header,
-        )
+        with stages.stage("save"):
+            cpl.dfs.save_image(
+                frameset,
+                self.parameters,
+                frameset,
+                combined_image,
+                self.name,
+                product_properties,
+                f"demo/{self.version!r}",
+                output_file,
+                header=header,
+            )
+            compress_product(
+                output_file,
+                self.parameters["mbias.output.compression"].value,
+                self.parameters["mbias.output.quantize"].value,
+            )
+        stages.write_sidecar(output_file, recipe=self.name, frames=len(raw_bias_files))
+
+        if cache:
+            cache.store(cache_key, output_file)
 
         product_frames.append(
             cpl.ui.Frame(
@@ -2,10 +2,21 @@ import cpl.core
 import cpl.ui
 import cpl.dfs
 import cpl.drs
-import re
 
 from typing import Any, Dict
 
+import numpy as np
+
+from figl_cache import DEFAULT_CACHE_SIZE, ProductCache
+from figl_calib import read_master
+from figl_functions import read_header
+from figl_instrument import Stages
+from figl_io import DEFAULT_QUANTIZE, compress_product
+from figl_stacking import (
+    DEFAULT_KAPPA, DEFAULT_MEMORY_LIMIT, DEFAULT_NITER, DEFAULT_PREFETCH, PRECISIONS, LoadStats, stack_frames,
+)
+from figl_stats import METHODS, image_statistics
+
 class DarkProcess(cpl.ui.PyRecipe):
     _name = "dark_processor"
     _version = "0.1"
@@ -23,7 +34,94 @@ class DarkProcess(cpl.ui.PyRecipe):
                     context = "mdark",
                     description = "Method used for averaging",
                     default = "mean",
-                    alternatives = ("mean", "median"),
+                    alternatives = ("mean", "median", "sigclip"),
+                ),
+                cpl.ui.ParameterValue(
+                    name = "mdark.stacking.memory",
+                    context = "mdark",
+                    description = "Memory budget for stacking in MB",
+                    default = DEFAULT_MEMORY_LIMIT,
+                ),
+                cpl.ui.ParameterValue(
+                    name = "mdark.stacking.histogram",
+                    context = "mdark",
+                    description = "Median of integer raw frames from per-pixel histograms: a fixed 1 KB of memory per pixel instead of 2 bytes per frame and pixel, for stacks too large for mdark.stacking.memory, at about 1.6 times the time",
+                    default = False,
+                ),
+                cpl.ui.ParameterValue(
+                    name = "mdark.prefetch",
+                    context = "mdark",
+                    description = "Number of frames read ahead on background threads while processing, 0 reads them synchronously",
+                    default = DEFAULT_PREFETCH,
+                ),
+                cpl.ui.ParameterValue(
+                    name = "mdark.sigclip.kappa",
+                    context = "mdark",
+                    description = "Rejection threshold of the sigclip method in standard deviations",
+                    default = DEFAULT_KAPPA,
+                ),
+                cpl.ui.ParameterValue(
+                    name = "mdark.sigclip.niter",
+                    context = "mdark",
+                    description = "Number of clipping passes of the sigclip method",
+                    default = DEFAULT_NITER,
+                ),
+                cpl.ui.ParameterValue(
+                    name = "mdark.cache.dir",
+                    context = "mdark",
+                    description = "Directory of the product cache, empty to disable caching",
+                    default = "",
+                ),
+                cpl.ui.ParameterValue(
+                    name = "mdark.cache.size",
+                    context = "mdark",
+                    description = "Size limit of the product cache in MB",
+                    default = DEFAULT_CACHE_SIZE,
+                ),
+                cpl.ui.ParameterValue(
+                    name = "mdark.cache.invalidate",
+                    context = "mdark",
+                    description = "Discard a cached product for these inputs and rebuild it",
+                    default = False,
+                ),
+                cpl.ui.ParameterEnum(
+                    name = "mdark.precision",
+                    context = "mdark",
+                    description = "Pixel precision: double, or single to keep raw frames as integers until the bias is subtracted and compute and save in float32",
+                    default = "double",
+                    alternatives = ("double", "single"),
+                ),
+                cpl.ui.ParameterEnum(
+                    name = "mdark.statistics",
+                    context = "mdark",
+                    description = "Estimator of the QC median and MAD of the master (written with mdark.qc.statistics): exact, or the sampled or histogram approximation, whose error bound is written as a QC ERR keyword",
+                    default = "exact",
+                    alternatives = METHODS,
+                ),
+                cpl.ui.ParameterValue(
+                    name = "mdark.qc.statistics",
+                    context = "mdark",
+                    description = "Write the median and MAD of the master as QC MEDIAN and MAD keywords",
+                    default = False,
+                ),
+                cpl.ui.ParameterEnum(
+                    name = "mdark.output.compression",
+                    context = "mdark",
+                    description = "Tile compression of the product: none, rice or gzip. Integer images are compressed losslessly, float images are quantised unless mdark.output.quantize is 0",
+                    default = "none",
+                    alternatives = ("none", "rice", "gzip"),
+                ),
+                cpl.ui.ParameterValue(
+                    name = "mdark.output.quantize",
+                    context = "mdark",
+                    description = "Quantisation of compressed float products in levels per noise sigma, 0 for lossless",
+                    default = DEFAULT_QUANTIZE,
+                ),
+                cpl.ui.ParameterValue(
+                    name = "mdark.instrument",
+                    context = "mdark",
+                    description = "Record the time and memory of each processing stage as QC keywords and a JSON sidecar",
+                    default = False,
                 ),
             )
         )
@@ -40,8 +138,6 @@ class DarkProcess(cpl.ui.PyRecipe):
         
         output_file = "MASTER_DARK.fits"
 
-        pattern = r'value\s+:\s+(\d+)'
-        
         raw_Dark_Frames = cpl.ui.FrameSet()
         bias_frame = None
         match = None
@@ -68,52 +164,114 @@ class DarkProcess(cpl.ui.PyRecipe):
                 f"No raw frames in frameset."
             )
 
-        processed_dark_images = cpl.core.ImageList()
+        if bias_frame is None:
+            cpl.core.Msg.error(
+                self.name,
+                f"No master bias in frameset. Stopping..."
+            )
+            return product_frames
 
-        if bias_frame:
-            bias_image = cpl.core.Image.load(bias_frame.file)
+        cache = ProductCache.from_parameters(self.parameters, "mdark")
+        if cache:
+            cache_key = cache.key(self.name, self.version, frameset, self.parameters)
+            if self.parameters["mdark.cache.invalidate"].value:
+                cpl.core.Msg.info(self.name, f"Discarding cached product {cache_key}.")
+                cache.invalidate(cache_key)
+            elif cache.fetch(cache_key, output_file):
+                cpl.core.Msg.info(self.name, f"Using cached product {cache_key} as {output_file!r}.")
+                product_frames.append(
+                    cpl.ui.Frame(
+                        file=output_file,
+                        tag="MASTER_DARK",
+                        group=cpl.ui.Frame.FrameGroup.CALIB,
+                    )
+                )
+                return product_frames
+
+        stages = Stages.from_parameters(self.parameters, "mdark")
+        raw_dark_files = []
+        precision = self.parameters["mdark.precision"].value
+        dtype = PRECISIONS[precision]
+
+        with stages.stage("load"):
+            bias_image = read_master(bias_frame.file, dtype)
 
         for idx, frame in enumerate(raw_Dark_Frames):
             cpl.core.Msg.info(self.name, f"Processing {frame.file!r}...")
             if idx == 0:
-                exp_time_list = cpl.core.PropertyList.load_regexp(frame.file, 0, "EXPTIME", False)
-                exp_time = exp_time_list.dump(show=False)
-                match_exp = float(re.search(pattern, exp_time).group(1)) # type: ignore
-            cpl.core.Msg.debug(self.name, f"Loading dark image {idx}...")
-            raw_dark_image = cpl.core.Image.load(frame.file)
+                match_exp = read_header(frame.file).exptime
+            raw_dark_files.append(frame.file)
 
-            raw_dark_image.subtract(bias_image)
-
-            processed_dark_images.insert(idx, raw_dark_image)
+        def subtract_bias(idx, band, y0, y1):
+            if band.dtype == dtype:
+                band -= bias_image[y0:y1]
+                return band
+            # Integer raw band in single precision.
+            return np.subtract(band, bias_image[y0:y1], dtype=dtype)
 
         method = self.parameters["mdark.stacking.method"].value
+        memory_limit = self.parameters["mdark.stacking.memory"].value
+        kappa = self.parameters["mdark.sigclip.kappa"].value
+        niter = self.parameters["mdark.sigclip.niter"].value
+        prefetch = self.parameters["mdark.prefetch"].value
+        histogram = self.parameters["mdark.stacking.histogram"].value
+        load_stats = LoadStats()
+        qc = {}
 
         cpl.core.Msg.info(self.name, f"Combining dark images using method {method!r}")
 
-        if method == "mean":
-            combined_image = processed_dark_images.collapse_create()
-        elif method == "median":
-            combined_image = processed_dark_images.collapse_median_create()
-
-        combined_image.divide_scalar(match_exp) # type: ignore
+        if method == "median":
+            # The median commutes with subtracting the bias, so the raw frames
+            # are combined first, as integers (see stack_frames), and the bias is
+            # subtracted once from the result.
+            combined = stack_frames(
+                raw_dark_files, method, memory_limit, qc=qc, stages=stages,
+                dtype=dtype, prefetch=prefetch, load_stats=load_stats, integer_median=histogram,
+            )
+            combined -= bias_image
+        else:
+            combined = stack_frames(
+                raw_dark_files, method, memory_limit, calibrate=subtract_bias,
+                kappa=kappa, niter=niter, qc=qc, stages=stages,
+                dtype=dtype, native=precision == "single", prefetch=prefetch, load_stats=load_stats,
+            )
+        cpl.core.Msg.info(self.name, load_stats.summary())
+        combined /= match_exp
+        combined_image = cpl.core.Image(combined)
+        if self.parameters["mdark.qc.statistics"].value:
+            qc.update(image_statistics(combined, self.parameters["mdark.statistics"].value))
 
         product_properties = cpl.core.PropertyList()
+        for key, value in qc.items():
+            product_properties.append(cpl.core.Property(f"ESO QC {key}", value))
+        for key, value in stages.qc_properties():
+            product_properties.append(cpl.core.Property(key, value))
         product_properties.append(
             cpl.core.Property("ESO PRO CATG", cpl.core.Type.STRING, r"OBJECT_REDUCED")
         )
 
         cpl.core.Msg.info(self.name, f"Saving product file as {output_file!r}.")
 
-        cpl.dfs.save_image(
-            frameset,
-            self.parameters,
-            frameset,
-            combined_image,
-            self.name,
-            product_properties,
-            f"demo/{self.version!r}",
-            output_file,
-        )
+        with stages.stage("save"):
+            cpl.dfs.save_image(
+                frameset,
+                self.parameters,
+                frameset,
+                combined_image,
+                self.name,
+                product_properties,
+                f"demo/{self.version!r}",
+                output_file,
+            )
+            compress_product(
+                output_file,
+                self.parameters["mdark.output.compression"].value,
+                self.parameters["mdark.output.quantize"].value,
+            )
+        stages.write_sidecar(output_file, recipe=self.name, frames=len(raw_dark_files))
+
+        if cache:
+            cache.store(cache_key, output_file)
 
         product_frames.append(
             cpl.ui.Frame(
@@ -2,10 +2,22 @@ import cpl.core
 import cpl.ui
 import cpl.dfs
 import cpl.drs
-import re
 
 from typing import Any, Dict
 
+import numpy as np
+
+from figl_cache import DEFAULT_CACHE_SIZE, ProductCache
+from figl_calib import DarkScaler, read_master
+from figl_functions import read_header
+from figl_instrument import Stages
+from figl_io import DEFAULT_QUANTIZE, compress_product
+from figl_stacking import (
+    DEFAULT_MEMORY_LIMIT, DEFAULT_PREFETCH, PRECISIONS, FrameSource, LoadStats, image_shape, prefetch_depth,
+    read_image, stack_frames,
+)
+from figl_stats import METHODS, image_statistics, median
+
 class FlatProcess(cpl.ui.PyRecipe):
     _name = "flat_processor"
     _version = "0.1"
@@ -26,6 +38,75 @@ class FlatProcess(cpl.ui.PyRecipe):
                     default = "mean",
                     alternatives = ("mean", "median"),
                 ),
+                cpl.ui.ParameterValue(
+                    name = "mflat.stacking.memory",
+                    context = "mflat",
+                    description = "Memory budget for stacking in MB",
+                    default = DEFAULT_MEMORY_LIMIT,
+                ),
+                cpl.ui.ParameterValue(
+                    name = "mflat.prefetch",
+                    context = "mflat",
+                    description = "Number of frames read ahead on background threads while processing, 0 reads them synchronously",
+                    default = DEFAULT_PREFETCH,
+                ),
+                cpl.ui.ParameterValue(
+                    name = "mflat.cache.dir",
+                    context = "mflat",
+                    description = "Directory of the product cache, empty to disable caching",
+                    default = "",
+                ),
+                cpl.ui.ParameterValue(
+                    name = "mflat.cache.size",
+                    context = "mflat",
+                    description = "Size limit of the product cache in MB",
+                    default = DEFAULT_CACHE_SIZE,
+                ),
+                cpl.ui.ParameterValue(
+                    name = "mflat.cache.invalidate",
+                    context = "mflat",
+                    description = "Discard a cached product for these inputs and rebuild it",
+                    default = False,
+                ),
+                cpl.ui.ParameterEnum(
+                    name = "mflat.precision",
+                    context = "mflat",
+                    description = "Pixel precision: double, or single to keep raw frames as integers until the bias is subtracted and compute and save in float32",
+                    default = "double",
+                    alternatives = ("double", "single"),
+                ),
+                cpl.ui.ParameterEnum(
+                    name = "mflat.statistics",
+                    context = "mflat",
+                    description = "Estimator of the normalisation medians of the flats and the QC median and MAD of the master (written with mflat.qc.statistics): exact, or the sampled or histogram approximation, whose error bound is written as a QC ERR keyword",
+                    default = "exact",
+                    alternatives = METHODS,
+                ),
+                cpl.ui.ParameterValue(
+                    name = "mflat.qc.statistics",
+                    context = "mflat",
+                    description = "Write the median and MAD of the master as QC MEDIAN and MAD keywords",
+                    default = False,
+                ),
+                cpl.ui.ParameterEnum(
+                    name = "mflat.output.compression",
+                    context = "mflat",
+                    description = "Tile compression of the product: none, rice or gzip. Integer images are compressed losslessly, float images are quantised unless mflat.output.quantize is 0",
+                    default = "none",
+                    alternatives = ("none", "rice", "gzip"),
+                ),
+                cpl.ui.ParameterValue(
+                    name = "mflat.output.quantize",
+                    context = "mflat",
+                    description = "Quantisation of compressed float products in levels per noise sigma, 0 for lossless",
+                    default = DEFAULT_QUANTIZE,
+                ),
+                cpl.ui.ParameterValue(
+                    name = "mflat.instrument",
+                    context = "mflat",
+                    description = "Record the time and memory of each processing stage as QC keywords and a JSON sidecar",
+                    default = False,
+                ),
             )
         )
 
@@ -47,8 +128,6 @@ class FlatProcess(cpl.ui.PyRecipe):
         dark_frame = None
         product_frames = cpl.ui.FrameSet()
 
-        pattern = r'value\s+:\s+(\d+)'
-
         for frame in frameset:
             if frame.tag == "CHOSEN_FLAT":
                 cpl.core.Msg.debug(self.name, f"Got raw flat frame: {frame.file}.")
@@ -73,62 +152,140 @@ class FlatProcess(cpl.ui.PyRecipe):
                 self.name,
                 f"No raw frames in frameset."
             )
+
+        cache = ProductCache.from_parameters(self.parameters, "mflat")
+        if cache:
+            cache_key = cache.key(self.name, self.version, frameset, self.parameters)
+            if self.parameters["mflat.cache.invalidate"].value:
+                cpl.core.Msg.info(self.name, f"Discarding cached product {cache_key}.")
+                cache.invalidate(cache_key)
+            elif cache.fetch(cache_key, output_file):
+                cpl.core.Msg.info(self.name, f"Using cached product {cache_key} as {output_file!r}.")
+                product_frames.append(
+                    cpl.ui.Frame(
+                        file=output_file,
+                        tag="MASTER_FLAT",
+                        group=cpl.ui.Frame.FrameGroup.CALIB,
+                    )
+                )
+                return product_frames
         
-        processed_flat_images = cpl.core.ImageList()
+        stages = Stages.from_parameters(self.parameters, "mflat")
+        raw_flat_files = []
+        exptimes = []
+        medians = []
+        precision = self.parameters["mflat.precision"].value
+        dtype = PRECISIONS[precision]
+        # In single precision the raw flats stay integers until the bias is subtracted.
+        raw_dtype = None if precision == "single" else dtype
 
         cpl.core.Msg.warning(
             self.name,
             f"Loading calib files."
         )
 
-        if bias_frame:
-            bias_image = cpl.core.Image.load(bias_frame.file)
+        with stages.stage("load"):
+            if bias_frame:
+                bias_image = read_master(bias_frame.file, dtype)
+
+            if dark_frame:
+                dark_image = read_master(dark_frame.file, dtype)
 
-        if dark_frame:
-            dark_image = cpl.core.Image.load(dark_frame.file)
+        # Bias plus the dark scaled to each flat's own exposure time.
+        offsets = DarkScaler(dark_image, bias_image)
 
-        for idx, frame in enumerate(raw_flat_frames):
-            if idx == 0:
-                exp_time_list = cpl.core.PropertyList.load_regexp(frame.file, 0, "EXPTIME", False)
-                exp_time = exp_time_list.dump(show=True)
-                match_exp = float(re.search(pattern, exp_time).group(1)) # type: ignore
-                dark_image.multiply_scalar(match_exp)
-            raw_flat_image = cpl.core.Image.load(frame.file)
+        def subtract_offset(image, offset):
+            # In place for float images, into a new dtype array for integer raws.
+            return np.subtract(image, offset, out=image if image.dtype == dtype else None, dtype=dtype)
 
-            raw_flat_image.subtract(bias_image)
-            raw_flat_image.subtract(dark_image)
-            median = raw_flat_image.get_median()
-            raw_flat_image.divide_scalar(median)
-            processed_flat_images.insert(idx, raw_flat_image)
+        for frame in raw_flat_frames:
+            raw_flat_files.append(frame.file)
+            exptimes.append(read_header(frame.file).exptime)
 
-        combined_image = None
+        missing = [file for file, exptime in zip(raw_flat_files, exptimes) if exptime is None]
+        if missing:
+            cpl.core.Msg.error(
+                self.name,
+                f"No EXPTIME in {', '.join(missing)}, the dark cannot be scaled to it. Stopping..."
+            )
+            return product_frames
+
+        memory_limit = self.parameters["mflat.stacking.memory"].value
+        prefetch = self.parameters["mflat.prefetch"].value
+        load_stats = LoadStats()
+
+        def load_flat(idx):
+            with stages.stage("load"):
+                return read_image(raw_flat_files[idx], raw_dtype)
+
+        # The normalisation needs the median of the whole calibrated frame,
+        # so it is measured one frame at a time before stacking, with the
+        # next whole frames read ahead as far as the memory budget allows.
+        ny, nx = image_shape(raw_flat_files[0])
+        depth = prefetch_depth(ny * nx * np.dtype(dtype).itemsize, memory_limit, prefetch)
+        statistics = self.parameters["mflat.statistics"].value
+        norm_error = 0.0
+        for idx, raw_flat_image in enumerate(FrameSource(load_flat, len(raw_flat_files), depth, stats=load_stats)):
+            with stages.stage("normalise"):
+                raw_flat_image = subtract_offset(raw_flat_image, offsets.scaled(exptimes[idx]))
+                level = median(raw_flat_image, statistics)
+                medians.append(level.value)
+                norm_error = max(norm_error, level.error / abs(level.value))
+            del raw_flat_image
+
+        def calibrate(idx, band, y0, y1):
+            band = subtract_offset(band, offsets.scaled(exptimes[idx])[y0:y1])
+            band /= medians[idx]
+            return band
 
         method = self.parameters["mflat.stacking.method"].value
 
         cpl.core.Msg.info(self.name, f"Combining dark images using method {method!r}")
 
-        if method == "mean":
-            combined_image = processed_flat_images.collapse_create()
-        elif method == "median":
-            combined_image = processed_flat_images.collapse_median_create()
+        combined = stack_frames(
+            raw_flat_files, method, memory_limit, calibrate=calibrate, stages=stages,
+            dtype=dtype, native=precision == "single", prefetch=prefetch, load_stats=load_stats,
+        )
+        cpl.core.Msg.info(self.name, load_stats.summary())
+        combined_image = cpl.core.Image(combined)
+        qc = {}
+        if self.parameters["mflat.qc.statistics"].value:
+            qc.update(image_statistics(combined, statistics))
+        if statistics != "exact":
+            # Largest relative error of the normalisation of a flat.
+            qc["NORM ERR"] = norm_error
 
         product_properties = cpl.core.PropertyList()
         product_properties.append(
             cpl.core.Property("ESO PRO CATG", cpl.core.Type.STRING, r"OBJECT_REDUCED")
         )
+        for key, value in qc.items():
+            product_properties.append(cpl.core.Property(f"ESO QC {key}", value))
+        for key, value in stages.qc_properties():
+            product_properties.append(cpl.core.Property(key, value))
 
         cpl.core.Msg.info(self.name, f"Saving product file as {output_file!r}.")
 
-        cpl.dfs.save_image(
-            frameset,
-            self.parameters,
-            frameset,
-            combined_image,
-            self.name,
-            product_properties,
-            f"demo/{self.version!r}",
-            output_file,
-        )
+        with stages.stage("save"):
+            cpl.dfs.save_image(
+                frameset,
+                self.parameters,
+                frameset,
+                combined_image,
+                self.name,
+                product_properties,
+                f"demo/{self.version!r}",
+                output_file,
+            )
+            compress_product(
+                output_file,
+                self.parameters["mflat.output.compression"].value,
+                self.parameters["mflat.output.quantize"].value,
+            )
+        stages.write_sidecar(output_file, recipe=self.name, frames=len(raw_flat_files))
+
+        if cache:
+            cache.store(cache_key, output_file)
 
         product_frames.append(
             cpl.ui.Frame(
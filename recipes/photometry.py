@@ -2,12 +2,17 @@ import cpl.core
 import cpl.ui
 import cpl.dfs
 import cpl.drs
-import re
 
 from typing import Any, Dict
 
 import numpy as np
 
+from figl_functions import read_header
+from figl_instrument import Stages
+from figl_io import image_extension, write_table_columns
+from figl_phot import aperture_photometry, instrumental_magnitude
+from figl_stacking import read_image
+
 
 class Photometry(cpl.ui.PyRecipe):
     _name = "photometry"
@@ -16,7 +21,7 @@ class Photometry(cpl.ui.PyRecipe):
     _email = "benjamin.eisele0101@gmail.com"
     _copyright = "GPL-3.0-or-later"
     _synopsis = "Basic photometry analysis"
-    _description = "This recipe calculates the magnitude of the star via aperture photometry."
+    _description = "This recipe measures the magnitudes of all stars in the science frames via aperture photometry."
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -27,80 +32,162 @@ class Photometry(cpl.ui.PyRecipe):
                     description = "Test Parameter",
                     default = "Test"
                 ),
+                cpl.ui.ParameterValue(
+                    name = "phot.detect.sigma",
+                    context = "phot",
+                    description = "Detection threshold in sigma for the source list",
+                    default = 32.0
+                ),
+                cpl.ui.ParameterValue(
+                    name = "phot.aperture.radius",
+                    context = "phot",
+                    description = "Radius of the photometric aperture in pixels",
+                    default = 8.0
+                ),
+                cpl.ui.ParameterValue(
+                    name = "phot.annulus.inner",
+                    context = "phot",
+                    description = "Inner radius of the sky annulus in pixels",
+                    default = 12.0
+                ),
+                cpl.ui.ParameterValue(
+                    name = "phot.annulus.outer",
+                    context = "phot",
+                    description = "Outer radius of the sky annulus in pixels",
+                    default = 18.0
+                ),
+                cpl.ui.ParameterValue(
+                    name = "phot.instrument",
+                    context = "phot",
+                    description = "Record the time and memory of each processing stage as QC keywords and a JSON sidecar",
+                    default = False
+                ),
             ),
         )
 
     def run(self, frameset: cpl.ui.FrameSet, settings: Dict[str, Any]) -> cpl.ui.FrameSet:
+        for key, value in settings.items():
+            try:
+                self.parameters[key].value = value
+            except KeyError:
+                cpl.core.Msg.warning(
+                    self._name,
+                    f"Settings includes {key}:{value} but {self} has no parameter named {key}.",
+                )
 
-        output_file = "SCIENCE_FRAME.fits"
+        output_file = "PHOTOMETRY.fits"
         output_frame = cpl.ui.FrameSet()
 
-        pattern_doub = r'value\s+:\s+(\d+)'
-        pattern_strg = r"value\s+:\s+'(\w+)'"
-        pattern_fil = r"value\s+:\s+'(\w+\s\w)'"
-        
-        # Assume the brightest Standard star is used
+        sigma = self.parameters["phot.detect.sigma"].value
+        radius = self.parameters["phot.aperture.radius"].value
+        inner = self.parameters["phot.annulus.inner"].value
+        outer = self.parameters["phot.annulus.outer"].value
+        stages = Stages.from_parameters(self.parameters, "phot")
+
+        ZP = None
+        science_frames = []
 
         for frame in frameset:
             frame.group = cpl.ui.Frame.FrameGroup.RAW
             if frame.tag == "STANDARD_FRAME":
                 cpl.core.Msg.debug(self.name, f"Got standard frame: {frame.file}")
-                zp_list = cpl.core.PropertyList.load_regexp(frame.file, 0, "ZEROPOINT", False)
-                zp_val = zp_list.dump(show=False)
-                zp_match = float(re.search(pattern_doub, zp_val).group(1)) # type: ignore
-                ZP = zp_match
-        for frame in frameset:
-            frame.group = cpl.ui.Frame.FrameGroup.RAW
-            if frame.tag == "SCIENCE_FRAME":
+                ZP = read_header(frame.file).zeropoint
+            elif frame.tag == "SCIENCE_FRAME":
                 cpl.core.Msg.debug(self.name, f"Got science frame: {frame.file}")
-                obj_typ_list = cpl.core.PropertyList.load_regexp(frame.file, 0, "OBJTYP", False)
-                obj_typ = obj_typ_list.dump(show=False)
-                match_obj = re.search(pattern_strg, obj_typ).group(1) # type: ignore
-                exp_time_list = cpl.core.PropertyList.load_regexp(frame.file, 0, "EXPTIME", False)
-                exp_time = cpl.core.PropertyList.dump(exp_time_list, show=False)
-                match_exp = float(re.search(pattern_doub, exp_time).group(1)) # type: ignore
-            
-                input_image = cpl.core.Image.load(frame.file)
-                cpl.core.Msg.debug(self.name, "Calculating magnitude...")
-                apertures = cpl.drs.Apertures.extract_sigma(input_image, 32.0)
-                apertures.sort_by_flux()
-                brightness = apertures.get_flux(1)
-                filter_typ_list = cpl.core.PropertyList.load_regexp(frame.file, 0, "FILTER", False)
-                filter_typ = filter_typ_list.dump(show=False)
-                match_filter = re.search(pattern_fil, filter_typ).group(1) # type: ignore
-                mag = -2.5 * np.log10(brightness / match_exp) + ZP
-
-                product_properties = cpl.core.PropertyList()
-                product_properties.append(
-                    cpl.core.Property("MAGNITUDE", mag))
-                product_properties.append(
-                    cpl.core.Property("OBJTYP", match_obj))
-                product_properties.append(
-                    cpl.core.Property("EXPTIME", match_exp))
-                product_properties.append(
-                    cpl.core.Property("FILTER", match_filter))
-                product_properties.append(
-                    cpl.core.Property("ESO PRO CATG", cpl.core.Type.STRING, r"OBJECT_REDUCED")) 
-
-                cpl.core.Msg.info(self.name, f"Saving product file as {output_file!r}.")
-
-                cpl.dfs.save_image(
-                    frameset,
-                    self.parameters,
-                    frameset,
-                    input_image,
-                    self.name,
-                    product_properties,
-                    f"demo/{self.version!r}",
-                    output_file,
-                )
+                science_frames.append(frame)
+
+        if len(science_frames) == 0:
+            cpl.core.Msg.error(
+                self.name,
+                f"No science frames in frameset."
+            )
+            return output_frame
+
+        if ZP is None:
+            cpl.core.Msg.warning(self.name, "No zero point available, magnitudes are instrumental.")
+            ZP = 0.0
+
+        # The source list comes from the first frame and is measured at the
+        # same positions in every frame.
+        cpl.core.Msg.info(self.name, f"Detecting sources in {science_frames[0].file!r}...")
+        with stages.stage("load"):
+            detection_image = cpl.core.Image.load(science_frames[0].file, extension=image_extension(science_frames[0].file))
+        with stages.stage("detect"):
+            apertures = cpl.drs.Apertures.extract_sigma(detection_image, sigma)
+            apertures.sort_by_flux()
+        # CPL centroids are 1-based FITS pixel coordinates.
+        x = np.array([apertures.get_centroid_x(ind) for ind in range(1, apertures.size + 1)]) - 1.0
+        y = np.array([apertures.get_centroid_y(ind) for ind in range(1, apertures.size + 1)]) - 1.0
+        cpl.core.Msg.info(self.name, f"Measuring {len(x)} sources in {len(science_frames)} frames.")
+
+        columns = {"FRAME": [], "SOURCE": [], "X": [], "Y": [], "FLUX": [], "SKY": [], "NPIX": [], "MAGNITUDE": []}
+
+        for idx, frame in enumerate(science_frames):
+            header = read_header(frame.file)
+            match_obj = header.objtyp
+            match_exp = header.exptime
+            match_filter = header.filter
+
+            cpl.core.Msg.debug(self.name, "Calculating magnitudes...")
+            with stages.stage("load"):
+                image = read_image(frame.file)
+            with stages.stage("photometry"):
+                measured = aperture_photometry(image, x, y, radius, inner, outer)
+            columns["FRAME"].append(np.full(len(x), idx))
+            columns["SOURCE"].append(np.arange(1, len(x) + 1))
+            columns["X"].append(x + 1.0)
+            columns["Y"].append(y + 1.0)
+            for key in ("FLUX", "SKY", "NPIX"):
+                columns[key].append(measured[key])
+            columns["MAGNITUDE"].append(instrumental_magnitude(measured["FLUX"], match_exp) + ZP)
+
+        columns = {key: np.concatenate(values) for key, values in columns.items()}
+
+        # CPL only saves the table layout and the DFS keywords; the rows are
+        # written column by column with astropy after saving.
+        table = cpl.core.Table.empty(0)
+        for key, values in columns.items():
+            table.new_column(key, cpl.core.Type.INT if values.dtype.kind == "i" else cpl.core.Type.DOUBLE)
+
+        product_properties = cpl.core.PropertyList()
+        product_properties.append(
+            cpl.core.Property("ZEROPOINT", ZP))
+        product_properties.append(
+            cpl.core.Property("NSOURCES", len(x)))
+        product_properties.append(
+            cpl.core.Property("OBJTYP", match_obj))
+        product_properties.append(
+            cpl.core.Property("EXPTIME", match_exp))
+        product_properties.append(
+            cpl.core.Property("FILTER", match_filter))
+        product_properties.append(
+            cpl.core.Property("ESO PRO CATG", cpl.core.Type.STRING, r"PHOTOMETRY_TABLE"))
+        for key, value in stages.qc_properties():
+            product_properties.append(cpl.core.Property(key, value))
+
+        cpl.core.Msg.info(self.name, f"Saving product file as {output_file!r}.")
+
+        with stages.stage("save"):
+            cpl.dfs.save_table(
+                frameset,
+                self.parameters,
+                frameset,
+                table,
+                self.name,
+                product_properties,
+                f"demo/{self.version!r}",
+                output_file,
+            )
+        with stages.stage("table"):
+            write_table_columns(output_file, columns)
+        stages.write_sidecar(output_file, recipe=self.name, frames=len(science_frames))
         output_frame.append(
             cpl.ui.Frame(
                 file=output_file,
-                tag="SCIENCE_FRAME",
+                tag="PHOTOMETRY_TABLE",
                 group=cpl.ui.Frame.FrameGroup.PRODUCT,
                 level=cpl.ui.Frame.FrameLevel.FINAL,
-                frameType=cpl.ui.Frame.FrameType.IMAGE,
+                frameType=cpl.ui.Frame.FrameType.TABLE,
             )
         )
-        return output_frame
\ No newline at end of file
+        return output_frame
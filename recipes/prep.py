@@ -2,9 +2,82 @@ import cpl.core
 import cpl.ui
 import cpl.dfs
 import cpl.drs
-import re
+import json
+import os
+import shutil
+
+from typing import Any, Dict, Tuple
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+import numpy as np
+from astropy.io import fits
+
+from figl_functions import read_header
+from figl_instrument import Stages
+from figl_io import DEFAULT_QUANTIZE, compress_product, image_extension, image_hdu
+
+
+def sampled_noise(file: str, nsamples: int = 30, hsize: int = 6, seed: int = 0) -> Tuple[float, float]:
+    """Noise of a frame from randomly placed windows, read without loading the image.
+
+    Like cpl.drs.detector.get_noise_window, the standard deviation is measured
+    in ``nsamples`` windows of (2 * hsize + 1)^2 pixels. The noise is their
+    median and the error their spread. The windows are placed with a fixed
+    seed so a frame always gets the same score.
+    """
+    size = 2 * hsize + 1
+    rng = np.random.default_rng(seed)
+    with fits.open(file, memmap=False) as hdul:
+        hdu = image_hdu(hdul)
+        ny, nx = hdu.shape
+        ys = rng.integers(0, max(1, ny - size + 1), nsamples)
+        xs = rng.integers(0, max(1, nx - size + 1), nsamples)
+        stdevs = np.array([
+            np.std(hdu.section[y:y + size, x:x + size], dtype=np.float64)
+            for y, x in zip(ys, xs)
+        ])
+    return float(np.median(stdevs)), float(np.std(stdevs))
+
+
+# ioctl request of Linux for a copy-on-write clone of a whole file.
+FICLONE = 0x40049409
+
+
+def _clone(source: str, target: str):
+    with open(source, "rb") as src, open(target, "wb") as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+
+def link_frame(source: str, target: str) -> str:
+    """Emit ``source`` as ``target`` without copying its pixels and return how: clone, symlink or copy.
+
+    Where the file system supports it (btrfs, XFS, ...) ``target`` is a
+    copy-on-write clone, which shares the blocks of the raw frame but is a
+    file of its own: writing to it leaves the raw frame untouched. Otherwise
+    it is a symbolic link, which resolves to the raw frame itself, so
+    writing through it would change the raw data; the recipes only ever load
+    CHOSEN_FLAT frames, and anything else must open them read-only. Where
+    neither is available the frame is copied.
+    """
+    if os.path.lexists(target):
+        os.remove(target)
+    if fcntl is not None:
+        try:
+            _clone(source, target)
+            return "clone"
+        except OSError:
+            os.remove(target)
+    try:
+        os.symlink(os.path.abspath(source), target)
+        return "symlink"
+    except OSError:
+        shutil.copyfile(source, target)
+        return "copy"
 
-from typing import Any, Dict
 
 class RawPrep(cpl.ui.PyRecipe):
     _name = "raw_prep"
@@ -25,6 +98,44 @@ class RawPrep(cpl.ui.PyRecipe):
                     description = "Maximum value of accepted noise",
                     default = 126.0
                 ),
+                cpl.ui.ParameterEnum(
+                    name = "prep.output.mode",
+                    context = "prep",
+                    description = "How flats are emitted: copy writes every flat as a product, link scores all flats from sampled windows first and emits the chosen ones as copy-on-write clones of, or else symbolic links to, the raw files, each with a JSON sidecar holding its NOISE",
+                    default = "copy",
+                    alternatives = ("copy", "link"),
+                ),
+                cpl.ui.ParameterValue(
+                    name = "prep.noise.nsamples",
+                    context = "prep",
+                    description = "Number of windows sampled for the noise estimate in link mode",
+                    default = 30,
+                ),
+                cpl.ui.ParameterValue(
+                    name = "prep.noise.hsize",
+                    context = "prep",
+                    description = "Half size of the noise windows in link mode",
+                    default = 6,
+                ),
+                cpl.ui.ParameterEnum(
+                    name = "prep.output.compression",
+                    context = "prep",
+                    description = "Tile compression of the product: none, rice or gzip. Integer images are compressed losslessly, float images are quantised unless prep.output.quantize is 0",
+                    default = "none",
+                    alternatives = ("none", "rice", "gzip"),
+                ),
+                cpl.ui.ParameterValue(
+                    name = "prep.output.quantize",
+                    context = "prep",
+                    description = "Quantisation of compressed float products in levels per noise sigma, 0 for lossless",
+                    default = DEFAULT_QUANTIZE,
+                ),
+                cpl.ui.ParameterValue(
+                    name = "prep.instrument",
+                    context = "prep",
+                    description = "Record the time and memory of each processing stage as QC keywords and a JSON sidecar",
+                    default = False,
+                ),
             )
         )
     
@@ -41,20 +152,65 @@ class RawPrep(cpl.ui.PyRecipe):
         product_frames = cpl.ui.FrameSet()
 
         output_file = "FLAT.fits"
+        stages = Stages.from_parameters(self.parameters, "prep")
+
+        if self.parameters["prep.output.mode"].value == "link":
+            nsamples = self.parameters["prep.noise.nsamples"].value
+            hsize = self.parameters["prep.noise.hsize"].value
 
-        pattern = r'value\s+:\s+(\d+)'
+            scores = []
+            for idx, frame in enumerate(frameset):
+                if frame.tag == "FLAT":
+                    frame.group = cpl.ui.Frame.FrameGroup.RAW
+                    cpl.core.Msg.debug(self.name, f"Ascertaining noise of frame: {frame.file}.")
+                    with stages.stage("noise"):
+                        noise, error = sampled_noise(frame.file, nsamples, hsize)
+                    scores.append((idx, frame, noise, error))
+
+            for idx, frame, noise, error in scores:
+                if noise >= self.parameters['prep.low.noise'].value:
+                    cpl.core.Msg.info(self.name, f"Rejecting {frame.file!r} with noise {noise:.2f}.")
+                    continue
+                chosen_file = output_file[:4]+f"_{idx}"+output_file[4:]
+                with stages.stage("save"):
+                    how = link_frame(frame.file, chosen_file)
+                cpl.core.Msg.info(self.name, f"Emitted chosen flat {frame.file!r} as {chosen_file!r} ({how}).")
+                # The NOISE keyword of the copy mode, without writing the pixels again.
+                with open(os.path.splitext(chosen_file)[0] + ".json", "w") as sidecar:
+                    json.dump(
+                        {
+                            "FILE": frame.file,
+                            "LINK": how,
+                            "NOISE": noise,
+                            "NOISE ERROR": error,
+                            "EXPTIME": read_header(frame.file).exptime,
+                        },
+                        sidecar,
+                        indent=2,
+                    )
+                product_frames.append(
+                    cpl.ui.Frame(
+                        file=chosen_file,
+                        tag="CHOSEN_FLAT",
+                        group=cpl.ui.Frame.FrameGroup.RAW,
+                    )
+                )
+
+            stages.write_sidecar(
+                output_file, [product.file for product in product_frames], recipe=self.name, frames=len(scores),
+            )
+            return product_frames
 
         for idx, frame in enumerate(frameset):
             if frame.tag == "FLAT":
                 cpl.core.Msg.debug(self.name, f"Got raw flat frame: {frame.file}.")
-                if idx == 0:
-                    exp_time_list = cpl.core.PropertyList.load_regexp(frame.file, 0, "EXPTIME", False)
-                    exp_time = cpl.core.PropertyList.dump(exp_time_list, show=False)
-                    match_exp = float(re.search(pattern, exp_time).group(1)) # type: ignore
+                match_exp = read_header(frame.file).exptime
                 frame.group = cpl.ui.Frame.FrameGroup.RAW
-                raw_flat_image = cpl.core.Image.load(frame.file)
+                with stages.stage("load"):
+                    raw_flat_image = cpl.core.Image.load(frame.file, extension=image_extension(frame.file))
                 cpl.core.Msg.debug(self.name, f"Ascertaining noise of frame: {frame.file}.")
-                noise, error = cpl.drs.detector.get_noise_window(raw_flat_image)
+                with stages.stage("noise"):
+                    noise, error = cpl.drs.detector.get_noise_window(raw_flat_image)
                 product_properties = cpl.core.PropertyList()
                 product_properties.append(
                     cpl.core.Property("NOISE", noise))
@@ -63,17 +219,23 @@ class RawPrep(cpl.ui.PyRecipe):
                 product_properties.append(
                     cpl.core.Property("EXPTIME", match_exp))
                 cpl.core.Msg.info(self.name, f"Saving chosen flat as {output_file!r}.")
-                cpl.dfs.save_image(
-                    frameset,
-                    self.parameters,
-                    frameset,
-                    raw_flat_image,
-                    self.name,
-                    product_properties,
-                    f"demo/{self.version!r}",
-                    output_file[:4]+f"_{idx}"+output_file[4:],
-                    inherit=frame,  
-                )
+                with stages.stage("save"):
+                    cpl.dfs.save_image(
+                        frameset,
+                        self.parameters,
+                        frameset,
+                        raw_flat_image,
+                        self.name,
+                        product_properties,
+                        f"demo/{self.version!r}",
+                        output_file[:4]+f"_{idx}"+output_file[4:],
+                        inherit=frame,  
+                    )
+                    compress_product(
+                        output_file[:4]+f"_{idx}"+output_file[4:],
+                        self.parameters["prep.output.compression"].value,
+                        self.parameters["prep.output.quantize"].value,
+                    )
                 if noise < self.parameters['prep.low.noise'].value:
                     product_frames.append(
                         cpl.ui.Frame(
@@ -91,5 +253,8 @@ class RawPrep(cpl.ui.PyRecipe):
                             )
                         )
 
+        stages.write_sidecar(
+            output_file, [product.file for product in product_frames], recipe=self.name, frames=len(product_frames),
+        )
         return product_frames
     
\ No newline at end of file
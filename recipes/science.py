@@ -2,11 +2,14 @@ import cpl.core
 import cpl.ui
 import cpl.dfs
 import cpl.drs
-import re
 
 from typing import Any, Dict
 
-from numpy import mat
+from figl_calib import CalibrationModel, read_master
+from figl_functions import read_header
+from figl_instrument import Stages
+from figl_io import DEFAULT_QUANTIZE, compress_product
+from figl_stacking import DEFAULT_MEMORY_LIMIT, DEFAULT_PREFETCH, PRECISIONS, LoadStats, stack_frames
 
 class ScienceProcess(cpl.ui.PyRecipe):
     _name = "science_processor"
@@ -28,6 +31,50 @@ class ScienceProcess(cpl.ui.PyRecipe):
                     default = "mean",
                     alternatives = ("mean", "median"),
                 ),
+                cpl.ui.ParameterValue(
+                    name = "mflat.stacking.memory",
+                    context = "mflat",
+                    description = "Memory budget for stacking in MB",
+                    default = DEFAULT_MEMORY_LIMIT,
+                ),
+                cpl.ui.ParameterValue(
+                    name = "science.workers",
+                    context = "science",
+                    description = "Number of frames calibrated in parallel, 1 calibrates them one after another",
+                    default = 1,
+                ),
+                cpl.ui.ParameterValue(
+                    name = "science.prefetch",
+                    context = "science",
+                    description = "Number of frames read ahead on background threads while processing, 0 reads them synchronously",
+                    default = DEFAULT_PREFETCH,
+                ),
+                cpl.ui.ParameterEnum(
+                    name = "science.precision",
+                    context = "science",
+                    description = "Pixel precision: double, or single to keep raw frames as integers until the bias is subtracted and compute and save in float32",
+                    default = "double",
+                    alternatives = ("double", "single"),
+                ),
+                cpl.ui.ParameterEnum(
+                    name = "science.output.compression",
+                    context = "science",
+                    description = "Tile compression of the product: none, rice or gzip. Integer images are compressed losslessly, float images are quantised unless science.output.quantize is 0",
+                    default = "none",
+                    alternatives = ("none", "rice", "gzip"),
+                ),
+                cpl.ui.ParameterValue(
+                    name = "science.output.quantize",
+                    context = "science",
+                    description = "Quantisation of compressed float products in levels per noise sigma, 0 for lossless",
+                    default = DEFAULT_QUANTIZE,
+                ),
+                cpl.ui.ParameterValue(
+                    name = "science.instrument",
+                    context = "science",
+                    description = "Record the time and memory of each processing stage as QC keywords and a JSON sidecar",
+                    default = False,
+                ),
             )
         )
 
@@ -43,15 +90,11 @@ class ScienceProcess(cpl.ui.PyRecipe):
 
         output_file = "SCIENCE_FRAME.fits"
 
-        pattern_strg = r"value\s+:\s+'(\w+)'"
-        pattern_fil = r"value\s+:\s+'(\w+\s\w)'"
-        pattern_doub = r"value\s+:\s+(\d+)"
-
         raw_science_frames = cpl.ui.FrameSet()
         bias_frame = None
         dark_frame = None
         flat_frame = None
-        object_images = cpl.core.ImageList()
+        raw_science_files = []
         object_products = cpl.ui.FrameSet()
 
         method = self.parameters["mflat.stacking.method"].value
@@ -90,36 +133,39 @@ class ScienceProcess(cpl.ui.PyRecipe):
             f"Loading calib files."
         )
 
-        if bias_frame:
-            bias_image = cpl.core.Image.load(bias_frame.file)
-        if dark_frame:
-            dark_image = cpl.core.Image.load(dark_frame.file)
-        if flat_frame:
-            flat_image = cpl.core.Image.load(flat_frame.file)
-
+        stages = Stages.from_parameters(self.parameters, "science")
+        precision = self.parameters["science.precision"].value
+        dtype = PRECISIONS[precision]
+        with stages.stage("load"):
+            if bias_frame:
+                bias_image = read_master(bias_frame.file, dtype)
+            if dark_frame:
+                dark_image = read_master(dark_frame.file, dtype)
+            if flat_frame:
+                flat_image = read_master(flat_frame.file, dtype)
+
+        with stages.stage("calibrate"):
+            model = CalibrationModel(bias_image, dark_image, flat_image, dtype=dtype)
+        exptimes = []
 
         for idx, frame in enumerate(raw_science_frames):
             cpl.core.Msg.info(self.name, f"Processing {frame.file!r}...")
+            header = read_header(frame.file)
             if idx == 0:
-                exp_time_list = cpl.core.PropertyList.load_regexp(frame.file, 0, "EXPTIME", False)
-                exp_time = cpl.core.PropertyList.dump(exp_time_list, show=False)
-                match_exp = float(re.search(pattern_doub, exp_time).group(1)) # type: ignore
-                dark_image.multiply_scalar(match_exp) # type: ignore
-
-            obj_typ_list = cpl.core.PropertyList.load_regexp(frame.file, 0, "OBJTYP", False)
-            obj_typ = obj_typ_list.dump(show=False)
-            match_obj = re.search(pattern_strg, obj_typ).group(1) # type: ignore
-
-            cpl.core.Msg.debug(self.name, f"Loading science image {idx}...")
-            raw_science_image = cpl.core.Image.load(frame.file)
-            cpl.core.Msg.debug(self.name, f"Processing image {idx}...")
-            raw_science_image.subtract(bias_image)
-            raw_science_image.subtract(dark_image)
-            raw_science_image.divide(flat_image)
-            object_images.append(raw_science_image)
-            filter_typ_list = cpl.core.PropertyList.load_regexp(frame.file, 0, "FILTER", False)
-            filter_typ = filter_typ_list.dump(show=False)
-            match_filter = re.search(pattern_fil, filter_typ).group(1) # type: ignore
+                match_exp = header.exptime
+
+            match_obj = header.objtyp
+            raw_science_files.append(frame.file)
+            exptimes.append(header.exptime)
+            match_filter = header.filter
+
+        missing = [file for file, exptime in zip(raw_science_files, exptimes) if exptime is None]
+        if missing:
+            cpl.core.Msg.error(
+                self.name,
+                f"No EXPTIME in {', '.join(missing)}, the dark cannot be scaled to it. Stopping..."
+            )
+            return object_products
 
         product_properties = cpl.core.PropertyList()
         product_properties.append(
@@ -137,24 +183,45 @@ class ScienceProcess(cpl.ui.PyRecipe):
 
         cpl.core.Msg.info(self.name, f"Combining dark images using method {method!r}")
 
-        if method == "mean":
-            combined_object_image = object_images.collapse_create()
+        def calibrate(idx, band, y0, y1):
+            return model.apply(band, y0, y1, exptimes[idx])
+
+        memory_limit = self.parameters["mflat.stacking.memory"].value
+        workers = max(1, self.parameters["science.workers"].value)
+        prefetch = self.parameters["science.prefetch"].value
+        load_stats = LoadStats()
+        if workers > 1:
+            cpl.core.Msg.info(self.name, f"Calibrating frames with {workers} workers.")
+        combined_object_image = cpl.core.Image(
+            stack_frames(
+                raw_science_files, method, memory_limit, calibrate=calibrate, workers=workers,
+                stages=stages, dtype=dtype, native=precision == "single", prefetch=prefetch, load_stats=load_stats,
+            )
+        )
+        cpl.core.Msg.info(self.name, load_stats.summary())
 
-        elif method == "median":
-            combined_object_image = object_images.collapse_median_create()
+        for key, value in stages.qc_properties():
+            product_properties.append(cpl.core.Property(key, value))
 
         cpl.core.Msg.info(self.name, f"Saving product file as {output_file!r}.")
 
-        cpl.dfs.save_image(
-            frameset,
-            self.parameters,
-            frameset,
-            combined_object_image,
-            self.name,
-            product_properties,
-            f"demo/{self.version!r}",
-            output_file,
-        )
+        with stages.stage("save"):
+            cpl.dfs.save_image(
+                frameset,
+                self.parameters,
+                frameset,
+                combined_object_image,
+                self.name,
+                product_properties,
+                f"demo/{self.version!r}",
+                output_file,
+            )
+            compress_product(
+                output_file,
+                self.parameters["science.output.compression"].value,
+                self.parameters["science.output.quantize"].value,
+            )
+        stages.write_sidecar(output_file, recipe=self.name, frames=len(raw_science_files), workers=workers)
 
         object_products.append(
             cpl.ui.Frame(
@@ -2,12 +2,22 @@ import cpl.core
 import cpl.ui
 import cpl.dfs
 import cpl.drs
-import re
 
 from typing import Any, Dict
 
 import numpy as np
 
+from astropy.io import fits
+
+from figl_functions import read_header
+from figl_instrument import Stages
+from figl_io import DEFAULT_QUANTIZE, compress_product, image_extension
+from figl_phot import (
+    CatalogMatcher, aperture_photometry, filter_band, instrumental_magnitude,
+    load_catalog, robust_zero_point,
+)
+from figl_stacking import read_image
+
 
 class Photometry(cpl.ui.PyRecipe):
     _name = "zero_point"
@@ -27,10 +37,79 @@ class Photometry(cpl.ui.PyRecipe):
                     description = "Test Parameter",
                     default = "Test"
                 ),
+                cpl.ui.ParameterValue(
+                    name = "zp.catalog",
+                    context = "zp",
+                    description = "Standard star catalog file, empty to use the brightest star with the built-in Landolt magnitudes",
+                    default = ""
+                ),
+                cpl.ui.ParameterValue(
+                    name = "zp.match.radius",
+                    context = "zp",
+                    description = "Cross-match radius in arcsec, or in pixels for catalogs with X/Y columns",
+                    default = 2.0
+                ),
+                cpl.ui.ParameterValue(
+                    name = "zp.detect.sigma",
+                    context = "zp",
+                    description = "Detection threshold in sigma",
+                    default = 18.0
+                ),
+                cpl.ui.ParameterValue(
+                    name = "zp.aperture.radius",
+                    context = "zp",
+                    description = "Radius of the photometric aperture in pixels",
+                    default = 8.0
+                ),
+                cpl.ui.ParameterValue(
+                    name = "zp.annulus.inner",
+                    context = "zp",
+                    description = "Inner radius of the sky annulus in pixels",
+                    default = 12.0
+                ),
+                cpl.ui.ParameterValue(
+                    name = "zp.annulus.outer",
+                    context = "zp",
+                    description = "Outer radius of the sky annulus in pixels",
+                    default = 18.0
+                ),
+                cpl.ui.ParameterValue(
+                    name = "zp.clip.kappa",
+                    context = "zp",
+                    description = "Clipping threshold of the zero point fit in standard deviations",
+                    default = 3.0
+                ),
+                cpl.ui.ParameterEnum(
+                    name = "zp.output.compression",
+                    context = "zp",
+                    description = "Tile compression of the product: none, rice or gzip. Integer images are compressed losslessly, float images are quantised unless zp.output.quantize is 0",
+                    default = "none",
+                    alternatives = ("none", "rice", "gzip"),
+                ),
+                cpl.ui.ParameterValue(
+                    name = "zp.output.quantize",
+                    context = "zp",
+                    description = "Quantisation of compressed float products in levels per noise sigma, 0 for lossless",
+                    default = DEFAULT_QUANTIZE,
+                ),
+                cpl.ui.ParameterValue(
+                    name = "zp.instrument",
+                    context = "zp",
+                    description = "Record the time and memory of each processing stage as QC keywords and a JSON sidecar",
+                    default = False
+                ),
             ),
         )
 
     def run(self, frameset: cpl.ui.FrameSet, settings: Dict[str, Any]) -> cpl.ui.FrameSet:
+        for key, value in settings.items():
+            try:
+                self.parameters[key].value = value
+            except KeyError:
+                cpl.core.Msg.warning(
+                    self._name,
+                    f"Settings includes {key}:{value} but {self} has no parameter named {key}.",
+                )
 
         output_file = "SCIENCE_FRAME.fits"
         output_frame = cpl.ui.FrameSet()
@@ -40,39 +119,80 @@ class Photometry(cpl.ui.PyRecipe):
         zp_r = None
         zp_v = None
 
-        pattern_doub = r'value\s+:\s+(\d+)'
-        pattern_strg = r"value\s+:\s+'(\w+)'"
-        pattern_fil = r"value\s+:\s+'(\w+\s\w)'"
-
         if len(frameset) == 0:
             cpl.core.Msg.error(
                 self.name,
                 f"No frames in frameset."
             )
 
+        catalog_file = self.parameters["zp.catalog"].value
+        sigma = self.parameters["zp.detect.sigma"].value
+        stages = Stages.from_parameters(self.parameters, "zp")
+        matcher = None
+        if catalog_file:
+            cpl.core.Msg.info(self.name, f"Loading standard star catalog {catalog_file!r}.")
+            matcher = CatalogMatcher(load_catalog(catalog_file), self.parameters["zp.match.radius"].value)
 
         for frame in frameset:
             frame.group = cpl.ui.Frame.FrameGroup.RAW
-            obj_typ_list = cpl.core.PropertyList.load_regexp(frame.file, 0, "OBJTYP", False)
-            obj_typ = obj_typ_list.dump(show=False)
-            match_obj = re.search(pattern_strg, obj_typ).group(1) # type: ignore
+            header = read_header(frame.file)
+            match_obj = header.objtyp
             cpl.core.Msg.debug(self.name, f"Got standard frame: {frame.file} of type: {match_obj}.")
-            exp_time_list = cpl.core.PropertyList.load_regexp(frame.file, 0, "EXPTIME", False)
-            exp_time = cpl.core.PropertyList.dump(exp_time_list, show=False)
-            match_exp = float(re.search(pattern_doub, exp_time).group(1)) # type: ignore
+            match_exp = header.exptime
             cpl.core.Msg.debug(self.name, f"Loading standard image...")
-            input_image = cpl.core.Image.load(frame.file)
-            apertures= cpl.drs.Apertures.extract_sigma(input_image, 18.0)
-            apertures.sort_by_flux()
+            with stages.stage("load"):
+                input_image = cpl.core.Image.load(frame.file, extension=image_extension(frame.file))
+            with stages.stage("detect"):
+                apertures= cpl.drs.Apertures.extract_sigma(input_image, sigma)
+                apertures.sort_by_flux()
             brightness = apertures.get_flux(1)
             cpl.core.Msg.info(
                 self.name,
                 f"Calculating zero point"
             )
             m_inst = -2.5*np.log10(brightness/match_exp)
-            filter_typ_list = cpl.core.PropertyList.load_regexp(frame.file, 0, "FILTER", False)
-            filter_typ = filter_typ_list.dump(show=False)
-            match_filter = re.search(pattern_fil, filter_typ).group(1) # type: ignore
+            match_filter = header.filter
+            if matcher is not None:
+                band = filter_band(match_filter)
+                if band not in matcher.catalog.dtype.names:
+                    cpl.core.Msg.error(self.name, f"Catalog has no magnitudes for filter {match_filter!r}.")
+                    continue
+                # CPL centroids are 1-based FITS pixel coordinates.
+                x = np.array([apertures.get_centroid_x(ind) for ind in range(1, apertures.size + 1)]) - 1.0
+                y = np.array([apertures.get_centroid_y(ind) for ind in range(1, apertures.size + 1)]) - 1.0
+                with stages.stage("load"):
+                    image = read_image(frame.file)
+                with stages.stage("photometry"):
+                    measured = aperture_photometry(
+                        image, x, y,
+                        self.parameters["zp.aperture.radius"].value,
+                        self.parameters["zp.annulus.inner"].value,
+                        self.parameters["zp.annulus.outer"].value,
+                    )
+                    inst_mags = instrumental_magnitude(measured["FLUX"], match_exp)
+                try:
+                    with stages.stage("match"):
+                        match = matcher.match(x, y, fits.getheader(frame.file))
+                except ValueError as err:
+                    cpl.core.Msg.error(self.name, f"Cannot match {frame.file!r} to the catalog: {err} Skipping it.")
+                    continue
+                matched = match >= 0
+                zp, zp_rms, nstars = robust_zero_point(
+                    matcher.catalog[band][match[matched]],
+                    inst_mags[matched],
+                    self.parameters["zp.clip.kappa"].value,
+                )
+                if nstars:
+                    cpl.core.Msg.info(
+                        self.name,
+                        f"Zero point {zp:.3f} +- {zp_rms:.3f} from {nstars} of {len(x)} detected stars."
+                    )
+                else:
+                    cpl.core.Msg.warning(
+                        self.name,
+                        f"None of the {len(x)} detected stars in {frame.file!r} matched the catalog, "
+                        f"not writing a zero point."
+                    )
             product_properties = cpl.core.PropertyList()
             product_properties.append(
                 cpl.core.Property("OBJTYP", match_obj)
@@ -83,7 +203,18 @@ class Photometry(cpl.ui.PyRecipe):
             product_properties.append(
                 cpl.core.Property("FILTER", match_filter)
             )
-            if match_filter == "Bessel R":
+            if matcher is not None:
+                if nstars:
+                    product_properties.append(
+                        cpl.core.Property("ZEROPOINT", zp)
+                    )
+                    product_properties.append(
+                        cpl.core.Property("ESO QC ZP RMS", zp_rms)
+                    )
+                product_properties.append(
+                    cpl.core.Property("ESO QC ZP NSTARS", nstars)
+                )
+            elif match_filter == "Bessel R":
                 zp_r = mag_r_land - m_inst
                 product_properties.append(
                     cpl.core.Property("ZEROPOINT", zp_r)
@@ -95,18 +226,26 @@ class Photometry(cpl.ui.PyRecipe):
                 )
             product_properties.append(
                 cpl.core.Property("ESO PRO CATG", cpl.core.Type.STRING, r"OBJECT_REDUCED"))
+            for key, value in stages.qc_properties():
+                product_properties.append(cpl.core.Property(key, value))
             
             cpl.core.Msg.info(self.name, f"Saving product file as {output_file!r}.")
 
-            cpl.dfs.save_image(
-                    frameset,
-                    self.parameters,
-                    frameset,
-                    input_image,
-                    self.name,
-                    product_properties,
-                    f"demo/{self.version!r}",
+            with stages.stage("save"):
+                cpl.dfs.save_image(
+                        frameset,
+                        self.parameters,
+                        frameset,
+                        input_image,
+                        self.name,
+                        product_properties,
+                        f"demo/{self.version!r}",
+                        output_file,
+                    )
+                compress_product(
                     output_file,
+                    self.parameters["zp.output.compression"].value,
+                    self.parameters["zp.output.quantize"].value,
                 )
             output_frame.append(
                 cpl.ui.Frame(
@@ -114,4 +253,5 @@ class Photometry(cpl.ui.PyRecipe):
                     tag="STANDARD_FRAME",
                     group=cpl.ui.Frame.FrameGroup.CALIB,
                 ))
+        stages.write_sidecar(output_file, recipe=self.name, frames=len(frameset))
         return output_frame
\ No newline at end of file
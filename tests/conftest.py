@@ -0,0 +1,7 @@
+"""Put the recipe helpers and scripts on the module path, as the recipes and scripts do themselves."""
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for directory in ("recipes", "python_scripts", "benchmarks"):
+    sys.path.insert(0, os.path.join(ROOT, directory))
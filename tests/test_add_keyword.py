@@ -0,0 +1,49 @@
+import warnings
+
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from add_keyword import apply_edits, edit_header
+
+
+@pytest.fixture
+def frame(tmp_path):
+    header = fits.Header()
+    header["OBJECT"] = "M42"
+    header["HIERARCH ESO DET DIT"] = 1.0
+    path = tmp_path / "frame.fits"
+    fits.PrimaryHDU(np.arange(6, dtype=np.uint16).reshape(2, 3), header).writeto(path)
+    return str(path)
+
+
+def test_hierarch_keyword_is_replaced(frame):
+    for value in ("2", "3", "4"):
+        assert edit_header(frame, [("ESO DET DIT", value, None)]) == "in place"
+    header = fits.getheader(frame)
+    assert header["ESO DET DIT"] == "4"
+    assert sum(keyword == "ESO DET DIT" for keyword in header) == 1
+    np.testing.assert_array_equal(fits.getdata(frame), np.arange(6).reshape(2, 3))
+
+
+def test_short_keyword_is_replaced_case_insensitively(frame):
+    edit_header(frame, [("object", "M31", None)])
+    header = fits.getheader(frame)
+    assert header["OBJECT"] == "M31"
+    assert list(header).count("OBJECT") == 1
+
+
+def test_new_keyword_is_inserted_at_position():
+    cards = [fits.Card("A", 1).image, fits.Card("B", 2).image]
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        edited = apply_edits(cards, [("C", "x", 1), ("ESO OBS NAME", "y", None)])
+    assert [fits.Card.fromstring(card).keyword for card in edited] == ["A", "C", "B", "ESO OBS NAME"]
+
+
+def test_outgrown_header_is_rewritten(frame):
+    edits = [(f"KEY{i}", "value", None) for i in range(40)]
+    assert edit_header(frame, edits) == "rewritten"
+    header = fits.getheader(frame)
+    assert header["KEY39"] == "value"
+    np.testing.assert_array_equal(fits.getdata(frame), np.arange(6).reshape(2, 3))
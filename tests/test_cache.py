@@ -0,0 +1,75 @@
+import os
+import time
+
+from collections import namedtuple
+
+import numpy as np
+from astropy.io import fits
+
+from figl_cache import ProductCache
+
+Frame = namedtuple("Frame", "file tag")
+Parameter = namedtuple("Parameter", "name value")
+
+
+def write(path, value):
+    fits.PrimaryHDU(np.full((8, 8), value, dtype=np.float32)).writeto(path, overwrite=True)
+    return str(path)
+
+
+def test_fetched_master_keeps_dependent_keys(tmp_path):
+    cache = ProductCache(str(tmp_path / "cache"))
+    raw = write(tmp_path / "dark.fits", 1)
+    bias = write(tmp_path / "bias.fits", 2)
+    cache.store("bias", bias)
+
+    frames = [Frame(raw, "DARK"), Frame(bias, "MASTER_BIAS")]
+    before = cache.key("dark_processor", "1", frames, [])
+    time.sleep(0.01)
+    assert cache.fetch("bias", bias)
+    assert cache.key("dark_processor", "1", frames, []) == before
+
+    write(bias, 3)
+    assert cache.key("dark_processor", "1", frames, []) != before
+
+
+def test_key_ignores_execution_parameters(tmp_path):
+    frames = [Frame(write(tmp_path / "bias.fits", 1), "BIAS")]
+    key = ProductCache.key("bias_processor", "1", frames, [Parameter("mbias.stacking.method", "median")])
+    assert key == ProductCache.key("bias_processor", "1", frames, [
+        Parameter("mbias.stacking.method", "median"), Parameter("mbias.workers", 4),
+        Parameter("mbias.stacking.memory", 10.0)])
+    assert key != ProductCache.key("bias_processor", "1", frames, [Parameter("mbias.stacking.method", "mean")])
+
+
+def test_fetched_product_is_a_copy(tmp_path):
+    cache = ProductCache(str(tmp_path / "cache"))
+    product = write(tmp_path / "MASTER_BIAS.fits", 1)
+    (tmp_path / "MASTER_BIAS.stages.json").write_text("{}")
+    cache.store("key", product)
+
+    output = str(tmp_path / "out" / "MASTER_BIAS.fits")
+    os.makedirs(os.path.dirname(output))
+    assert cache.fetch("key", output)
+    assert os.path.exists(tmp_path / "out" / "MASTER_BIAS.stages.json")
+    assert os.stat(output).st_ino != os.stat(cache._path("key")).st_ino
+    with fits.open(output, mode="update") as hdul:
+        hdul[0].data[:] = 7
+    assert fits.getdata(cache._path("key"))[0, 0] == 1
+    assert not cache.fetch("other", output)
+
+
+def test_evicts_least_recently_used(tmp_path):
+    product = write(tmp_path / "product.fits", 1)
+    size = os.path.getsize(product)
+    cache = ProductCache(str(tmp_path / "cache"), max_size=2.5 * size / 2**20)
+    for key in ("a", "b"):
+        cache.store(key, product)
+        time.sleep(0.01)
+    mtime = os.stat(cache._path("a")).st_mtime_ns
+    assert cache.fetch("a", str(tmp_path / "out.fits"))
+    assert os.stat(cache._path("a")).st_mtime_ns == mtime
+
+    cache.store("c", product)
+    assert sorted(os.path.basename(path) for path, _, _ in cache.entries()) == ["a.fits", "c.fits"]
+    assert not os.path.exists(os.path.join(cache.root, "b.json"))
@@ -0,0 +1,103 @@
+import numpy as np
+import pytest
+
+import figl_calib
+from figl_calib import CalibrationModel, DarkScaler
+
+SHAPE = (37, 29)
+
+
+@pytest.fixture
+def masters():
+    rng = np.random.default_rng(0)
+    bias = rng.normal(300.0, 2.0, SHAPE)
+    dark_rate = rng.uniform(0.0, 0.5, SHAPE)
+    flat = rng.uniform(0.8, 1.2, SHAPE)
+    flat[3, 4] = 0.0
+    flat[20, :] = 0.0
+    return bias, dark_rate, flat
+
+
+def three_pass(frame, bias, dark_rate, flat, exptime):
+    """(frame - bias - dark * exptime) / flat, zero where the flat is zero."""
+    reduced = frame - bias - dark_rate * exptime
+    return np.divide(reduced, flat, out=np.zeros_like(reduced), where=flat != 0)
+
+
+@pytest.mark.parametrize("band", [(0, SHAPE[0]), (5, 18), (20, 21), (30, SHAPE[0])])
+@pytest.mark.parametrize("raw_dtype", [np.float64, np.uint16])
+def test_apply_matches_three_passes(masters, band, raw_dtype):
+    bias, dark_rate, flat = masters
+    model = CalibrationModel(bias, dark_rate, flat)
+    rng = np.random.default_rng(1)
+    y0, y1 = band
+    for exptime in (10.0, 60.0, 10.0, 0.0, 300.0):
+        frame = rng.uniform(1000.0, 20000.0, SHAPE).astype(raw_dtype)
+        expected = three_pass(frame.astype(np.float64), bias, dark_rate, flat, exptime)[y0:y1]
+        calibrated = model.apply(frame[y0:y1].copy(), y0, y1, exptime)
+        assert calibrated.dtype == np.float64
+        np.testing.assert_allclose(calibrated, expected, rtol=1e-12, atol=1e-9)
+
+
+def test_float_bands_are_calibrated_in_place(masters):
+    model = CalibrationModel(*masters)
+    band = np.full((4, SHAPE[1]), 5000.0)
+    assert model.apply(band, 2, 6, 30.0) is band
+
+
+def test_chunk_boundaries(masters, monkeypatch):
+    bias, dark_rate, flat = masters
+    frame = np.random.default_rng(2).uniform(1000.0, 20000.0, SHAPE)
+    expected = three_pass(frame, bias, dark_rate, flat, 45.0)
+    # Chunks of 2 and of 1 row, neither dividing the band height.
+    for chunk_rows in (2, 1):
+        monkeypatch.setattr(figl_calib, "CHUNK_BYTES", chunk_rows * SHAPE[1] * 8)
+        calibrated = CalibrationModel(bias, dark_rate, flat).apply(frame[3:34].copy(), 3, 34, 45.0)
+        np.testing.assert_allclose(calibrated, expected[3:34], rtol=1e-12, atol=1e-9)
+
+
+def test_single_precision(masters):
+    bias, dark_rate, flat = masters
+    model = CalibrationModel(bias, dark_rate, flat, dtype=np.float32)
+    frame = np.random.default_rng(3).integers(1000, 20000, SHAPE).astype(np.uint16)
+    calibrated = model.apply(frame[8:30], 8, 30, 120.0)
+    assert calibrated.dtype == np.float32
+    expected = three_pass(frame.astype(np.float64), bias, dark_rate, flat, 120.0)[8:30]
+    np.testing.assert_allclose(calibrated, expected, rtol=1e-5, atol=1e-3)
+    assert np.all(calibrated[20 - 8] == 0.0)
+
+
+def test_dark_scaler_per_exposure_time(masters):
+    bias, dark_rate, _ = masters
+    scaler = DarkScaler(dark_rate, bias)
+    for exptime in (10.0, 60.0, 0.0):
+        np.testing.assert_allclose(scaler.scaled(exptime), bias + dark_rate * exptime, rtol=1e-15)
+    assert scaler.scaled(60.0) is scaler.scaled(60.0)
+    np.testing.assert_allclose(DarkScaler(dark_rate).scaled(5.0), dark_rate * 5.0)
+
+
+def test_dark_scaler_evicts_least_recently_used(masters):
+    _, dark_rate, _ = masters
+    scaler = DarkScaler(dark_rate, cache_size=2)
+    ten = scaler.scaled(10.0)
+    twenty = scaler.scaled(20.0)
+    assert scaler.scaled(10.0) is ten
+    scaler.scaled(30.0)  # Evicts 20 s, used longest ago.
+    assert scaler.scaled(10.0) is ten
+    assert scaler.scaled(20.0) is not twenty
+    np.testing.assert_array_equal(scaler.scaled(20.0), twenty)
+
+
+def test_dark_scaler_images_are_read_only(masters):
+    bias, dark_rate, _ = masters
+    scaled = DarkScaler(dark_rate, bias).scaled(10.0)
+    with pytest.raises(ValueError):
+        scaled += 1.0
+    offset = CalibrationModel(*masters).offset(10.0)
+    with pytest.raises(ValueError):
+        offset[0, 0] = 0.0
+
+
+def test_dark_scaler_without_exposure_time(masters):
+    with pytest.raises(ValueError, match="exposure time"):
+        DarkScaler(masters[1]).scaled(None)
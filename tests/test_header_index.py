@@ -0,0 +1,27 @@
+import numpy as np
+from astropy.io import fits
+
+from header_index import observing_night, read_keywords
+
+
+def test_read_keywords(tmp_path):
+    header = fits.Header()
+    header["HIERARCH ESO DET DIT"] = 1.0
+    header["IMAGETYP"] = "Flat Field "
+    header["FILTER"] = "Bessel V"
+    header["DATE-OBS"] = "2024-03-15T03:10:00.000"
+    header["EXPTIME"] = 2.5
+    path = tmp_path / "flat.fits"
+    fits.PrimaryHDU(np.zeros((2, 2), dtype=np.uint16), header).writeto(path)
+
+    values = read_keywords(str(path))
+    assert values == {"imagetyp": "Flat Field", "filter": "Bessel V", "date_obs": "2024-03-15T03:10:00.000",
+                      "exptime": 2.5, "night": "2024-03-14"}
+
+
+def test_observing_night():
+    assert observing_night("2024-03-14T20:00:00") == "2024-03-14"
+    assert observing_night("2024-03-15T11:59:59") == "2024-03-14"
+    assert observing_night("2024-03-15T12:00:00") == "2024-03-15"
+    assert observing_night("2024-03-15T02:00:00", boundary=0.0) == "2024-03-15"
+    assert observing_night(None) is None
@@ -0,0 +1,34 @@
+import json
+import time
+
+from figl_instrument import Stages
+
+
+def test_nested_stage_time_is_exclusive():
+    stages = Stages(enabled=True)
+    with stages.stage("outer"):
+        with stages.stage("inner"):
+            time.sleep(0.05)
+    assert stages.times["inner"] >= 0.05
+    assert stages.times["outer"] < 0.05
+    assert dict(stages.qc_properties())["ESO QC TIME INNER"] >= 0.05
+
+
+def test_disabled_stages_record_nothing(tmp_path):
+    stages = Stages()
+    with stages.stage("load"):
+        pass
+    stages.write_sidecar(str(tmp_path / "MASTER_BIAS.fits"))
+    assert stages.qc_properties() == []
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_sidecar_lists_products(tmp_path):
+    stages = Stages(enabled=True)
+    with stages.stage("noise"):
+        pass
+    stages.write_sidecar(str(tmp_path / "FLAT.fits"), ["FLAT_0.fits", "FLAT_2.fits"], recipe="raw_prep")
+    report = json.loads((tmp_path / "FLAT.stages.json").read_text())
+    assert report["products"] == ["FLAT_0.fits", "FLAT_2.fits"]
+    assert "product" not in report
+    assert report["recipe"] == "raw_prep" and report["stages"]["noise"]["calls"] == 1
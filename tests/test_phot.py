@@ -0,0 +1,106 @@
+import numpy as np
+import pytest
+from astropy.io import fits
+from astropy.wcs import WCS
+
+from figl_io import write_table_columns
+from figl_phot import CatalogMatcher, GridIndex, aperture_photometry, robust_zero_point
+
+
+def test_grid_index_nearest_matches_brute_force():
+    rng = np.random.default_rng(1)
+    ref = rng.uniform(0, 500, (2, 2000))
+    query = rng.uniform(0, 500, (2, 300))
+    match, distance = GridIndex(ref[0], ref[1], 5.0).nearest(query[0], query[1], 5.0)
+
+    dist = np.hypot(query[0][:, None] - ref[0][None, :], query[1][:, None] - ref[1][None, :])
+    expected = np.where(dist.min(axis=1) <= 5.0, dist.argmin(axis=1), -1)
+    np.testing.assert_array_equal(match, expected)
+    np.testing.assert_allclose(distance[match >= 0], dist.min(axis=1)[match >= 0])
+
+
+def test_robust_zero_point_clips_outliers():
+    rng = np.random.default_rng(2)
+    catalog = rng.uniform(10, 15, 50)
+    instrumental = catalog - 22.0 + rng.normal(0, 0.01, 50)
+    instrumental[:3] += 2.0
+    zp, rms, nstars = robust_zero_point(catalog, instrumental)
+    assert zp == pytest.approx(22.0, abs=0.01)
+    assert rms < 0.05
+    assert nstars == 47
+
+
+def test_robust_zero_point_without_stars():
+    zp, rms, nstars = robust_zero_point([], [])
+    assert nstars == 0 and np.isnan(zp)
+
+
+def celestial_catalog():
+    dtype = [("ID", "i8"), ("RA", "f8"), ("DEC", "f8"), ("V", "f8")]
+    return np.array([(1, 150.0, 2.0, 12.0), (2, 150.01, 2.01, 13.0)], dtype=dtype)
+
+
+def test_celestial_matching_needs_a_wcs():
+    matcher = CatalogMatcher(celestial_catalog(), 2.0)
+    with pytest.raises(ValueError, match="celestial WCS"):
+        matcher.match(np.array([10.0]), np.array([10.0]), fits.Header())
+
+
+def test_celestial_matching_through_wcs():
+    wcs = WCS(naxis=2)
+    wcs.wcs.ctype = ["RA---TAN", "DEC--TAN"]
+    wcs.wcs.crval = [150.0, 2.0]
+    wcs.wcs.crpix = [101.0, 101.0]
+    wcs.wcs.cdelt = [-1.0 / 3600, 1.0 / 3600]
+    x, y = wcs.all_world2pix([150.01, 150.0, 150.05], [2.01, 2.0, 2.05], 0)
+    match = CatalogMatcher(celestial_catalog(), 2.0).match(x + 0.3, y - 0.3, wcs.to_header())
+    np.testing.assert_array_equal(match, [1, 0, -1])
+
+
+def brute_force_photometry(image, x, y, radius, inner, outer):
+    yy, xx = np.indices(image.shape)
+    flux, sky = [], []
+    for xc, yc in zip(x, y):
+        xi, yi = int(np.rint(xc)), int(np.rint(yc))
+        r2 = (xx - xc) ** 2 + (yy - yc) ** 2
+        # The cutout of the vectorised code reaches at most ceil(outer) + 1 pixels out.
+        near = (np.abs(xx - xi) <= np.ceil(outer) + 1) & (np.abs(yy - yi) <= np.ceil(outer) + 1)
+        level = np.median(image[near & (r2 >= inner ** 2) & (r2 <= outer ** 2)])
+        aperture = near & (r2 <= radius ** 2)
+        flux.append(image[aperture].sum() - level * aperture.sum())
+        sky.append(level)
+    return np.array(flux), np.array(sky)
+
+
+def test_aperture_photometry_matches_brute_force(monkeypatch):
+    import figl_phot
+
+    monkeypatch.setattr(figl_phot, "BATCH_SIZE", 7)
+    rng = np.random.default_rng(3)
+    image = rng.normal(100.0, 5.0, (80, 90))
+    x = np.r_[rng.uniform(0, 89, 20), 0.2, 88.7]
+    y = np.r_[rng.uniform(0, 79, 20), 79.0, 0.4]
+    measured = aperture_photometry(image, x, y, 3.0, 5.0, 8.0)
+    flux, sky = brute_force_photometry(image, x, y, 3.0, 5.0, 8.0)
+    np.testing.assert_allclose(measured["SKY"], sky)
+    np.testing.assert_allclose(measured["FLUX"], flux, atol=1e-8)
+
+
+def test_write_table_columns(tmp_path):
+    header = fits.Header()
+    header["EXTNAME"] = "PHOT"
+    empty = fits.BinTableHDU.from_columns(
+        [fits.Column(name="FRAME", format="J", array=np.zeros(0, np.int32)),
+         fits.Column(name="FLUX", format="D", array=np.zeros(0))], header=header)
+    primary = fits.PrimaryHDU()
+    primary.header["HIERARCH ESO PRO CATG"] = "PHOTOMETRY_TABLE"
+    path = str(tmp_path / "table.fits")
+    fits.HDUList([primary, empty]).writeto(path)
+
+    write_table_columns(path, {"FRAME": np.arange(4), "FLUX": np.linspace(0.0, 1.0, 4)})
+    with fits.open(path) as hdul:
+        assert hdul[0].header["ESO PRO CATG"] == "PHOTOMETRY_TABLE"
+        assert hdul[1].header["EXTNAME"] == "PHOT"
+        assert hdul[1].columns.formats == ["J", "D"]
+        np.testing.assert_array_equal(hdul[1].data["FRAME"], np.arange(4))
+        np.testing.assert_allclose(hdul[1].data["FLUX"], np.linspace(0.0, 1.0, 4))
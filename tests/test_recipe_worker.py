@@ -0,0 +1,60 @@
+import importlib
+import os
+import sys
+
+import pytest
+
+from recipe_worker import RecipeWorker, reload_order
+from run_workflow import HELPER_IMPORT
+
+SOURCES = {
+    "figl_wtest_base": "VALUE = {value}\n",
+    "figl_wtest_mid": "from figl_wtest_base import VALUE\nDOUBLE = 2 * VALUE\n",
+    "figl_wtest_other": "OTHER = 1\n",
+    "wtest_recipe": "import figl_wtest_other\nfrom figl_wtest_mid import DOUBLE\nRESULT = DOUBLE\n",
+}
+
+
+def test_reload_order():
+    imports = {"rec": {"figl_mid", "figl_other"}, "figl_mid": {"figl_base"}, "figl_base": set(), "figl_other": set(),
+               "rec2": {"figl_other"}}
+    assert reload_order({"figl_base"}, imports) == ["figl_base", "figl_mid", "rec"]
+    assert reload_order({"figl_other"}, imports) == ["figl_other", "rec", "rec2"]
+    assert reload_order({"rec"}, imports) == ["rec"]
+    assert reload_order({"a"}, {"a": {"b"}, "b": {"a"}}) == ["b", "a"]
+
+
+@pytest.fixture
+def recipes(tmp_path, monkeypatch):
+    def write(name, value=1, mtime=1_000_000_000):
+        path = tmp_path / f"{name}.py"
+        path.write_text(SOURCES[name].format(value=value))
+        os.utime(path, ns=(mtime, mtime))
+
+    for name in SOURCES:
+        write(name)
+    monkeypatch.syspath_prepend(str(tmp_path))
+    importlib.invalidate_caches()
+    yield write
+    for name in SOURCES:
+        sys.modules.pop(name, None)
+
+
+def test_helper_edit_reaches_recipe(tmp_path, recipes):
+    worker = RecipeWorker.__new__(RecipeWorker)
+    worker.recipes_dir = str(tmp_path)
+    worker.helper_import = HELPER_IMPORT
+    worker._mtimes = {}
+    recipe = worker._module("wtest_recipe")
+    assert recipe.RESULT == 2
+    other = sys.modules["figl_wtest_other"]
+
+    worker._reload_changed()
+    assert sys.modules["wtest_recipe"] is recipe and recipe.RESULT == 2
+
+    recipes("figl_wtest_base", value=5, mtime=2_000_000_000)
+    worker._reload_changed()
+    assert recipe.RESULT == 10
+    assert sys.modules["figl_wtest_mid"].DOUBLE == 10
+    # Modules not depending on the edited helper are left alone.
+    assert sys.modules["figl_wtest_other"] is other
@@ -0,0 +1,96 @@
+import os
+import shutil
+
+from collections import namedtuple
+
+import numpy as np
+from astropy.io import fits
+
+from run_workflow import (
+    NIGHT_KEYWORD, RECIPES_DIR, WORKFLOW_DIR, DataSource, InputFrame, add_nights, classify, find_recipes, job_key,
+    load_workflow, plan, read_headers, recipe_sources,
+)
+
+FakeTask = namedtuple("FakeTask", "recipe")
+
+
+class FakeJob:
+    def __init__(self, inputs):
+        self.task = FakeTask("dark_processor")
+        self._inputs = inputs
+
+    def inputs(self):
+        return self._inputs
+
+
+def test_recipe_sources_follow_helper_imports():
+    names = {os.path.basename(path) for path in recipe_sources("mDark")}
+    assert {"mDark.py", "figl_calib.py", "figl_stacking.py", "figl_instrument.py", "figl_io.py"} <= names
+    assert "mFlat.py" not in names
+
+
+def test_job_key_changes_with_helper_source(tmp_path):
+    recipes_dir = tmp_path / "recipes"
+    shutil.copytree(RECIPES_DIR, recipes_dir, ignore=shutil.ignore_patterns("__pycache__"))
+    raw = tmp_path / "dark.fits"
+    raw.write_bytes(b"raw")
+    job = FakeJob([InputFrame(str(raw), "DARK")])
+    recipes = find_recipes(str(recipes_dir))
+
+    key = job_key(job, recipes, {}, str(recipes_dir))
+    assert job_key(job, recipes, {}, str(recipes_dir)) == key
+    with open(recipes_dir / "figl_stacking.py", "a") as f:
+        f.write("\n# changed\n")
+    assert job_key(job, recipes, {}, str(recipes_dir)) != key
+    assert job_key(job, recipes, {"mdark.stacking.method": "mean"}, str(recipes_dir)) != key
+
+
+def write_frame(path, imagetyp, date_obs, **keywords):
+    header = fits.Header()
+    header["IMAGETYP"] = imagetyp
+    header["DATE-OBS"] = date_obs
+    header["ORIGIN"] = "LFOA"
+    header["FILTER"] = "Bessel V"
+    header["EXPTIME"] = 10.0
+    for keyword, value in keywords.items():
+        header[keyword] = value
+    fits.PrimaryHDU(np.zeros((2, 2), dtype=np.uint16), header).writeto(path)
+    return str(path)
+
+
+def test_calibrations_grouped_by_derived_night(tmp_path):
+    tasks = load_workflow(os.path.join(WORKFLOW_DIR, "figl_wkf.py"))
+    sources = {}
+    for task in tasks:
+        for node in [task.source()] + task.associated_inputs:
+            if isinstance(node, DataSource):
+                sources[node.name] = node
+    files = [
+        write_frame(tmp_path / "b1.fits", "bias", "2024-03-14T18:00:00"),
+        write_frame(tmp_path / "b2.fits", "bias", "2024-03-15T04:00:00"),
+        write_frame(tmp_path / "b3.fits", "bias", "2024-03-15T19:00:00"),
+        write_frame(tmp_path / "d1.fits", "dark", "2024-03-15T21:00:00"),
+    ]
+    headers = add_nights(read_headers(files))
+    assert all(NIGHT_KEYWORD not in fits.getheader(file) for file in files)
+
+    groups = classify(headers, sources.values())
+    assert sorted(len(group.frames) for group in groups["BIAS"]) == [1, 2]
+    jobs = plan([task for task in tasks if task.name in ("bias", "dark")], groups)
+    darks = [job for job in jobs if job.task.name == "dark"]
+    assert [job.associated[0].name for job in darks] == ["bias/2024-03-15"]
+
+
+def test_calibration_without_night_is_skipped(tmp_path, capsys):
+    tasks = load_workflow(os.path.join(WORKFLOW_DIR, "figl_wkf.py"))
+    sources = {task.source().name: task.source() for task in tasks}
+    files = [
+        write_frame(tmp_path / "b1.fits", "bias", ""),
+        write_frame(tmp_path / "b2.fits", "bias", "2024-03-14T18:00:00"),
+        write_frame(tmp_path / "s1.fits", "object", "not a date", OBJTYP="Supernova"),
+    ]
+    groups = classify(add_nights(read_headers(files)), sources.values())
+    assert [frame.file for group in groups["BIAS"] for frame in group.frames] == [files[1]]
+    # Science frames do not need a NIGHT.
+    assert [frame.file for group in groups["SCIENCE"] for frame in group.frames] == [files[2]]
+    assert capsys.readouterr().out.count("skipping b1.fits") == 1
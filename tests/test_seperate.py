@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from seperate import parse_slices, separate_data_cube_streaming
+
+
+@pytest.fixture
+def cube(tmp_path):
+    data = (np.arange(5)[:, None, None] * 100 + np.arange(12).reshape(3, 4)).astype(np.uint16)
+    path = tmp_path / "cube.fits"
+    fits.PrimaryHDU(data).writeto(path)
+    return str(path), data
+
+
+def test_parse_slices():
+    assert parse_slices("1-3,5") == {0, 1, 2, 4}
+
+
+def test_streaming_slices_match_cube(cube):
+    path, data = cube
+    separate_data_cube_streaming(path, workers=2)
+    for i in range(data.shape[0]):
+        np.testing.assert_array_equal(fits.getdata(path[:-5] + f"/Flat_{i + 1}.fits"), data[i])
+
+
+def test_combine_averages_selected_planes(cube):
+    path, data = cube
+    separate_data_cube_streaming(path, combine=parse_slices("2-3"), write=False)
+    np.testing.assert_allclose(fits.getdata(path[:-5] + "/Flat_combined.fits"), data[1:3].mean(axis=0))
+
+
+def test_combine_rejects_slices_outside_cube(cube):
+    path, _ = cube
+    with pytest.raises(ValueError, match=r"\[9\]"):
+        separate_data_cube_streaming(path, combine=parse_slices("1-2,9"), write=False)
@@ -0,0 +1,217 @@
+import time
+import tracemalloc
+
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from figl_stacking import FrameSource, LoadStats, _t_limit, band_rows, bands, stack_frames
+
+
+def write_frames(directory, frames, name="frame"):
+    files = []
+    for idx, data in enumerate(frames):
+        path = directory / f"{name}_{idx:03d}.fits"
+        fits.PrimaryHDU(data).writeto(path)
+        files.append(str(path))
+    return files
+
+
+@pytest.fixture
+def raw_frames(tmp_path):
+    rng = np.random.default_rng(0)
+    frames = rng.normal(1000.0, 30.0, (9, 23, 17))
+    frames[3, 5, 5] = 65000.0
+    return write_frames(tmp_path, np.clip(frames, 0, 65535).astype(np.uint16)), frames
+
+
+def sigclip_reference(frames, kappa, niter):
+    """Iterative kappa-sigma clipped mean, starting from leave-one-out statistics."""
+    n = frames.shape[0]
+    # Each value against the mean and sample sigma of the other frames.
+    others = np.array([np.delete(frames, idx, axis=0) for idx in range(n)])
+    deviation = np.abs(frames - others.mean(axis=1)) / np.sqrt(n / (n - 1))
+    keep = deviation <= _t_limit(kappa, n - 2) * others.std(axis=1, ddof=1)
+    center = frames.mean(axis=0)
+    for iteration in range(niter):
+        if iteration:
+            keep = np.abs(frames - center) <= kappa * sigma
+        used = keep.any(axis=0)
+        center = np.where(used, np.mean(frames, axis=0, where=keep), center)
+        sigma = np.nan_to_num(np.std(frames, axis=0, where=keep, ddof=1))
+    return center, n - keep.sum(axis=0)
+
+
+def test_t_limit():
+    # Two-sided 0.27% points of Student's t.
+    for dof, expected in [(1, 235.8), (3, 9.219), (10, 3.957), (1000, 3.008)]:
+        assert _t_limit(3.0, dof) == pytest.approx(expected, rel=1e-3)
+
+
+@pytest.mark.parametrize("nframes", [5, 6, 8])
+def test_sigclip_rejects_a_cosmic_in_small_stacks(tmp_path, nframes):
+    rng = np.random.default_rng(nframes)
+    frames = rng.normal(1000.0, 10.0, (nframes, 16, 16))
+    clean_qc, qc = {}, {}
+    clean = stack_frames(write_frames(tmp_path, frames, "clean"), "sigclip", qc=clean_qc)
+    frames[1, 7, 9] += 5000.0
+    combined = stack_frames(write_frames(tmp_path, frames, "cosmic"), "sigclip", qc=qc)
+    assert combined[7, 9] == pytest.approx(np.delete(frames[:, 7, 9], 1).mean(), rel=1e-12)
+    combined[7, 9] = clean[7, 9]
+    np.testing.assert_array_equal(combined, clean)
+    assert qc["NREJ TOTAL"] == clean_qc["NREJ TOTAL"] + 1
+    # Good values are rarely rejected.
+    assert clean_qc["NREJ TOTAL"] < 0.01 * frames.size
+
+
+def test_sigclip_constant_frames_keep_their_values(tmp_path):
+    frames = np.full((20, 3, 3), 1000.1)
+    frames[3, 1, 1] = 5000.0
+    qc = {}
+    combined = stack_frames(write_frames(tmp_path, frames), "sigclip", qc=qc)
+    np.testing.assert_allclose(combined, 1000.1, rtol=1e-15)
+    assert qc["NREJ TOTAL"] == 1 and qc["NREJ MAX"] == 1 and qc["NREJ NPIX"] == 1
+
+
+@pytest.fixture
+def float_frames(tmp_path):
+    rng = np.random.default_rng(1)
+    frames = rng.normal(100.0, 5.0, (8, 21, 11))
+    frames[2, 4, 6] = 1e4
+    frames[5, 10, :] = -1e3
+    return write_frames(tmp_path, frames, "float"), frames
+
+
+def test_bands_cover_the_image():
+    assert bands(10, 4) == [(0, 4), (4, 8), (8, 10)]
+    assert bands(3, 5) == [(0, 3)]
+    # One row is the floor, the image height the ceiling.
+    assert band_rows((100, 100), 10, "median", memory_limit=1e-9) == 1
+    assert band_rows((100, 100), 10, "mean", memory_limit=1024) == 100
+    # Median holds every frame, mean a fixed number of buffers.
+    assert band_rows((4096, 4096), 50, "median", 64) < band_rows((4096, 4096), 50, "mean", 64)
+
+
+@pytest.mark.parametrize("method", ["mean", "median", "sigclip"])
+@pytest.mark.parametrize("dtype", [np.float64, np.uint16])
+@pytest.mark.parametrize("prefetch", [0, 2])
+def test_peak_memory_within_budget(tmp_path, method, dtype, prefetch):
+    rng = np.random.default_rng(2)
+    files = write_frames(tmp_path, rng.normal(1000.0, 10.0, (10, 512, 512)).astype(dtype))
+    budget = 8
+    tracemalloc.start()
+    try:
+        combined = stack_frames(files, method, budget, prefetch=prefetch)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    # The combined image and, for sigclip, the rejection map are outputs.
+    outputs = combined.nbytes + (combined.size * 4 if method == "sigclip" else 0)
+    assert (peak - outputs) / 2**20 < 1.1 * budget
+
+
+@pytest.mark.parametrize("method", ["mean", "median", "sigclip"])
+def test_whole_frame_reference(float_frames, method):
+    files, frames = float_frames
+    qc = {}
+    combined = stack_frames(files, method, qc=qc)
+    if method == "mean":
+        np.testing.assert_allclose(combined, frames.mean(axis=0), rtol=1e-12)
+    elif method == "median":
+        np.testing.assert_array_equal(combined, np.median(frames, axis=0))
+    else:
+        expected, rejected = sigclip_reference(frames, kappa=3.0, niter=2)
+        np.testing.assert_allclose(combined, expected, rtol=1e-10)
+        assert qc["NREJ TOTAL"] == rejected.sum()
+        assert qc["NREJ MAX"] == rejected.max()
+        assert qc["NREJ NPIX"] == np.count_nonzero(rejected)
+        # The outliers are rejected.
+        assert abs(combined[4, 6] - 100.0) < 20.0
+        assert np.all(np.abs(combined[10] - 100.0) < 20.0)
+
+
+@pytest.mark.parametrize("method", ["mean", "median", "sigclip"])
+@pytest.mark.parametrize("memory,workers,prefetch", [
+    (0.001, 1, 0),  # one row per band
+    (1024, 3, 0),
+    (1024, 1, 3),
+    (0.001, 2, 4),
+])
+def test_bands_workers_and_prefetch_match_serial(float_frames, raw_frames, method, memory, workers, prefetch):
+    for files in (float_frames[0], raw_frames[0]):
+        serial_qc, qc = {}, {}
+        serial = stack_frames(files, method, qc=serial_qc, workers=1, prefetch=0)
+        combined = stack_frames(files, method, memory, qc=qc, workers=workers, prefetch=prefetch)
+        np.testing.assert_array_equal(combined, serial)
+        assert qc == serial_qc
+
+
+@pytest.mark.parametrize("workers,prefetch", [(1, 0), (3, 2)])
+def test_calibrated_stack_matches_numpy(raw_frames, workers, prefetch):
+    files, _ = raw_frames
+    raw = np.array([fits.getdata(file) for file in files], dtype=np.float64)
+    bias = np.linspace(0.0, 50.0, 23 * 17).reshape(23, 17)
+
+    def calibrate(idx, band, y0, y1):
+        return (band - bias[y0:y1]) * (idx + 1)
+
+    expected = (raw - bias) * np.arange(1, len(files) + 1)[:, None, None]
+    for memory in (1024, 0.001):
+        combined = stack_frames(files, "mean", memory, calibrate=calibrate, workers=workers, prefetch=prefetch)
+        np.testing.assert_allclose(combined, expected.mean(axis=0), rtol=1e-12)
+
+
+def test_native_frames_in_single_precision(raw_frames):
+    files, _ = raw_frames
+    raw = np.array([fits.getdata(file) for file in files], dtype=np.float32)
+    combined = stack_frames(files, "mean", native=True, dtype=np.float32,
+                            calibrate=lambda idx, band, y0, y1: band.astype(np.float32) - 10.0)
+    assert combined.dtype == np.float32
+    np.testing.assert_allclose(combined, raw.mean(axis=0) - 10.0, rtol=1e-6)
+
+
+def test_frame_source_keeps_order():
+    stats = LoadStats()
+    delays = [0.02, 0.0, 0.01, 0.0, 0.0]
+
+    def load(idx):
+        time.sleep(delays[idx])
+        return idx
+
+    for depth in (0, 1, 3, 10):
+        assert list(FrameSource(load, len(delays), depth, stats=stats)) == list(range(len(delays)))
+    assert stats.reads == 4 * len(delays)
+
+
+def test_unknown_method(raw_frames):
+    with pytest.raises(ValueError, match="Unknown stacking method"):
+        stack_frames(raw_frames[0], "mode")
+
+
+@pytest.mark.parametrize("dtype", [np.uint16, np.int16, ">i2", np.uint8, np.int8])
+@pytest.mark.parametrize("nframes", [7, 8])
+@pytest.mark.parametrize("integer_median", [True, False])
+def test_integer_median_matches_np_median(tmp_path, dtype, nframes, integer_median):
+    info = np.iinfo(np.dtype(dtype))
+    rng = np.random.default_rng(nframes)
+    frames = rng.integers(info.min, info.max, (nframes, 19, 13), endpoint=True).astype(dtype)
+    files = write_frames(tmp_path, frames)
+    expected = np.median(frames.astype(np.float64), axis=0)
+    for memory in (1024, 0.001):
+        combined = stack_frames(files, "median", memory, integer_median=integer_median)
+        np.testing.assert_array_equal(combined, expected)
+
+
+def test_integer_median_in_single_precision(raw_frames):
+    files, _ = raw_frames
+    expected = np.median([fits.getdata(file).astype(np.float64) for file in files], axis=0)
+    combined = stack_frames(files, "median", integer_median=True, dtype=np.float32)
+    assert combined.dtype == np.float32
+    np.testing.assert_array_equal(combined, expected.astype(np.float32))
+
+
+def test_median_of_calibrated_frames(raw_frames):
+    files, _ = raw_frames
+    bias = np.linspace(0.0, 50.0, 23 * 17).reshape(23, 17)
+    calibrated = stack_frames(files, "median", calibrate=lambda idx, band, y0, y1: band - bias[y0:y1])
+    np.testing.assert_allclose(calibrated, stack_frames(files, "median") - bias)
@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+
+from figl_stats import METHODS, image_statistics, mad, median, percentile
+
+
+def images():
+    rng = np.random.default_rng(0)
+    gaussian = rng.normal(6000.0, 80.0, (600, 600))
+    bimodal = np.concatenate([rng.normal(0.0, 1e-3, 90000), rng.normal(1000.0, 1e-3, 90000)])
+    return {
+        "gaussian": gaussian,
+        "bimodal": bimodal,
+        "uniform": rng.uniform(-1.0, 1.0, 200001),
+        "uint16": np.clip(gaussian, 0, 65535).astype(np.uint16),
+    }
+
+
+@pytest.mark.parametrize("name", ["gaussian", "bimodal", "uniform", "uint16"])
+@pytest.mark.parametrize("method", METHODS)
+@pytest.mark.parametrize("q", [10.0, 50.0, 90.0])
+def test_percentile_within_bound(name, method, q):
+    data = images()[name]
+    exact = np.percentile(data, q)
+    estimate = percentile(data, q, method)
+    assert abs(estimate.value - exact) <= estimate.error + 1e-9 * abs(exact)
+
+
+@pytest.mark.parametrize("method", METHODS)
+def test_mad_within_bound(method):
+    data = images()["gaussian"]
+    exact = np.median(np.abs(data - np.median(data)))
+    estimate = mad(data, method)
+    assert abs(estimate.value - exact) <= estimate.error + 1e-9
+
+
+def test_bimodal_median_histogram():
+    estimate = median(images()["bimodal"], "histogram")
+    assert estimate.value == pytest.approx(500.0, abs=1e-3)
+    assert estimate.error < 1e-3
+
+
+def test_integer_histogram_is_exact():
+    data = images()["uint16"]
+    assert median(data, "histogram") == (np.median(data), 0.0)
+
+
+def test_image_statistics_keywords():
+    data = images()["gaussian"]
+    assert set(image_statistics(data)) == {"MEDIAN", "MAD"}
+    assert set(image_statistics(data, "sampled")) == {"MEDIAN", "MAD", "MEDIAN ERR", "MAD ERR"}
+    with pytest.raises(ValueError):
+        median(data, "mode")
@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from subtract import output_name, subtract_bias, subtract_bias_batch
+
+
+def write_raw(path, values, blank=None):
+    hdu = fits.PrimaryHDU(np.asarray(values, dtype=np.int16))
+    hdu.header["BZERO"] = 32768
+    hdu.header["BSCALE"] = 1
+    if blank is not None:
+        hdu.header["BLANK"] = blank
+    hdu.writeto(path)
+    return str(path)
+
+
+@pytest.fixture
+def frames(tmp_path):
+    # Stored -32768 + 32768 = 0 is the BLANK value.
+    dark = write_raw(tmp_path / "dark.fits", [[-32768, -32000], [-31000, -30000]], blank=-32768)
+    bias = str(tmp_path / "bias.fits")
+    fits.writeto(bias, np.full((2, 2), 100, dtype=np.float32))
+    return dark, bias
+
+
+def test_output_name():
+    assert output_name("a/dark.fits") == "a/dark_d_subtracted.fits"
+    assert output_name("a/dark.fit") == "a/dark_d_subtracted.fit"
+    assert output_name("a.fits/dark") == "a.fits/dark_d_subtracted"
+
+
+@pytest.mark.parametrize("batch", [False, True])
+def test_blank_pixels_are_masked(frames, batch):
+    dark, bias = frames
+    if batch:
+        subtract_bias_batch([dark], bias, workers=1)
+    else:
+        subtract_bias([dark], bias)
+    with fits.open(output_name(dark)) as hdul:
+        data = hdul[0].data
+        header = hdul[0].header
+    assert np.isnan(data[0, 0])
+    np.testing.assert_allclose(data[1:, :].ravel(), [1668, 2668])
+    np.testing.assert_allclose(data[0, 1], 668)
+    assert "BLANK" not in header and "BZERO" not in header
+
+
+@pytest.mark.parametrize("dtype", ["int16", "uint16", np.int32])
+def test_batch_rejects_integer_types(frames, dtype):
+    dark, bias = frames
+    with pytest.raises(ValueError, match="floating point"):
+        subtract_bias_batch([dark], bias, dtype=dtype)
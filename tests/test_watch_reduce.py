@@ -0,0 +1,63 @@
+import os
+
+import numpy as np
+from astropy.io import fits
+
+import watch_reduce
+from watch_reduce import RunningStack, arrivals, is_complete, watch
+
+
+def write(path, value=0):
+    fits.PrimaryHDU(np.full((4, 4), value, dtype=np.uint16)).writeto(path)
+    return str(path)
+
+
+def test_is_complete(tmp_path):
+    path = write(tmp_path / "frame.fits")
+    assert is_complete(path)
+    with open(path, "r+b") as f:
+        f.truncate(2880 + 10)
+    assert not is_complete(path)
+    assert not is_complete(str(tmp_path / "missing.fits"))
+
+
+def test_arrivals_skip_files_removed_after_listing(tmp_path, monkeypatch):
+    first = write(tmp_path / "a.fits")
+    gone = write(tmp_path / "b.fits")
+    (tmp_path / "notes.txt").write_text("")
+    getmtime = os.path.getmtime
+
+    def vanishing(path):
+        if path == gone:
+            raise FileNotFoundError(path)
+        return getmtime(path)
+
+    monkeypatch.setattr(os.path, "getmtime", vanishing)
+    assert arrivals(str(tmp_path), set()) == [first]
+    assert arrivals(str(tmp_path), {first}) == []
+
+
+def test_watch_survives_removed_files(tmp_path, monkeypatch):
+    write(tmp_path / "a.fits")
+    listdir = os.listdir
+    monkeypatch.setattr(watch_reduce.os, "listdir", lambda directory: listdir(directory) + ["ghost.fits"])
+
+    class Recorder:
+        def __init__(self):
+            self.paths = []
+
+        def process(self, path):
+            self.paths.append(os.path.basename(path))
+
+    reducer = Recorder()
+    watch(str(tmp_path), reducer, once=True)
+    assert reducer.paths == ["a.fits"]
+
+
+def test_running_stack_window():
+    stack = RunningStack(window=2)
+    for value in (1.0, 2.0, 4.0):
+        stack.add(np.full((2, 2), value), value * 10)
+    assert stack.count == 2
+    np.testing.assert_allclose(stack.mean(), 3.0)
+    assert stack.exptime == 60.0
@@ -0,0 +1,45 @@
+"""Classification rules of the figl workflow.
+
+Calibrations are grouped and matched by observing night, the NIGHT keyword:
+the date on which the night started (noon to noon UT). run_workflow.py
+derives it from DATE-OBS while classifying the raw frames, and
+header_index.py keeps it in its index, so the raw data is never edited for
+it. Tools that read the raw headers directly, like the EDPS server, need it
+in the headers (``header_index.py stamp``). A bias, dark or flat without
+NIGHT raises an error here, instead of all such frames silently falling
+into one group. Science and standard star frames are neither grouped nor
+matched by NIGHT, so they are classified with or without it.
+"""
+NIGHT_KEYWORD = "NIGHT"
+
+
+def _value(f, keyword):
+    try:
+        value = f[keyword]
+    except (KeyError, IndexError):
+        return None
+    return str(value).strip() if value is not None else None
+
+
+def raw_rule(imagetyp, objtyp=None, by_night=False):
+    """Rule matching raw frames of ``imagetyp`` (and ``objtyp``), which must have a NIGHT if ``by_night``."""
+    def rule(f):
+        if _value(f, "IMAGETYP") != imagetyp:
+            return False
+        if objtyp is not None and _value(f, "OBJTYP") != objtyp:
+            return False
+        if by_night and not _value(f, NIGHT_KEYWORD):
+            raise ValueError(
+                f"Raw {imagetyp} frame (DATE-OBS {_value(f, 'DATE-OBS')}) has no {NIGHT_KEYWORD} keyword: "
+                f"classify it with run_workflow.py, which derives it from DATE-OBS, or stamp it with "
+                f"header_index.py stamp."
+            )
+        return True
+    return rule
+
+
+is_bias = raw_rule("bias", by_night=True)
+is_dark = raw_rule("dark", by_night=True)
+is_flat = raw_rule("flat", by_night=True)
+is_science = raw_rule("object", "Supernova")
+is_landold = raw_rule("object", "Landold")
@@ -1,27 +1,30 @@
 from edps import task, data_source, classification_rule
 
+from .figl_rules import is_bias, is_dark, is_flat, is_landold, is_science
+
 # Classification rules
-bias_class = classification_rule("BIAS", {"IMAGETYP": "bias"})
-dark_class = classification_rule("DARK", {"IMAGETYP": "dark"})
-prep_class = classification_rule("FLAT", {"IMAGETYP": "flat"})
-science_class = classification_rule("SCIENCE", {"IMAGETYP": "object", "OBJTYP": "Supernova"})
-landold_class = classification_rule("SCIENCE", {"IMAGETYP": "object", "OBJTYP": "Landold"})
+bias_class = classification_rule("BIAS", is_bias)
+dark_class = classification_rule("DARK", is_dark)
+prep_class = classification_rule("FLAT", is_flat)
+science_class = classification_rule("SCIENCE", is_science)
+landold_class = classification_rule("SCIENCE", is_landold)
 noise_level = classification_rule("CHOSEN_FLAT")
 
 # Data Sources
+# Calibrations are grouped by observing night (NIGHT, see figl_rules.py).
 raw_bias = (data_source("BIAS")
             .with_classification_rule(bias_class)
-            .with_grouping_keywords(["DATE-OBS"])
-            .with_match_keywords(["ORIGIN"])
+            .with_grouping_keywords(["NIGHT"])
+            .with_match_keywords(["ORIGIN", "NIGHT"])
             .build())
 raw_darks = (data_source("DARK")
             .with_classification_rule(dark_class)
-            .with_grouping_keywords(["DATE-OBS"])
-            .with_match_keywords(["ORIGIN"])
+            .with_grouping_keywords(["NIGHT"])
+            .with_match_keywords(["ORIGIN", "NIGHT"])
             .build())
 raw_prep = (data_source("FLAT")
             .with_classification_rule(prep_class)
-            .with_grouping_keywords(["DATE-OBS"])
+            .with_grouping_keywords(["NIGHT", "FILTER"])
             .with_match_keywords(["ORIGIN", "FILTER", "EXPTIME"])
             .build())
 raw_landold = (data_source("STANDARD")